@@ -0,0 +1,195 @@
+''' Benchmarks of the pipeline stages on synthetic data
+
+    For every scale (regions x days) a synthetic data folder is generated in a
+    temporary directory and the stages are timed there, so the benchmarks run
+    offline and never touch the real data/ folder. The result is a table of
+    timings per stage and scale, with the fitted scaling exponent of each
+    stage in the number of rows (regions x days).
+
+    Usage, from the project folder:
+
+        python -m src.benchmarks.run_benchmarks --scales 50x200 100x400 200x800 --repeat 3 \\
+            --output bench.json [--baseline old_bench.json --tolerance 1.5]
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+import pandas as pd
+import numpy as np
+
+from src import profiling
+from src.benchmarks.synthetic_data import write_synthetic_data
+from src.data.storage import load_dataset, find_dataset
+from src.data.process_JH_data import melt_JH_data_all, store_confirmed_data_for_sir
+from src.data.schema import compact_frame
+from src.features.build_features import (build_features, build_latest_global_statistics, calc_filtered_data,
+                                         calc_daily_values_all_countries, impute_missing_recovered_data)
+from src.models.SIR_modelling import exec_SIR_modelling
+
+
+
+DEFAULT_SCALES = ['50x200', '100x400', '200x800']
+
+
+
+def time_call(func, repeat=3, setup=None):
+    ''' Best wall time of repeat calls, setup() provides fresh arguments untimed
+    '''
+    best = np.inf
+    for _ in range(repeat):
+        args = setup() if setup is not None else ()
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+
+def remove_dataset(name):
+    ''' Delete a stored dataset in every format, returns no arguments for time_call
+    '''
+    path, _ = find_dataset(name)
+    while path is not None:
+        os.remove(path)
+        path, _ = find_dataset(name)
+    return ()
+
+
+
+def benchmark_scale(n_regions, n_days, repeat=3, seed=0):
+    ''' Time all stages for one synthetic data size
+
+        Returns:
+        ----------
+        timings: dict
+            stage name to best wall time in seconds
+    '''
+    root = tempfile.mkdtemp(prefix='covid_benchmark_')
+    work_dir = os.path.join(root, 'work')
+    os.makedirs(work_dir)
+    cwd = os.getcwd()
+
+    try:
+        write_synthetic_data(os.path.join(root, 'data'), n_regions, n_days, seed)
+        os.chdir(work_dir)
+
+        timings = {}
+        timings['melt_JH_data_all'] = time_call(melt_JH_data_all, repeat)
+
+        pd_JH_data = compact_frame(melt_JH_data_all())
+        timings['calc_filtered_data'] = time_call(calc_filtered_data, repeat, lambda: (pd_JH_data,))
+
+        build_features()
+        pd_result_larg = load_dataset('COVID_final_set')
+        impute_start_date = pd_result_larg['date'].min() + pd.Timedelta(days=n_days//2)
+        timings['impute_missing_recovered_data'] = time_call(
+            lambda df: impute_missing_recovered_data(df, impute_start_date=impute_start_date),
+            repeat, lambda: (pd_result_larg.copy(),))
+
+        pd_daily = pd_result_larg[['date','country','confirmed','deaths','recovered']] \
+                        .groupby(['country','date'], observed=True).agg(np.sum).reset_index()
+        timings['calc_daily_values_all_countries'] = time_call(calc_daily_values_all_countries, repeat, lambda: (pd_daily,))
+
+        timings['build_latest_global_statistics'] = time_call(build_latest_global_statistics, repeat)
+
+        store_confirmed_data_for_sir()
+        # without stored window parameters every call fits all windows instead of skipping unchanged ones
+        timings['exec_SIR_modelling'] = time_call(exec_SIR_modelling, repeat,
+                                                  lambda: remove_dataset('COVID_SIR_window_params'))
+
+        return timings
+
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root, ignore_errors=True)
+
+
+
+def scaling_exponents(df_results):
+    ''' Slope of log(time) over log(rows) per stage, 1 means linear scaling
+    '''
+    exponents = {}
+    for stage, df_stage in df_results.groupby('stage'):
+        if df_stage['rows'].nunique() < 2:
+            continue
+        exponents[stage] = np.polyfit(np.log(df_stage['rows']), np.log(df_stage['seconds']), 1)[0]
+    return exponents
+
+
+
+def compare_to_baseline(df_results, baseline_path, tolerance):
+    ''' Stages and scales that got slower than tolerance times the baseline
+    '''
+    df_baseline = pd.DataFrame(json.load(open(baseline_path))['results'])
+    df_compare = pd.merge(df_results, df_baseline, on=['stage', 'regions', 'days'], suffixes=('', '_baseline'))
+    return df_compare[df_compare['seconds'] > tolerance*df_compare['seconds_baseline']]
+
+
+
+def run_benchmarks(scales=DEFAULT_SCALES, repeat=3, seed=0):
+    ''' Run the benchmarks for all scales
+
+        Parameters:
+        ----------
+        scales: list
+            'REGIONSxDAYS' strings
+        repeat: int
+            calls per stage, the best time is reported
+        seed: int
+
+        Returns:
+        ----------
+        df_results: pd.DataFrame
+            columns stage, regions, days, rows, seconds
+    '''
+    results = []
+    for scale in scales:
+        n_regions, n_days = [int(each) for each in scale.lower().split('x')]
+        print('Benchmarking {} regions x {} days'.format(n_regions, n_days))
+        for stage, seconds in benchmark_scale(n_regions, n_days, repeat, seed).items():
+            results.append({'stage': stage, 'regions': n_regions, 'days': n_days,
+                            'rows': n_regions*n_days, 'seconds': seconds})
+    return pd.DataFrame(results)
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on synthetic data.')
+    parser.add_argument('--scales', nargs='+', default=DEFAULT_SCALES, help='sizes as REGIONSxDAYS')
+    parser.add_argument('--repeat', type=int, default=3, help='calls per stage, the best time is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='allowed slowdown factor against the baseline')
+    args = parser.parse_args(argv)
+
+    profiling.PROFILE_LOG = None
+
+    df_results = run_benchmarks(args.scales, args.repeat, args.seed)
+    exponents = scaling_exponents(df_results)
+
+    print(df_results.pivot_table(index='stage', columns='rows', values='seconds').round(4).to_string())
+    for stage, exponent in exponents.items():
+        print('{}: time ~ rows^{:.2f}'.format(stage, exponent))
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({'results': df_results.to_dict('records'), 'scaling_exponents': exponents}, output_file, indent=2)
+
+    if args.baseline:
+        df_regressions = compare_to_baseline(df_results, args.baseline, args.tolerance)
+        if len(df_regressions):
+            print('Performance regressions against {}:'.format(args.baseline))
+            print(df_regressions.to_string(index=False))
+            return 1
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,108 @@
+''' Synthetic data shaped like the Johns Hopkins and World Bank sources
+
+    Used by the benchmarks to run the pipeline offline at any scale.
+'''
+import os
+import pandas as pd
+import numpy as np
+
+from src.data.storage import save_dataset
+from src.data.process_JH_data import melt_world_population
+
+
+
+JH_TIME_SERIES_DIR = 'raw/COVID-19/csse_covid_19_data/csse_covid_19_time_series'
+
+
+
+def get_region_keys(n_regions, states_per_country=3):
+    ''' Country and state names, every country has one 'no state' row and some states
+    '''
+    countries = ['Country {}'.format(each//states_per_country) for each in range(n_regions)]
+    states = [np.nan if each % states_per_country == 0 else 'State {}'.format(each) for each in range(n_regions)]
+    return countries, states
+
+
+
+def generate_wide_time_series(n_regions, n_days, start_date='2020-01-22', seed=0):
+    ''' Cumulative confirmed, deaths and recovered in the wide JH layout
+
+        Parameters:
+        ----------
+        n_regions: int
+            number of rows (country/state combinations)
+        n_days: int
+            number of date columns
+        start_date: str
+        seed: int
+
+        Returns:
+        ----------
+        tables: dict
+            case type to pd.DataFrame with Province/State, Country/Region, Lat, Long and one column per day
+    '''
+    rng = np.random.default_rng(seed)
+    countries, states = get_region_keys(n_regions)
+    dates = pd.date_range(start_date, periods=n_days)
+    date_columns = ['{}/{}/{}'.format(each.month, each.day, each.year % 100) for each in dates]
+
+    # logistic epidemic curves with random size, speed and onset per region
+    size = rng.uniform(1e3, 1e6, (n_regions, 1))
+    rate = rng.uniform(0.05, 0.2, (n_regions, 1))
+    onset = rng.uniform(20, max(n_days*0.6, 21), (n_regions, 1))
+    days = np.arange(n_days)[None, :]
+    confirmed = np.floor(size/(1 + np.exp(-rate*(days - onset))))
+    noise = rng.poisson(3, (n_regions, n_days)).cumsum(axis=1)
+
+    values = {'confirmed': confirmed + noise,
+              'deaths': np.floor(0.02*confirmed),
+              'recovered': np.floor(0.8*np.roll(confirmed, 10, axis=1)*(days >= 10))}
+
+    tables = {}
+    for case_type, cumulative in values.items():
+        pd_wide = pd.DataFrame(cumulative.astype('int64'), columns=date_columns)
+        pd_wide.insert(0, 'Long', rng.uniform(-180, 180, n_regions).round(4))
+        pd_wide.insert(0, 'Lat', rng.uniform(-60, 70, n_regions).round(4))
+        pd_wide.insert(0, 'Country/Region', countries)
+        pd_wide.insert(0, 'Province/State', states)
+        tables[case_type] = pd_wide
+    return tables
+
+
+
+def generate_population(countries, first_year=2015, last_year=2030, seed=0):
+    ''' Population table in the processed wide World Bank layout
+    '''
+    rng = np.random.default_rng(seed)
+    countries = list(dict.fromkeys(countries))
+    df_population_data = pd.DataFrame({'Country Name': countries,
+                                       'Country Code': ['C{:03d}'.format(each) for each in range(len(countries))]})
+    population = rng.uniform(1e6, 1e8, len(countries))
+    for year in range(first_year, last_year + 1):
+        df_population_data[str(year)] = np.round(population*(1 + 0.01*(year - first_year)))
+    return df_population_data
+
+
+
+def write_synthetic_data(data_dir, n_regions, n_days, seed=0):
+    ''' Write the raw JH files and the processed population tables below data_dir
+
+        Parameters:
+        ----------
+        data_dir: str
+            the folder taking the role of data/, i.e. the pipeline runs in a sibling folder
+        n_regions: int
+        n_days: int
+        seed: int
+    '''
+    time_series_dir = os.path.join(data_dir, JH_TIME_SERIES_DIR)
+    for each in [time_series_dir, os.path.join(data_dir, 'processed'), os.path.join(data_dir, 'interim')]:
+        os.makedirs(each, exist_ok=True)
+
+    tables = generate_wide_time_series(n_regions, n_days, seed=seed)
+    for case_type, pd_wide in tables.items():
+        pd_wide.to_csv(os.path.join(time_series_dir, 'time_series_covid19_{}_global.csv'.format(case_type)), index=False)
+
+    df_population_data = generate_population(tables['confirmed']['Country/Region'], seed=seed)
+    df_population_data.to_csv(os.path.join(data_dir, 'processed', 'world_population_data.csv'), sep=',', index=False)
+    save_dataset(melt_world_population(df_population_data), 'world_population', directory=os.path.join(data_dir, 'processed'))
@@ -1,17 +1,380 @@
 import subprocess
 import os
+import time
 import pandas as pd
 import numpy as np
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import json
 import git
 
+from src.profiling import profile_stage, record_rows
+from src.data.storage import save_dataset
+
+
+
+# data sources, can be pointed to mirrors or a local test server
+JH_GIT_URL = os.environ.get('COVID_JH_GIT_URL', 'https://github.com/CSSEGISandData/COVID-19.git')
+RKI_URL = os.environ.get('COVID_RKI_URL', 'https://services7.arcgis.com/mOBPykOjAyBO2ZKk/arcgis/rest/services/RKI_Landkreisdaten/FeatureServer/0/query')
+WORLD_BANK_URL = os.environ.get('COVID_WORLD_BANK_URL', 'https://api.worldbank.org/v2/en/indicator/SP.POP.TOTL?downloadformat=csv')
+
+DOWNLOAD_CHUNK_SIZE = 1024*1024
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF = 1.0
+DOWNLOAD_TIMEOUT = 60
+
+# server errors worth another attempt
+RETRY_STATUS = {429, 500, 502, 503, 504}
+RETRY_ERRORS = (requests.ConnectionError, requests.Timeout, requests.HTTPError,
+                requests.exceptions.ChunkedEncodingError)
+
+JH_REPO_DIR = '../data/raw/COVID-19'
+JH_BRANCH = 'master'
+# the only part of the Johns Hopkins repository read by the pipeline
+JH_SPARSE_PATHS = ['csse_covid_19_data/csse_covid_19_time_series']
+
+# features per request of the RKI feature service, its maxRecordCount is 1000 or larger
+RKI_PAGE_SIZE = 1000
+NPGEO_DIR = '../data/raw/NPGEO/'
+
+
+
+def load_download_meta(filename):
+    ''' Validators (ETag, Last-Modified) of the last download of filename
+    '''
+    meta_file = filename + '.meta.json'
+    if not os.path.isfile(meta_file) or not os.path.isfile(filename):
+        return {}
+    with open(meta_file, 'r') as file_obj:
+        return json.load(file_obj)
+
+
+
+def save_download_meta(filename, response):
+    meta = {'url': response.url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified')}
+    with open(filename + '.meta.json', 'w') as file_obj:
+        json.dump(meta, file_obj, indent=2)
+
+
+
+def download_file(url, filename, params=None,
+                  chunk_size=DOWNLOAD_CHUNK_SIZE, retries=DOWNLOAD_RETRIES,
+                  backoff=DOWNLOAD_BACKOFF, timeout=DOWNLOAD_TIMEOUT):
+    ''' Stream url to filename, skipping the transfer if the file is unchanged
+
+        The body is written in chunks to filename.part and moved into place
+        when complete. The ETag and Last-Modified headers are kept next to
+        the file and sent as If-None-Match / If-Modified-Since on the next
+        call, a 304 answer keeps the existing file. An interrupted transfer
+        is resumed with a Range request where the server supports it.
+        Connection errors, timeouts and 429/5xx answers are retried with
+        exponential backoff.
+
+        Parameters:
+        ----------
+        url: str
+        filename: str
+            target file
+        params: dict
+            query parameters
+        chunk_size: int
+            bytes written per chunk
+        retries: int
+            further attempts after a failed one
+        backoff: float
+            seconds before the first retry, doubled for every further one
+        timeout: float
+            connect and read timeout in seconds
+
+        Returns:
+        ----------
+        downloaded: bool
+            False if the server reported the file as unchanged
+    '''
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    part_file = filename + '.part'
+    meta = load_download_meta(filename)
+
+    attempt = 0
+    while True:
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+        # resume only a partial file whose version the server can confirm
+        part_meta = load_download_meta(part_file)
+        validator = part_meta.get('etag') or part_meta.get('last_modified')
+        if validator and os.path.getsize(part_file):
+            headers['Range'] = 'bytes={}-'.format(os.path.getsize(part_file))
+            headers['If-Range'] = validator
+
+        try:
+            with requests.get(url, params=params, headers=headers, stream=True, timeout=timeout) as response:
+                if response.status_code == 304:
+                    return False
+                if response.status_code == 416 and 'Range' in headers:
+                    # stale partial file, start over without Range, not counted as a failed attempt
+                    for each in [part_file, part_file + '.meta.json']:
+                        os.remove(each)
+                    continue
+                if response.status_code in RETRY_STATUS:
+                    raise requests.HTTPError('{} for url {}'.format(response.status_code, response.url), response=response)
+                response.raise_for_status()
+
+                mode = 'ab' if response.status_code == 206 else 'wb'
+                with open(part_file, mode) as output_file:
+                    if mode == 'wb':
+                        save_download_meta(part_file, response)
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        output_file.write(chunk)
+
+                os.replace(part_file, filename)
+                os.replace(part_file + '.meta.json', filename + '.meta.json')
+                return True
+
+        except RETRY_ERRORS as error:
+            wait_before_retry(url, error, attempt, retries, backoff)
+            attempt += 1
+
+
+
+def wait_before_retry(url, error, attempt, retries, backoff):
+    ''' Sleep with exponential backoff before the next attempt, or re-raise the error
+
+        The error is raised again after the last attempt and for HTTP answers
+        that will not change on a retry (e.g. 404).
+    '''
+    response = getattr(error, 'response', None)
+    status = response.status_code if response is not None else None
+    if attempt == retries or (status is not None and status not in RETRY_STATUS):
+        raise error
+    wait = backoff*2**attempt
+    print('Request to {} failed ({}), retrying in {:.1f}s'.format(url, error, wait))
+    time.sleep(wait)
+
+
+
+def get_json(url, params=None, retries=DOWNLOAD_RETRIES, backoff=DOWNLOAD_BACKOFF, timeout=DOWNLOAD_TIMEOUT):
+    ''' GET a JSON document with the retry policy of download_file
+
+        ArcGIS services answer errors with status 200 and an error object,
+        these raise a RuntimeError.
+    '''
+    for attempt in range(retries + 1):
+        try:
+            response = requests.get(url, params=params, timeout=timeout)
+            if response.status_code in RETRY_STATUS:
+                raise requests.HTTPError('{} for url {}'.format(response.status_code, response.url), response=response)
+            response.raise_for_status()
+            json_object = response.json()
+        except RETRY_ERRORS as error:
+            wait_before_retry(url, error, attempt, retries, backoff)
+            continue
+
+        if 'error' in json_object:
+            raise RuntimeError('Query {} failed: {}'.format(response.url, json_object['error']))
+        return json_object
+
+
+
+def get_feature_count(url, where='1=1'):
+    ''' Number of features of an ArcGIS feature service layer matching where
+    '''
+    return get_json(url, {'where': where, 'returnCountOnly': 'true', 'f': 'json'})['count']
+
+
+
+def get_feature_page(url, offset, count, fields='*', where='1=1', order_by='OBJECTID'):
+    ''' Attributes of count features starting at offset, as column lists
+
+        Services with a lower maxRecordCount than count return a shorter page
+        with exceededTransferLimit set, the rest is requested until count
+        features are read or the layer is exhausted.
+
+        Returns:
+        ----------
+        columns: dict
+            field name to list of values
+        n_rows: int
+    '''
+    columns = {}
+    n_rows = 0
+    while n_rows < count:
+        json_object = get_json(url, {'where': where,
+                                     'outFields': fields,
+                                     'orderByFields': order_by,
+                                     'resultOffset': offset + n_rows,
+                                     'resultRecordCount': count - n_rows,
+                                     'returnGeometry': 'false',
+                                     'f': 'json'})
+        features = json_object.get('features', [])
+        if not features:
+            break
+
+        for name in features[0]['attributes']:
+            columns.setdefault(name, [None]*n_rows)
+        for each_feature in features:
+            attributes = each_feature['attributes']
+            for name, values in columns.items():
+                values.append(attributes.get(name))
+        n_rows += len(features)
+
+    return columns, n_rows
+
+
+
+def get_feature_table(url, fields='*', where='1=1', page_size=RKI_PAGE_SIZE, max_workers=4):
+    ''' Read an ArcGIS feature service layer page by page into a data frame
+
+        The pages (resultOffset/resultRecordCount) are requested in parallel
+        and appended in order to one value buffer per column, so only the
+        pages in flight are held as parsed JSON.
+
+        Parameters:
+        ----------
+        url: str
+            query endpoint of the layer
+        fields: str or list
+            fields to read, '*' for all
+        where: str
+            SQL filter of the features
+        page_size: int
+            features per request
+        max_workers: int
+            number of pages requested at the same time
+
+        Returns:
+        ----------
+        df: pd.DataFrame
+    '''
+    fields = fields if isinstance(fields, str) else ','.join(fields)
+    n_features = get_feature_count(url, where)
+    offsets = range(0, n_features, page_size)
+
+    buffers = {}
+    n_rows = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pages = executor.map(lambda offset: get_feature_page(url, offset, min(page_size, n_features - offset), fields, where),
+                             offsets)
+        for columns, page_rows in pages:
+            for name in columns:
+                buffers.setdefault(name, [None]*n_rows)
+            for name, values in buffers.items():
+                values.extend(columns.get(name, [None]*page_rows))
+            n_rows += page_rows
+
+    return pd.DataFrame(buffers)
+
+
+
+def get_all_data(max_workers=3, germany=False):
+    ''' Fetch all raw data sources at the same time
+
+        Parameters:
+        ----------
+        max_workers: int
+            number of downloads running in parallel
+        germany: bool
+            also fetch the current RKI data
+
+        Returns:
+        ----------
+        errors: dict
+            name of every failed fetch to its exception
+    '''
+    jobs = {'get_johns_hopkins': get_johns_hopkins,
+            'get_world_population_data': get_world_population_data}
+    if germany:
+        jobs['get_current_data_germany'] = get_current_data_germany
+
+    errors = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {name: executor.submit(job) for name, job in jobs.items()}
+        for name, future in futures.items():
+            try:
+                future.result()
+            except Exception as error:
+                print('Fetching', name, 'failed:', repr(error))
+                errors[name] = error
+    return errors
+
 
     
-def get_johns_hopkins():
+def get_tree_ids(repo, paths):
+    ''' Git object ids of paths in the checked out commit, None for missing ones
+    '''
+    tree_ids = {}
+    for path in paths:
+        try:
+            tree_ids[path] = repo.git.rev_parse('HEAD:' + path)
+        except git.exc.GitCommandError:
+            tree_ids[path] = None
+    return tree_ids
+
+
+
+def sync_sparse_repo(git_url, repo_dir, branch, paths, depth=1):
+    ''' Shallow fetch of branch, with the working tree restricted to paths
+
+        A missing repository is initialised, an existing full checkout is
+        reduced to the paths. Only the last depth commits are fetched and,
+        where the server supports partial clones, only the blobs below paths.
+
+        Parameters:
+        ----------
+        git_url: str
+            remote, e.g. the GitHub URL or file:// URL of a local bare repository
+        repo_dir: str
+        branch: str
+        paths: list
+            directories to check out
+        depth: int
+            number of commits fetched
+
+        Returns:
+        ----------
+        changed: bool
+            True if any of the paths differs from the previous checkout
+    '''
+    if os.path.isdir(os.path.join(repo_dir, '.git')):
+        repo = git.Repo(repo_dir)
+    else:
+        repo = git.Repo.init(repo_dir)
+        repo.create_remote('origin', git_url)
+
+    before = get_tree_ids(repo, paths)
+
+    repo.git.sparse_checkout('init', '--cone')
+    repo.git.sparse_checkout('set', *paths)
+    repo.git.fetch('origin', branch, depth=depth, filter='blob:none')
+    repo.git.checkout('-B', branch, '--force', 'FETCH_HEAD')
+
+    return get_tree_ids(repo, paths) != before
+
+
+
+@profile_stage
+def get_johns_hopkins(sparse=True, repo_dir=JH_REPO_DIR, branch=JH_BRANCH):
     ''' Get data by a git pull request, the source code has to be pulled first
         Result is stored in the predifined csv structure
+
+        Parameters:
+        ----------
+        sparse: bool
+            shallow fetch of only the time series folder read by the pipeline,
+            otherwise pull (or clone) the whole repository
+        repo_dir: str
+        branch: str
+
+        Returns:
+        ----------
+        changed: bool
+            the time series files differ from the previous checkout
     '''
     # git_pull = subprocess.Popen( "/usr/bin/git pull" ,
     #                      cwd = os.path.dirname( 'data/raw/COVID-19/' ),
@@ -24,51 +387,69 @@ def get_johns_hopkins():
     # print("Error : " + str(error))
     # print("out : " + str(out))
     
-    git_url = "https://github.com/CSSEGISandData/COVID-19.git"
-    repo_dir = "../data/raw/COVID-19"
-    branch = "master"
+    git_url = JH_GIT_URL
 
     try:
-        g = git.cmd.Git(repo_dir)
-        msg = g.pull()
-        print(msg)
-    except:
-        git.Repo.clone_from(git_url, repo_dir, branch=branch, single_branch=True, depth=1)
+        if sparse:
+            changed = sync_sparse_repo(git_url, repo_dir, branch, JH_SPARSE_PATHS)
+        elif not os.path.isdir(os.path.join(repo_dir, '.git')):
+            git.Repo.clone_from(git_url, repo_dir, branch=branch, single_branch=True, depth=1)
+            changed = True
+        else:
+            repo = git.Repo(repo_dir)
+            before = get_tree_ids(repo, JH_SPARSE_PATHS)
+            print(repo.git.pull())
+            changed = get_tree_ids(repo, JH_SPARSE_PATHS) != before
+    except git.exc.GitCommandError as error:
+        print('git sync of the Johns Hopkins data failed: ' + str(error.stderr).strip())
+        raise
+
+    print('Johns Hopkins time series ' + ('updated.' if changed else 'unchanged.'))
+    return changed
 
 
 
-def get_current_data_germany():
+@profile_stage
+def get_current_data_germany(fields='*', page_size=RKI_PAGE_SIZE, max_workers=4):
     ''' Get current data from germany, attention API endpoint not too stable
-        Result data frame is stored as pd.DataFrame
+        Result data frame is stored as dataset GER_state_data in the NPGEO folder
+
+        Parameters:
+        ----------
+        fields: str or list
+            RKI fields to keep, e.g. ['GEN', 'BL', 'EWZ', 'cases', 'deaths'], '*' for all
+        page_size: int
+            features per request
+        max_workers: int
+            number of pages requested at the same time
     '''
     # 400 regions / Landkreise
-    data = requests.get('https://services7.arcgis.com/mOBPykOjAyBO2ZKk/arcgis/rest/services/RKI_Landkreisdaten/FeatureServer/0/query?where=1%3D1&outFields=*&outSR=4326&f=json')
-
-    json_object = json.loads(data.content)
-    full_list = []
-    for pos,each_dict in enumerate (json_object['features'][:]):
-        full_list.append(each_dict['attributes'])
+    pd_full_list = get_feature_table(RKI_URL, fields, page_size=page_size, max_workers=max_workers)
 
-    pd_full_list = pd.DataFrame(full_list)
-    pd_full_list.to_csv('../data/raw/NPGEO/GER_state_data.csv',sep=';')
+    os.makedirs(NPGEO_DIR, exist_ok=True)
+    save_dataset(pd_full_list, 'GER_state_data', directory=NPGEO_DIR)
+    record_rows(output_rows=pd_full_list.shape[0])
     print(' Number of regions rows: ' + str(pd_full_list.shape[0]))
     
     
     
+@profile_stage
 def get_world_population_data():
-    url = 'https://api.worldbank.org/v2/en/indicator/SP.POP.TOTL?downloadformat=csv'
+    ''' Download the World Bank population ZIP, unless it is unchanged on the server
 
-    # Downloading the file by sending the request to the URL
-    req = requests.get(url)
-     
-    # Split URL to get the file name
+        Returns:
+        ----------
+        downloaded: bool
+    '''
     filename = "../data/raw/global_population_data.zip"
-     
-    # Writing the file to the local file system
-    with open(filename,'wb') as output_file:
-        output_file.write(req.content)
-        
-    print("World propulation raw ZIP data downloaded.")
+
+    downloaded = download_file(WORLD_BANK_URL, filename)
+
+    if downloaded:
+        print("World propulation raw ZIP data downloaded.")
+    else:
+        print("World propulation raw ZIP data unchanged.")
+    return downloaded
 
 
     
\ No newline at end of file
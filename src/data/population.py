@@ -0,0 +1,182 @@
+import os
+import threading
+import numpy as np
+import pandas as pd
+
+from src.data.storage import find_dataset, load_dataset
+from src.data.process_JH_data import POPULATION_CSV, melt_world_population
+
+
+
+# World Bank country names differing from the Johns Hopkins names
+WB_TO_JH_NAMES = {
+    'United States': 'US',
+    'Russian Federation': 'Russia',
+    'Iran, Islamic Rep.': 'Iran',
+    'Korea, Rep.': 'Korea, South',
+    "Korea, Dem. People's Rep.": 'Korea, North',
+    'Egypt, Arab Rep.': 'Egypt',
+    'Venezuela, RB': 'Venezuela',
+    'Syrian Arab Republic': 'Syria',
+    'Yemen, Rep.': 'Yemen',
+    'Lao PDR': 'Laos',
+    'Brunei Darussalam': 'Brunei',
+    'Kyrgyz Republic': 'Kyrgyzstan',
+    'Slovak Republic': 'Slovakia',
+    'Czech Republic': 'Czechia',
+    'Turkiye': 'Turkey',
+    'Myanmar': 'Burma',
+    'Congo, Dem. Rep.': 'Congo (Kinshasa)',
+    'Congo, Rep.': 'Congo (Brazzaville)',
+    'Gambia, The': 'Gambia',
+    'Bahamas, The': 'Bahamas',
+    'Micronesia, Fed. Sts.': 'Micronesia',
+    'St. Kitts and Nevis': 'Saint Kitts and Nevis',
+    'St. Lucia': 'Saint Lucia',
+    'St. Vincent and the Grenadines': 'Saint Vincent and the Grenadines',
+}
+
+# World Bank country codes with a fixed Johns Hopkins name
+WB_CODE_TO_JH_NAMES = {'USA': 'US'}
+
+
+
+def normalize_country_name(name, code=None):
+    ''' Johns Hopkins name of a World Bank country name
+    '''
+    if code in WB_CODE_TO_JH_NAMES:
+        return WB_CODE_TO_JH_NAMES[code]
+    return WB_TO_JH_NAMES.get(name, name)
+
+
+
+class PopulationLookup:
+    ''' Population per country and year with constant time access
+
+        Countries are keyed on their Johns Hopkins names. A year without a
+        value falls back to the latest earlier year with a value, or to the
+        earliest later year if there is none.
+
+        Parameters:
+        ----------
+        population: pd.Series
+            population indexed by (country, year), as returned by load_world_population
+        codes: dict
+            optional World Bank country code of every country name
+    '''
+
+    def __init__(self, population, codes=None):
+        codes = codes or {}
+        self._years = {}
+        self._values = {}
+
+        countries = np.asarray(population.index.get_level_values(0), dtype=object)
+        years = population.index.get_level_values(1).values.astype(np.int64)
+        values = population.values
+        order = np.lexsort((years, pd.factorize(countries)[0]))
+        countries, years, values = countries[order], years[order], values[order]
+
+        starts = np.flatnonzero(np.r_[True, countries[1:] != countries[:-1]])
+        ends = np.r_[starts[1:], len(countries)]
+        for start, end in zip(starts, ends):
+            name = normalize_country_name(countries[start], codes.get(countries[start]))
+            # a country listed under its World Bank and its Johns Hopkins name keeps the first
+            if name not in self._years:
+                self._years[name] = years[start:end]
+                self._values[name] = values[start:end]
+
+
+    @classmethod
+    def from_frame(cls, df_long):
+        ''' Lookup of a long format table with columns country, country_code, year and population
+        '''
+        codes = dict(zip(df_long['country'].astype(str), df_long['country_code'].astype(str)))
+        return cls(df_long.set_index(['country', 'year'])['population'], codes)
+
+
+    @classmethod
+    def from_dataset(cls):
+        ''' Lookup of the stored world_population dataset
+        '''
+        return cls.from_frame(load_dataset('world_population'))
+
+
+    @classmethod
+    def from_wide_csv(cls, filename=POPULATION_CSV):
+        ''' Lookup of the wide World Bank table, as stored in world_population_data.csv
+        '''
+        return cls.from_frame(melt_world_population(pd.read_csv(filename, sep=',')))
+
+
+    @property
+    def countries(self):
+        return list(self._years)
+
+
+    def __contains__(self, country):
+        return country in self._years
+
+
+    def get(self, country, year, default=None):
+        ''' Population of a country in a year, with year fallback
+
+            Parameters:
+            ----------
+            country: str
+                Johns Hopkins or World Bank country name
+            year: int or str
+            default:
+                returned for unknown countries
+
+            Returns:
+            ----------
+            population: int
+        '''
+        years = self._years.get(country)
+        if years is None:
+            country = normalize_country_name(country)
+            years = self._years.get(country)
+            if years is None:
+                return default
+
+        pos = np.searchsorted(years, int(year), side='right') - 1
+        return self._values[country][max(pos, 0)]
+
+
+    def get_many(self, countries, year):
+        ''' Population of several countries in a year, NaN for unknown countries
+
+            Returns:
+            ----------
+            population: pd.Series
+                indexed by country
+        '''
+        return pd.Series([self.get(each, year, np.nan) for each in countries], index=list(countries), dtype='float64')
+
+
+
+_lookup_cache = {}
+_lookup_lock = threading.Lock()
+
+
+
+def get_population_lookup():
+    ''' Shared PopulationLookup, rebuilt when the stored data changes
+
+        Read from the world_population dataset, or from the wide
+        world_population_data.csv where the long dataset was not built yet.
+    '''
+    path, _ = find_dataset('world_population')
+    build = PopulationLookup.from_dataset
+    if path is None:
+        if not os.path.isfile(POPULATION_CSV):
+            raise FileNotFoundError('Neither dataset world_population nor {} found, '
+                                    'run process_world_population_data first'.format(POPULATION_CSV))
+        path, build = POPULATION_CSV, PopulationLookup.from_wide_csv
+    key = (path, os.stat(path).st_mtime_ns)
+
+    with _lookup_lock:
+        if key not in _lookup_cache:
+            _lookup_cache.clear()
+            _lookup_cache[key] = build()
+        return _lookup_cache[key]
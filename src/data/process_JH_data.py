@@ -1,25 +1,60 @@
 import pandas as pd
 import numpy as np
 from datetime import datetime
-import shutil
-import glob
 import os
+import zipfile
+import json
+import hashlib
 
+from src.profiling import profile_stage, record_rows
+from src.data.storage import save_dataset, append_dataset, dataset_path, load_dataset
 
 
-def store_relational_JH_data_type(case_type):
-    ''' Transformes the COVID data into a relational data set
+
+JH_DATA_PATH = '../data/raw/COVID-19/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_{}_global.csv'
+JH_KEY_COLUMNS = ['Province/State', 'Country/Region', 'Lat', 'Long']
+CASE_TYPES = ['confirmed', 'deaths', 'recovered']
+RELATIONAL_MANIFEST = '../data/processed/COVID_relational_manifest.json'
+
+POPULATION_ZIP = '../data/raw/global_population_data.zip'
+POPULATION_CSV = '../data/processed/world_population_data.csv'
+
+
+
+def load_relational_manifest():
+    ''' Load the manifest of already processed date columns per case type
     '''
+    if not os.path.isfile(RELATIONAL_MANIFEST):
+        return {}
+    with open(RELATIONAL_MANIFEST, 'r') as manifest_file:
+        return json.load(manifest_file)
 
-    data_path = '../data/raw/COVID-19/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_{}_global.csv'.format(case_type)
-    pd_raw = pd.read_csv(data_path)
 
+
+def save_relational_manifest(manifest):
+    with open(RELATIONAL_MANIFEST, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+
+
+def get_region_hash(pd_raw):
+    ''' Hash of the region rows of a wide JH table, a changed hash means the
+        already stored relational data can not be extended
+    '''
+    regions = pd_raw['Province/State'].fillna('no') + '|' + pd_raw['Country/Region']
+    return hashlib.sha1('\n'.join(regions).encode('utf-8')).hexdigest()
+
+
+
+def melt_JH_data(pd_raw, case_type):
+    ''' Melt a wide JH time series table into the relational (date, state, country) format
+    '''
     pd_data_base = pd_raw.rename(columns = {'Country/Region':'country',
                                             'Province/State':'state'})
 
     pd_data_base['state'] = pd_data_base['state'].fillna('no')
 
-    pd_data_base = pd_data_base.drop(['Lat','Long'],axis=1)
+    pd_data_base = pd_data_base.drop(['Lat','Long'],axis=1,errors='ignore')
 
 
     pd_relational_model = pd_data_base.set_index(['state','country']) \
@@ -31,51 +66,200 @@ def store_relational_JH_data_type(case_type):
                                        )
 
     pd_relational_model['date'] = pd_relational_model.date.astype('datetime64[ns]')
+    return pd_relational_model
+
+
+
+@profile_stage
+def melt_JH_data_all(case_types=CASE_TYPES):
+    ''' Relational data set of all case types, built in one pass
+
+        The wide tables are aligned on the regions and dates of the first case
+        type, so every case type becomes one column of the same (date, state,
+        country) rows without any join of the relational data. Regions or dates
+        missing in a later case type are left empty, as a left merge would.
+
+        Parameters:
+        ----------
+        case_types: list
+            the first one defines the regions and dates
+
+        Returns:
+        ----------
+        pd_relational_model: pd.DataFrame
+            columns date, state, country and one column per case type, sorted by date
+    '''
+    pd_wide = {}
+    for case_type in case_types:
+        pd_raw = pd.read_csv(JH_DATA_PATH.format(case_type))
+        pd_raw['Province/State'] = pd_raw['Province/State'].fillna('no')
+        pd_raw = pd_raw.drop(['Lat','Long'],axis=1).set_index(['Province/State','Country/Region'])
+        pd_wide[case_type] = pd_raw[~pd_raw.index.duplicated()]
+        record_rows(input_rows=pd_raw.shape[0])
+
+    regions = pd_wide[case_types[0]].index
+    date_columns = pd_wide[case_types[0]].columns
+    n_regions, n_dates = len(regions), len(date_columns)
+
+    pd_relational_model = pd.DataFrame({
+        'date': np.repeat(pd.to_datetime(date_columns, format='%m/%d/%y').values, n_regions),
+        'state': np.tile(regions.get_level_values(0).values, n_dates),
+        'country': np.tile(regions.get_level_values(1).values, n_dates),
+    })
+    for case_type in case_types:
+        values = pd_wide[case_type].reindex(index=regions, columns=date_columns).values
+        pd_relational_model[case_type] = values.T.reshape(-1)
+
+    return pd_relational_model
+
+
+
+@profile_stage
+def store_relational_JH_data_type(case_type, incremental=False):
+    ''' Transformes the COVID data into a relational data set
+
+        Parameters:
+        ----------
+        case_type: str
+            confirmed, deaths or recovered
+        incremental: bool
+            only melt the date columns added since the last run and append them
+            to the stored relational data, a full rebuild is done if the regions
+            changed or nothing was stored yet
+    '''
+
+    data_path = JH_DATA_PATH.format(case_type)
+    result_name = 'COVID_relational_{}'.format(case_type)
+
+    date_columns = [each for each in pd.read_csv(data_path, nrows=0).columns if each not in JH_KEY_COLUMNS]
+    manifest = load_relational_manifest()
+    state = manifest.get(case_type)
+
+    if incremental and state is not None and os.path.isfile(dataset_path(result_name)) \
+            and date_columns[:len(state['date_columns'])] == state['date_columns']:
+        new_columns = date_columns[len(state['date_columns']):]
+        pd_raw = pd.read_csv(data_path, usecols=JH_KEY_COLUMNS[:2] + new_columns)
 
-    pd_relational_model.to_csv('../data/processed/COVID_relational_{}.csv'.format(case_type),sep=';',index=False)
+        if get_region_hash(pd_raw) == state['region_hash']:
+            if not new_columns:
+                print('{} cases already up to date.'.format(case_type))
+                return
+
+            pd_relational_model = melt_JH_data(pd_raw[JH_KEY_COLUMNS[:2] + new_columns], case_type)
+            append_dataset(pd_relational_model, result_name)
+            record_rows(input_rows=pd_raw.shape[0], output_rows=pd_relational_model.shape[0])
+
+            state['date_columns'] = date_columns
+            save_relational_manifest(manifest)
+            print('{} cases processed incrementally. Number of rows appended: '.format(case_type) + str(pd_relational_model.shape[0]))
+            return
+
+    pd_raw = pd.read_csv(data_path)
+    pd_relational_model = melt_JH_data(pd_raw, case_type)
+
+    save_dataset(pd_relational_model, result_name)
+    record_rows(input_rows=pd_raw.shape[0], output_rows=pd_relational_model.shape[0])
+
+    manifest[case_type] = {'date_columns': date_columns,
+                           'region_hash': get_region_hash(pd_raw)}
+    save_relational_manifest(manifest)
     print('{} cases processed. Number of rows stored: '.format(case_type) + str(pd_relational_model.shape[0]))
     
 
 
-def store_relational_JH_data():
+@profile_stage
+def store_relational_JH_data(incremental=False):
     ''' Transformes the COVID data into a relational data set, for confirmed, deaths and recovered
+
+        Not a pipeline stage any more, build_features melts all case types
+        at once with melt_JH_data_all. The relational data sets are kept for
+        use outside the dashboard.
     '''
-    store_relational_JH_data_type("confirmed")
-    store_relational_JH_data_type("deaths")
-    store_relational_JH_data_type("recovered")
+    store_relational_JH_data_type("confirmed", incremental)
+    store_relational_JH_data_type("deaths", incremental)
+    store_relational_JH_data_type("recovered", incremental)
     
     
     
+def read_world_population_zip(filename=POPULATION_ZIP):
+    ''' Read the World Bank population table straight from the ZIP archive
+
+        The data file is the largest member of the archive, it is parsed as a
+        stream and its four preamble lines are skipped while parsing.
+
+        Returns:
+        ----------
+        df_population_data: pd.DataFrame
+            wide table, one column per year
+    '''
+    with zipfile.ZipFile(filename) as archive:
+        member = max(archive.infolist(), key=lambda info: info.file_size)
+        with archive.open(member) as stream:
+            return pd.read_csv(stream, sep=',', skiprows=4, encoding='utf-8-sig')
+
+
+
+def melt_world_population(df_population_data):
+    ''' Long format (country, year, population) of the wide World Bank table
+
+        Years without a value are dropped, the rows are sorted by country and
+        year so the table can be searched by its index.
+    '''
+    year_columns = [each for each in df_population_data.columns if str(each).isdigit()]
+    values = df_population_data[year_columns].values
+
+    df_long = pd.DataFrame({'country': np.repeat(df_population_data['Country Name'].values, len(year_columns)),
+                            'country_code': np.repeat(df_population_data['Country Code'].values, len(year_columns)),
+                            'year': np.tile(np.array(year_columns, dtype=np.int16), len(df_population_data)),
+                            'population': values.reshape(-1)})
+    df_long = df_long[df_long['population'].notnull()]
+    df_long['population'] = df_long['population'].astype(np.int64)
+    df_long['country'] = df_long['country'].astype('category')
+    df_long['country_code'] = df_long['country_code'].astype('category')
+
+    return df_long.sort_values(['country', 'year'], kind='stable').reset_index(drop=True)
+
+
+
+def load_world_population():
+    ''' Population lookup indexed by (country, year)
+
+        Returns:
+        ----------
+        population: pd.Series
+            sorted MultiIndex, e.g. population.loc[('US', 2020)]
+    '''
+    df_long = load_dataset('world_population')
+    return df_long.set_index(['country', 'year'])['population'].sort_index()
+
+
+
+@profile_stage
 def process_world_population_data():
-    filename = "../data/raw/global_population_data.zip"
-    dir_name = '../data/raw/global_population_data/'
-    
-    shutil.unpack_archive(filename, dir_name)
-    
-    list_of_files = filter( os.path.isfile,
-                            glob.glob(  dir_name + '*') )
-    max_file = max( list_of_files,
-                    key =  lambda x: os.stat(x).st_size)
-    max_filename = os.path.split(max_file)[-1]
-    
-    file = "../data/raw/global_population_data/{}".format(max_filename)
-    
-    with open(file, 'r') as file_r_obj:
-        lines = file_r_obj.readlines()
-        
-    write_file = "../data/processed/world_population_data.csv"
-        
-    with open(write_file, 'w') as file_w_obj:
-        for i in range(4, len(lines)):
-            file_w_obj.write(lines[i])
-    
-    df_population_data = pd.read_csv('../data/processed/world_population_data.csv', sep=',')
-    df_population_data.loc[df_population_data['Country Code']=='USA', 'Country Name'] = 'US'
-    df_population_data.to_csv('../data/processed/world_population_data.csv', sep=',', index=False)
+    ''' Prepare the World Bank population data
+
+        Stores the wide table as world_population_data.csv, as before, and
+        the long format table as dataset world_population. The World Bank
+        name of the USA is replaced by the Johns Hopkins name US. Without a
+        downloaded ZIP the long table is built from the stored wide table.
+    '''
+    if os.path.isfile(POPULATION_ZIP) or not os.path.isfile(POPULATION_CSV):
+        df_population_data = read_world_population_zip(POPULATION_ZIP)
+        df_population_data.loc[df_population_data['Country Code']=='USA', 'Country Name'] = 'US'
+        df_population_data.to_csv(POPULATION_CSV, sep=',', index=False)
+    else:
+        print("World population ZIP not found, using", POPULATION_CSV)
+        df_population_data = pd.read_csv(POPULATION_CSV, sep=',')
+
+    df_long = melt_world_population(df_population_data)
+    save_dataset(df_long, 'world_population')
+    record_rows(input_rows=df_population_data.shape[0], output_rows=df_long.shape[0])
 
     print("World propulation data CSV prepared. Number of records stored:", df_population_data.shape[0])
 
 
+
+@profile_stage
 def store_confirmed_data_for_sir():
     data_path = '../data/raw/COVID-19/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_confirmed_global.csv'
     pd_raw = pd.read_csv(data_path)
@@ -90,7 +274,8 @@ def store_confirmed_data_for_sir():
                                     )
     pd_flat_table['date'] = pd_flat_table.date.astype('datetime64[ns]')
     pd_flat_table = pd.pivot_table(pd_flat_table, values='confirmed', index='date', columns='country', aggfunc=np.sum, fill_value=0).reset_index()
-    pd_flat_table.to_csv('../data/processed/COVID_full_flat_table.csv',sep=';',index = False)
+    save_dataset(pd_flat_table, 'COVID_full_flat_table')
+    record_rows(input_rows=pd_raw.shape[0], output_rows=pd_flat_table.shape[0])
     #print(pd_flat_table.tail())
     print('Data processed for SIR modelling. Number of rows stored in Full Flat Table: '+str(pd_flat_table.shape[0]))
     
@@ -0,0 +1,85 @@
+import pandas as pd
+import numpy as np
+
+
+
+REGION_KEYS = ['country', 'state']
+
+COUNT_COLUMNS = ['confirmed', 'deaths', 'recovered', 'active',
+                 'daily_confirmed', 'daily_deaths', 'daily_recovered']
+
+# no narrower types, sums and differences of the counts would wrap around (int8: 100 + 100 = -56)
+INTEGER_TYPES = [np.int32, np.int64]
+
+
+
+def smallest_integer_type(values):
+    ''' Smallest signed integer type of INTEGER_TYPES holding all values, nullable if values are missing
+
+        Parameters:
+        ----------
+        values: pd.Series
+            integral values, possibly with NaN
+
+        Returns:
+        ----------
+        dtype: numpy dtype or pandas extension dtype, None if values are not integral
+    '''
+    numbers = pd.to_numeric(values, errors='coerce').astype('float64')
+    present = numbers.dropna()
+    if (present != np.floor(present)).any() or values.isnull().sum() != numbers.isnull().sum():
+        return None
+
+    low, high = (present.min(), present.max()) if len(present) else (0, 0)
+    for each in INTEGER_TYPES:
+        if np.iinfo(each).min <= low and high <= np.iinfo(each).max:
+            return pd.api.types.pandas_dtype(each.__name__.capitalize()) if numbers.hasnans else np.dtype(each)
+    return None
+
+
+
+def compact_frame(df, categories=REGION_KEYS, counts=COUNT_COLUMNS, dates=('date',)):
+    ''' Memory compact dtypes for the relational COVID data sets
+
+        Region keys become categoricals, case counts int32, or int64 if needed
+        (nullable where imputation or joins left gaps) and date columns native
+        datetimes. Columns not present in df are ignored, the frame is changed
+        in place and returned.
+
+        Parameters:
+        ----------
+        df: pd.DataFrame
+        categories: list
+            columns stored as pandas categoricals
+        counts: list
+            integral count columns to downcast, never below int32
+        dates: list
+            columns parsed to datetime64
+
+        Returns:
+        ----------
+        df: pd.DataFrame
+    '''
+    for column in categories:
+        if column in df.columns and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype('category')
+
+    for column in counts:
+        if column in df.columns:
+            dtype = smallest_integer_type(df[column])
+            if dtype is not None and df[column].dtype != dtype:
+                df[column] = df[column].astype('float64').astype(dtype) if pd.api.types.is_extension_array_dtype(dtype) \
+                             else df[column].astype(dtype)
+
+    for column in dates:
+        if column in df.columns and not pd.api.types.is_datetime64_any_dtype(df[column]):
+            df[column] = pd.to_datetime(df[column])
+
+    return df
+
+
+
+def to_float_array(values):
+    ''' Plain float64 numpy array of a column or frame, missing values as NaN
+    '''
+    return values.to_numpy(dtype='float64', na_value=np.nan)
@@ -0,0 +1,214 @@
+import os
+import glob
+import warnings
+import pandas as pd
+
+
+
+PROCESSED_DIR = '../data/processed/'
+
+# 'parquet' stores typed, compressed columnar files, 'csv' the original semicolon separated files
+STORAGE_FORMAT = os.environ.get('COVID_STORAGE_FORMAT', 'csv')
+
+FILE_EXTENSIONS = {'csv': '.csv', 'parquet': '.parquet'}
+
+# per dataset: columns holding dates, and region keys stored as categoricals
+DATASETS = {
+    'COVID_relational_confirmed': {'dates': ['date'], 'categories': ['state', 'country']},
+    'COVID_relational_deaths': {'dates': ['date'], 'categories': ['state', 'country']},
+    'COVID_relational_recovered': {'dates': ['date'], 'categories': ['state', 'country']},
+    'COVID_final_set': {'dates': ['date'], 'categories': ['state', 'country']},
+    'COVID_final_daily_set': {'dates': ['date'], 'categories': ['country']},
+    'COVID_full_flat_table': {'dates': ['date'], 'categories': []},
+    'global_latest_stats': {'dates': [], 'categories': ['country']},
+    'COVID_SIR_Model_Data': {'dates': [], 'categories': []},
+    'COVID_SIR_window_params': {'dates': ['start_date', 'end_date'], 'categories': ['country']},
+    'COVID_SIR_window_curves': {'dates': ['date'], 'categories': ['country']},
+    'COVID_SIR_fit_report': {'dates': [], 'categories': ['country']},
+    'COVID_SIRD_params': {'dates': ['start_date', 'end_date'], 'categories': ['country']},
+    'COVID_SEIR_params': {'dates': ['start_date', 'end_date'], 'categories': ['country']},
+    'GER_state_data': {'dates': [], 'categories': ['BL']},
+    'world_population': {'dates': [], 'categories': ['country', 'country_code']},
+}
+
+
+
+def get_storage_format(fmt=None):
+    ''' Resolve the storage format, falling back to CSV if no parquet engine is installed
+    '''
+    fmt = fmt or STORAGE_FORMAT
+    if fmt not in FILE_EXTENSIONS:
+        raise ValueError('Unknown storage format: {}'.format(fmt))
+
+    if fmt == 'parquet':
+        try:
+            import pyarrow
+        except ImportError:
+            warnings.warn('pyarrow is not installed, falling back to CSV storage')
+            return 'csv'
+    return fmt
+
+
+
+def dataset_path(name, fmt=None, directory=PROCESSED_DIR):
+    return os.path.join(directory, name + FILE_EXTENSIONS[get_storage_format(fmt)])
+
+
+
+def dataset_mtime(name, fmt, directory=PROCESSED_DIR):
+    ''' Last modification time of a stored dataset including its parquet parts, None if not stored
+    '''
+    path = os.path.join(directory, name + FILE_EXTENSIONS[fmt])
+    if not os.path.isfile(path):
+        return None
+    parts = parquet_parts(name, directory) if fmt == 'parquet' else []
+    return max(os.path.getmtime(each) for each in [path] + parts)
+
+
+
+def find_dataset(name, fmt=None, directory=PROCESSED_DIR):
+    ''' Path of the stored dataset in the configured format
+
+        The other format is only used if the dataset is not stored in the
+        configured one, with a warning, as it may be left from an older run.
+        A copy in the other format newer than the configured file is ignored,
+        also with a warning.
+
+        Returns:
+        ----------
+        path, fmt: tuple
+            (None, None) if the dataset is not stored in any format
+    '''
+    preferred = get_storage_format(fmt)
+    others = [other for other in FILE_EXTENSIONS if other != preferred]
+    modified = dataset_mtime(name, preferred, directory)
+
+    for other in others:
+        other_modified = dataset_mtime(name, other, directory)
+        if other_modified is None:
+            continue
+        if modified is None:
+            warnings.warn('Dataset {} is not stored as {}, loading the {} file'.format(name, preferred, other))
+            return os.path.join(directory, name + FILE_EXTENSIONS[other]), other
+        if other_modified > modified:
+            warnings.warn('Dataset {} has a newer {} file, loading the {} file'.format(name, other, preferred))
+
+    if modified is None:
+        return None, None
+    return os.path.join(directory, name + FILE_EXTENSIONS[preferred]), preferred
+
+
+
+def parquet_parts(name, directory=PROCESSED_DIR):
+    ''' Part files appended to a parquet dataset, in the order they were written
+    '''
+    return sorted(glob.glob(os.path.join(glob.escape(directory), name + '.part*.parquet')))
+
+
+
+def dataset_exists(name, fmt=None, directory=PROCESSED_DIR):
+    return find_dataset(name, fmt, directory)[0] is not None
+
+
+
+def save_dataset(df, name, fmt=None, directory=PROCESSED_DIR):
+    ''' Store a processed data frame
+
+        Parameters:
+        ----------
+        df: pd.DataFrame
+        name: str
+            dataset name, the file name without extension
+        fmt: str
+            'csv' or 'parquet', defaults to STORAGE_FORMAT
+        directory: str
+
+        Returns:
+        ----------
+        path: str
+            the written file
+    '''
+    fmt = get_storage_format(fmt)
+    path = dataset_path(name, fmt, directory)
+
+    if fmt == 'parquet':
+        df = df.copy()
+        for column in DATASETS.get(name, {}).get('categories', []):
+            if column in df.columns:
+                df[column] = df[column].astype('category')
+        df.to_parquet(path, index=False)
+        for part in parquet_parts(name, directory):
+            os.remove(part)
+    else:
+        df.to_csv(path, sep=';', index=False)
+
+    return path
+
+
+
+def append_dataset(df, name, fmt=None, directory=PROCESSED_DIR):
+    ''' Append rows to a stored dataset, without reading the stored rows
+
+        CSV files are extended in place. A parquet file can not be extended,
+        the rows are written to the next part file <name>.partNNNNN.parquet
+        instead, load_dataset reads the parts after the main file and the
+        next save_dataset merges them away. Without a stored dataset the
+        rows are saved as a new one.
+
+        Returns:
+        ----------
+        path: str
+            the written file
+    '''
+    fmt = get_storage_format(fmt)
+    path = dataset_path(name, fmt, directory)
+    if not os.path.isfile(path):
+        return save_dataset(df, name, fmt, directory)
+
+    if fmt == 'parquet':
+        path = os.path.join(directory, '{}.part{:05d}.parquet'.format(name, len(parquet_parts(name, directory)) + 1))
+        df.to_parquet(path, index=False)
+        return path
+
+    df.to_csv(path, sep=';', index=False, mode='a', header=False)
+    return path
+
+
+
+def load_dataset(name, fmt=None, directory=PROCESSED_DIR, columns=None):
+    ''' Load a processed data frame with native datetime columns
+
+        Parameters:
+        ----------
+        name: str
+            dataset name, the file name without extension
+        fmt: str
+            preferred format, the other format is used if only that one is stored
+        directory: str
+        columns: list
+            optional subset of columns to load
+
+        Returns:
+        ----------
+        df: pd.DataFrame
+    '''
+    path, fmt = find_dataset(name, fmt, directory)
+    if path is None:
+        raise FileNotFoundError('Dataset {} not found in {}'.format(name, directory))
+
+    if fmt == 'parquet':
+        parts = parquet_parts(name, directory)
+        if not parts:
+            return pd.read_parquet(path, columns=columns)
+        df = pd.concat([pd.read_parquet(each, columns=columns) for each in [path] + parts], ignore_index=True)
+        # the parts hold their own categories, the concatenated columns are plain objects
+        for column in DATASETS.get(name, {}).get('categories', []):
+            if column in df.columns:
+                df[column] = df[column].astype('category')
+        return df
+
+    dates = DATASETS.get(name, {}).get('dates', [])
+    if columns is not None:
+        dates = [each for each in dates if each in columns]
+    # round_trip parsing reads back exactly the floats written by to_csv
+    return pd.read_csv(path, sep=';', usecols=columns, parse_dates=dates, float_precision='round_trip')
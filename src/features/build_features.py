@@ -4,8 +4,15 @@ import pandas as pd
 from scipy import signal
 from datetime import timedelta
 
+from src.profiling import profile_stage, record_rows
+from src.data.storage import load_dataset, save_dataset
+from src.data.process_JH_data import melt_JH_data_all
+from src.data.schema import compact_frame, to_float_array
+from src.data.population import get_population_lookup
 
 
+
+@profile_stage
 def impute_missing_recovered_data(pd_result_larg, 
                                   impute_start_date = pd.to_datetime("08-05-2021"), 
                                   look_back = 10,
@@ -13,177 +20,231 @@ def impute_missing_recovered_data(pd_result_larg,
                                  ):
     '''
     Impute the full data, for the recovered field
+
+    For all (country, state) groups at once, the recovered cases from
+    impute_start_date onwards are the last reported recovered value plus the
+    cumulative sum of recovery_ratio_in_lookback times the daily confirmed
+    cases look_back days earlier, minus the daily deaths.
     '''
-    for country in list(pd_result_larg.country.unique()):
-        state_list = pd_result_larg[pd_result_larg['country'] == country].state.unique()
-        for state in state_list:
-            pd_sub = pd_result_larg[(pd_result_larg['country'] == country) & 
-                                    (pd_result_larg['state'] == state)]
-            d = pd_sub[pd.to_datetime(pd_sub.date) >= impute_start_date].deaths.reset_index(drop=True) - pd_sub[pd.to_datetime(pd_sub.date) >= impute_start_date - timedelta(days=1)].deaths.reset_index(drop=True)[0:-1]
-            c = pd_sub.confirmed[-d.shape[0]-look_back:-look_back].reset_index(drop=True) - pd_sub.confirmed[-d.shape[0]-look_back-1:-look_back-1].reset_index(drop=True)
-            r = pd_sub[pd.to_datetime(pd_sub.date) == impute_start_date - timedelta(days=1)].recovered.values[0]
-            impute = r + ((recovery_ratio_in_lookback*c) - d).cumsum()
-            pd_result_larg.loc[(pd_result_larg['country'] == country) & 
-                               (pd_result_larg['state'] == state) &
-                               (pd.to_datetime(pd_result_larg['date']) >= impute_start_date), 
-                               'recovered'] = list(impute.fillna(0).astype(int))
+    df = pd.DataFrame({'country': pd_result_larg['country'],
+                       'state': pd_result_larg['state'],
+                       'date': pd.to_datetime(pd_result_larg['date']),
+                       'confirmed': pd_result_larg['confirmed'],
+                       'deaths': pd_result_larg['deaths'],
+                       'recovered': pd_result_larg['recovered']})
+    df = df.sort_values('date', kind='stable')
+    to_impute = df['date'] >= impute_start_date
+
+    groups = df.groupby(['country', 'state'], sort=False, observed=True)
+    daily_deaths = df['deaths'] - groups['deaths'].shift(1)
+    lagged_confirmed = groups['confirmed'].shift(look_back) - groups['confirmed'].shift(look_back + 1)
+
+    if not to_impute.any():
+        return pd_result_larg
+
+    increment = ((recovery_ratio_in_lookback*lagged_confirmed) - daily_deaths)[to_impute]
+    last_recovered = df['recovered'].where(df['date'] == impute_start_date - timedelta(days=1))
+    last_recovered = last_recovered.groupby([df['country'], df['state']], sort=False, observed=True).transform('first')[to_impute]
+
+    # running sum per group on a dense (groups x days) matrix, so the rounding matches a plain cumsum
+    impute_groups = df[to_impute].groupby(['country', 'state'], sort=False, observed=True)
+    group_codes = impute_groups.ngroup().values
+    day_codes = impute_groups.cumcount().values
+    increments = np.zeros((group_codes.max() + 1, day_codes.max() + 1))
+    increments[group_codes, day_codes] = to_float_array(increment.fillna(0))
+    cumulative = pd.Series(np.cumsum(increments, axis=1)[group_codes, day_codes], index=increment.index)
+
+    impute = (last_recovered + cumulative).where(increment.notnull())
+
+    # the imputed values can exceed the compact integer type chosen for the reported ones
+    recovered = pd_result_larg['recovered']
+    if pd.api.types.is_integer_dtype(recovered.dtype):
+        pd_result_larg['recovered'] = recovered.astype('Int64' if pd.api.types.is_extension_array_dtype(recovered.dtype) else 'int64')
+    pd_result_larg.loc[impute.index, 'recovered'] = impute.fillna(0).astype(int)
                                
     return pd_result_larg
 
 
 
-def savgol_filter(df_input, column='confirmed', window=5):
-    ''' Savgol Filter which can be used in groupby apply function (data structure kept)
+def savgol_filter_groups(values, group_codes, day_codes, window=5, degree=1):
+    ''' Savgol Filter of many series at once
+
+        The series are scattered into a dense (days x groups x columns) matrix
+        and every set of equally long series is filtered in one call along the
+        time axis. Series shorter than the window use the largest odd window
+        that fits, series too short for the polynomial degree are kept as is.
 
         parameters:
         ----------
-        df_input : pandas.series
-        column : str
+        values : np.array
+            shape (n_rows, n_columns), missing values are treated as 0
+        group_codes : np.array
+            group number of each row, 0 ... n_groups-1
+        day_codes : np.array
+            position of each row within its group, 0 ... length-1
         window : int
             used data points to calculate the filter result
+        degree : int
+            degree of the fitted polynomial
 
         Returns:
         ----------
-        df_result: pd.DataFrame
-            the index of the df_input has to be preserved in result
+        result: np.array
+            the filtered values in the row order of the input
     '''
+    values = np.nan_to_num(np.asarray(values, dtype=float)) # attention with the neutral element here
+    if values.size == 0:
+        return values
 
-    degree=1
-    df_result=df_input
+    lengths = np.bincount(group_codes)
+    dense = np.zeros((lengths.max(), len(lengths), values.shape[1]))
+    dense[day_codes, group_codes] = values
 
-    filter_in=df_input[column].fillna(0) # attention with the neutral element here
+    for length in np.unique(lengths):
+        groups = np.flatnonzero(lengths == length)
+        group_window = min(window, length if length % 2 else length - 1)
+        if group_window <= degree:
+            continue
+        dense[:length, groups] = signal.savgol_filter(dense[:length, groups],
+                                                      group_window, # window size used for filtering
+                                                      degree,
+                                                      axis=0)
 
-    result=signal.savgol_filter(np.array(filter_in),
-                           window, # window size used for filtering
-                           1)
-    df_result[str(column+'_filtered')]=result
-    return df_result
+    return dense[day_codes, group_codes]
 
 
 
-def calc_filtered_data(df_input, filter_on='confirmed'):
+@profile_stage
+def calc_filtered_data(df_input, filter_on='confirmed', window=5, degree=1):
     '''  Calculate savgol filter and return merged data frame
 
         Parameters:
         ----------
         df_input: pd.DataFrame
-        filter_on: str
-            defines the used column
+        filter_on: str or list
+            defines the used column(s)
+        window: int
+            used data points to calculate the filter result
+        degree: int
+            degree of the fitted polynomial
         Returns:
         ----------
         df_output: pd.DataFrame
-            the result will be joined as a new column on the input data frame
+            the result will be joined as new <column>_filtered columns on the input data frame
     '''
 
-    must_contain=set(['state','country',filter_on])
+    filter_on = [filter_on] if isinstance(filter_on, str) else list(filter_on)
+    must_contain=set(['state','country'] + filter_on)
     assert must_contain.issubset(set(df_input.columns)), 'Error in calc_filtered_data, not all columns in data frame'
 
     df_output=df_input.copy() # we need a copy here otherwise the filter_on column will be overwritten
 
-    pd_filtered_result=df_output[['state','country',filter_on]].groupby(['state','country']).apply(savgol_filter)#.reset_index()
+    groups = df_output.groupby(['state','country'], sort=False, observed=True)
+    filtered = savgol_filter_groups(to_float_array(df_output[filter_on]),
+                                    groups.ngroup().values,
+                                    groups.cumcount().values,
+                                    window,
+                                    degree)
 
-    #print('--+++ after group by apply')
-    #print(pd_filtered_result[pd_filtered_result['country']=='Germany'].tail())
+    for pos, column in enumerate(filter_on):
+        df_output[str(column+'_filtered')] = filtered[:, pos]
 
-    #df_output=pd.merge(df_output,pd_filtered_result[['index',str(filter_on+'_filtered')]],on=['index'],how='left')
-    df_output=pd.merge(df_output,pd_filtered_result[[str(filter_on+'_filtered')]],left_index=True,right_index=True,how='left')
-    #print(df_output[df_output['country']=='Germany'].tail())
     return df_output
 
 
 
-def get_daily_list(total_list):
-    ''' Calculate Daily change in cases from the cummulative gathered list
-
-        Parameters:
-        ----------
-        total_list: list
-            A python list containing the cummulative cases
-        
-        Returns:
-        ----------
-        df_output: list
-            the result will be a list containing daily change in values
-    '''
-    daily_list=[]
-    daily_list.append(total_list.pop(0))
-    for each in range(len(total_list)):
-        if each == 0:
-            daily_list.append(max(0, total_list[each] - total_list[0]))
-        else:
-            daily_list.append(max(0, total_list[each] - total_list[each-1]))
-    
-    return daily_list
-
-
-
-def calc_daily_values_all_countries(pd_daily):
+@profile_stage
+def calc_daily_values_all_countries(pd_daily, columns=('confirmed', 'deaths', 'recovered')):
     ''' Calculate Daily cummulative cases for all countries
 
+        The countries are brought into contiguous blocks (in order of first
+        appearance, dates kept in input order) and the daily change is taken
+        as one difference over the whole column, restarted at every block.
+        As in the previous per-country implementation the first day keeps the
+        cumulative value, the second day is 0 and negative changes are clipped to 0.
+
         Parameters:
         ----------
-        all_countries: list
-            A python list containing name of all countries
-        
+        pd_daily: pandas dataframe
+            cumulative cases per country and date
+        columns: list
+            cumulative columns to convert into daily_<column> values
+
         Returns:
         ----------
         df_daily_all: pandas dataframe
             the result will be a list containing daily change in values
     '''
-    all_countries = pd_daily['country'].unique()
-    df_daily_all= pd.DataFrame()
-    for each_country in all_countries:
-        daily_list = get_daily_list(list(pd_daily[pd_daily['country'] == each_country]['confirmed']))
-        df_daily = pd.DataFrame(np.array(daily_list))
-        df_daily_death = np.array(get_daily_list(list(pd_daily[pd_daily['country'] == each_country]['deaths'])))
-        df_daily_recov = np.array(get_daily_list(list(pd_daily[pd_daily['country'] == each_country]['recovered'])))
-        
-        df_daily = df_daily.rename(columns = {0:'daily_confirmed'})
-        df_daily['daily_deaths'] = df_daily_death
-        df_daily['daily_recovered'] = df_daily_recov
-        df_daily['date'] = np.array(pd_daily[pd_daily['country'] == each_country]['date'])
-        df_daily['country'] = np.array(pd_daily[pd_daily['country'] == each_country]['country'])
-        df_daily_all = pd.concat([df_daily_all,df_daily])
+    country_codes = pd.factorize(pd_daily['country'])[0]
+    order = np.argsort(country_codes, kind='stable')
+    country_codes = country_codes[order]
+
+    first_day = np.ones(len(order), dtype=bool)
+    first_day[1:] = country_codes[1:] != country_codes[:-1]
+    second_day = np.zeros(len(order), dtype=bool)
+    second_day[1:] = first_day[:-1] & ~first_day[1:]
+
+    df_daily_all = pd.DataFrame()
+    for column in columns:
+        values = pd_daily[column]
+        if pd.api.types.is_extension_array_dtype(values.dtype):
+            # nullable integer columns of the compact schema, diffed as plain numbers
+            values = values.astype('float64') if values.hasnans else values.astype(values.dtype.numpy_dtype)
+        values = values.to_numpy()[order]
+        daily = np.empty_like(values)
+        daily[0:1] = values[0:1]
+        daily[1:] = np.maximum(values[1:] - values[:-1], 0)
+        daily[first_day] = values[first_day]
+        daily[second_day] = 0
+        df_daily_all['daily_{}'.format(column)] = daily
+
+    df_daily_all['date'] = pd_daily['date'].values[order]
+    df_daily_all['country'] = pd_daily['country'].values[order]
 
     return df_daily_all
 
 
 
+@profile_stage
 def build_features(impute_recovered = False):
+    ''' Build COVID_final_set and COVID_final_daily_set from the raw JH tables
+
+        COVID_final_set holds the columns date, state, country, confirmed,
+        deaths, recovered and confirmed_filtered, in this order, sorted by date
+        and within a date in the region order of the raw tables. The counts are
+        integers, counts missing in a case type are empty instead of a float
+        column with NaN.
+    '''
 
     ##### Build the cumulative data
     
-    pd_JH_data = pd.read_csv('../data/processed/COVID_relational_confirmed.csv',sep=';',parse_dates=[0])
-    pd_JH_data = pd_JH_data.sort_values('date',ascending=True)
-    
+    pd_JH_data = compact_frame(melt_JH_data_all())
+    record_rows(input_rows=pd_JH_data.shape[0])
+
     pd_result_larg = calc_filtered_data(pd_JH_data)
     
-    pd_JH_data_deaths = pd.read_csv('../data/processed/COVID_relational_deaths.csv',sep=';',parse_dates=[0])
-    pd_JH_data_deaths = pd_JH_data_deaths.sort_values('date',ascending=True).reset_index(drop=True)
-    pd_result_larg = pd.merge(pd_result_larg, pd_JH_data_deaths, on=['date', 'state', 'country'], how='left')
-    
-    pd_JH_data_recov = pd.read_csv('../data/processed/COVID_relational_recovered.csv',sep=';',parse_dates=[0])
-    pd_JH_data_recov = pd_JH_data_recov.sort_values('date',ascending=True).reset_index(drop=True)
-    pd_result_larg = pd.merge(pd_result_larg, pd_JH_data_recov, on=['date', 'state', 'country'], how='left')
-    
     if impute_recovered:
-        pd_result_larg = impute_missing_recovered_data(pd_result_larg)
+        pd_result_larg = compact_frame(impute_missing_recovered_data(pd_result_larg))
     
-    pd_result_larg.to_csv('../data/processed/COVID_final_set.csv',sep=';',index=False)
+    save_dataset(pd_result_larg, 'COVID_final_set')
+    record_rows(output_rows=pd_result_larg.shape[0])
     
     ##### Build the daily data
     
-    pd_daily = pd_result_larg[['date','state','country','confirmed','deaths','recovered']].groupby(['country','date']).agg(np.sum).reset_index()
+    pd_daily = pd_result_larg[['date','country','confirmed','deaths','recovered']].groupby(['country','date'], observed=True).agg(np.sum).reset_index()
 
     df_daily_all = calc_daily_values_all_countries(pd_daily)
     df_daily_all = df_daily_all.reset_index(drop=True)
     df_daily_all.daily_deaths = df_daily_all.daily_deaths.mask(df_daily_all.daily_deaths.lt(0), 0)
-    df_daily_all.to_csv('../data/processed/COVID_final_daily_set.csv',sep=';',index=False)
+    df_daily_all = compact_frame(df_daily_all)
+    save_dataset(df_daily_all, 'COVID_final_daily_set')
+    record_rows(output_rows=df_daily_all.shape[0])
     
     print("Processed data ready.")
 
 
 
+@profile_stage
 def build_latest_global_statistics():
     
     # getting location information
@@ -196,22 +257,19 @@ def build_latest_global_statistics():
     pd_loc = pd_loc.groupby('country').mean().reset_index()
     
     # getting latest COVID data
-    df_input_large = pd.read_csv('../data/processed/COVID_final_set.csv', sep=';')
-    df_input_large['date'] = pd.to_datetime(df_input_large['date'])
+    df_input_large = compact_frame(load_dataset('COVID_final_set'))
+    record_rows(input_rows=df_input_large.shape[0])
 
     df_input_large = df_input_large[df_input_large['date'] == df_input_large['date'].max()].drop('confirmed_filtered', axis=1)
     year = str(df_input_large['date'].max().year-1)
 
-    df_input_large = df_input_large.groupby(['country']).sum().reset_index()
+    df_input_large = df_input_large.groupby(['country'], observed=True)[['confirmed', 'deaths', 'recovered']].sum().reset_index()
 
     df_global_latest_stats = pd.merge(df_input_large, pd_loc, on=['country'], how='left')
     
     ## Get population data
-    df_population_data = pd.read_csv('../data/processed/world_population_data.csv', sep=',')
-    df_population_data = df_population_data[['Country Name', year]]
-    df_population_data.columns = ['country', 'population']
-
-    df_global_latest_stats = pd.merge(df_global_latest_stats, df_population_data, on='country', how='inner')
+    population = get_population_lookup()
+    df_global_latest_stats['population'] = population.get_many(df_global_latest_stats['country'].astype(str), year).values
     df_global_latest_stats = df_global_latest_stats[df_global_latest_stats.population.notnull()]
     
     df_global_latest_stats['active'] = df_global_latest_stats['confirmed'] - (df_global_latest_stats['deaths'] + df_global_latest_stats['recovered'])
@@ -221,6 +279,8 @@ def build_latest_global_statistics():
     for val in ['confirmed', 'deaths', 'recovered', 'active']:
         df_global_latest_stats['{}_ratio'.format(val)] = df_global_latest_stats[val]/df_global_latest_stats['population']
     
-    df_global_latest_stats.to_csv('../data/processed/global_latest_stats.csv', sep=";", index=False)
+    df_global_latest_stats = compact_frame(df_global_latest_stats)
+    save_dataset(df_global_latest_stats, 'global_latest_stats')
+    record_rows(output_rows=df_global_latest_stats.shape[0])
     
     print("Global Statistics ready. No of records stored:", df_global_latest_stats.shape[0])
\ No newline at end of file
@@ -1,33 +1,54 @@
 import warnings
 warnings.filterwarnings('ignore')
 
+import os
+import time
+import json
+import hashlib
+import functools
 import pandas as pd
 import numpy as np
 from scipy import optimize
 from scipy import integrate
+from concurrent.futures import ProcessPoolExecutor
+
+from src.profiling import profile_stage, record_rows
+from src.data.storage import load_dataset, save_dataset, dataset_exists
+from src.data.population import get_population_lookup
 
 '''
 Default paramter initializations
 '''
-N0 = 0
 I0 = 100        # Initial Infected population
-S0 = 0          # Initial Suspected population
 R0 = 0          # Initial Recovered population
 beta = 0.5      # Initial Rate of infection
 gamma = 0.1     # Initial Rate of recovery
-t = 0
 
-def Handle_SIR_Modelling(ydata):
-    global t
-    t = np.arange(len(ydata))
-    
-    global I0
-    I0 = ydata[0]   #Infected population
-    popt, pcov = optimize.curve_fit(fit_odeint, t, ydata, maxfev=10000)
-    fitted = fit_odeint(t, *popt)
-    return t, ydata, fitted
+SIR_FIT_START = 35      # First day of the fitted slice of each country
+SIR_FIT_END = 150       # Day after the last day of the fitted slice
+
+SIR_WINDOW = 60         # Days per window of the rolling fit
+SIR_WINDOW_STEP = 60    # Days between the starts of two windows
+SIR_MIN_WINDOW = 14     # Shorter trailing windows are merged into the previous one
+SIR_WINDOW_PARAM_COLUMNS = ['country', 'window', 'start_date', 'end_date', 'population', 'I0', 'beta', 'gamma',
+                            'var_beta', 'cov_beta_gamma', 'var_gamma', 'residual', 'n_iter', 'converged',
+                            'fit_time', 'input_hash']   # Columns of COVID_SIR_window_params
+SIR_FITTER_VERSION = 3  # Part of the window hashes, stored fits of an older SIRFitter are refitted
+
+SIR_FIT_BOUNDS = ((0.0, 0.0), (10.0, 10.0))   # (beta, gamma) lower and upper bounds of SIRFitter
+SIR_MIN_CHUNK = 2000   # Fewest countries per worker process, a batch fit costs mostly per iteration, not per country
+
+SIMULATION_CACHE_SIZE = 1024    # Trajectories kept by simulate_SIR
+RK4_STABLE_STEP = 2.5   # Largest rate per day times RK4 step, below the RK4 stability limit of about 2.78
+
+SIR_START_BOUNDS = ((0.01, 0.01), (10.0, 10.0))  # Range of the random (beta, gamma) starting points, fits reach gamma > 1
+SIR_N_STARTS = 8            # Starting points per country of a multi-start fit
+SIR_STARTS_PER_ROUND = 4    # Starting points fitted at once before checking for reproduced fits
+SIR_SAME_FIT = 0.01         # Relative residual difference of two starting points ending in the same optimum
+
 
-def SIR_model_fit(SIR, time, beta, gamma):
+
+def SIR_model_fit(SIR, time, beta, gamma, N0):
     '''
     Simple SIR model implementation.
     S: Suspected population
@@ -35,10 +56,13 @@ def SIR_model_fit(SIR, time, beta, gamma):
     R: Recovered population
     beta: rate of infection
     gamma: rate of recovery
+    N0: total population
     time: for integral as define in odeint function of scipy.integrate
     as per slides: ds+dI+dR = 0 and S+R+I=N (total population)
 
     Make a note tht in this model a recovered person can not get infected again.
+    All arguments can also be numpy arrays of the same shape, in which case
+    one SIR system per array element is evaluated.
     '''
 
     S,I,R = SIR
@@ -48,33 +72,1022 @@ def SIR_model_fit(SIR, time, beta, gamma):
 
     return dS_dt, dI_dt, dR_dt
 
-def fit_odeint(x, beta, gamma):
-    ''' To call integrate funtion of scipy'''
-    return integrate.odeint(SIR_model_fit, (S0, I0, R0), t, args=(beta, gamma))[:,1]  #we are only fetching dI
 
-def exec_SIR_modelling():
+
+def SIR_sensitivity_fit(state, time, beta, gamma, N0):
+    ''' SIR model extended by the forward sensitivities of S and I with respect
+        to beta and gamma. Integrating this system gives the analytic Jacobian
+        of the infected curve, so no finite differences are needed while fitting.
+
+        state: S, I, R, dS/dbeta, dI/dbeta, dS/dgamma, dI/dgamma
+    '''
+
+    S, I, R, S_b, I_b, S_g, I_g = state
+    dS_dt, dI_dt, dR_dt = SIR_model_fit((S, I, R), time, beta, gamma, N0)
+
+    infection = S*I/N0
+    infection_b = (S_b*I + S*I_b)/N0
+    infection_g = (S_g*I + S*I_g)/N0
+
+    dS_b = -infection - beta*infection_b
+    dI_b = infection + beta*infection_b - gamma*I_b
+    dS_g = -beta*infection_g
+    dI_g = beta*infection_g - I - gamma*I_g
+
+    return dS_dt, dI_dt, dR_dt, dS_b, dI_b, dS_g, dI_g
+
+
+
+def integrate_batch(model, y0, t, args=(), substeps=2):
+    ''' Fixed step Runge-Kutta (RK4) integration of a stacked ODE system
+
+        Parameters:
+        ----------
+        model: callable
+            right hand side model(y, time, *args), vectorized over the last axis of y
+        y0: np.array
+            initial state of shape (n_states, n_batch)
+        t: np.array
+            equidistant time points to report
+        args: tuple
+            additional model arguments, scalars or arrays of shape (n_batch,)
+        substeps: int
+            number of RK4 steps between two reported time points
+
+        Returns:
+        ----------
+        result: np.array
+            the state at every time point, shape (len(t), n_states, n_batch)
+    '''
+    y = np.array(y0, dtype=float)
+    result = np.empty((len(t),) + y.shape)
+    result[0] = y
+
+    with np.errstate(over='ignore', invalid='ignore'):
+        for k in range(1, len(t)):
+            h = (t[k] - t[k-1])/substeps
+            time = t[k-1]
+            for _ in range(substeps):
+                k1 = np.asarray(model(y, time, *args))
+                k2 = np.asarray(model(y + 0.5*h*k1, time + 0.5*h, *args))
+                k3 = np.asarray(model(y + 0.5*h*k2, time + 0.5*h, *args))
+                k4 = np.asarray(model(y + h*k3, time + h, *args))
+                y = y + h/6*(k1 + 2*k2 + 2*k3 + k4)
+                time = time + h
+            result[k] = y
+
+    return result
+
+
+
+def stable_substeps(max_rate, min_substeps=2):
+    ''' RK4 steps per day keeping integrate_batch finite for rates up to max_rate per day '''
+    return max(min_substeps, int(np.ceil(np.max(max_rate)/RK4_STABLE_STEP)))
+
+
+
+def levenberg_marquardt(params, evaluate, step, max_iter=100, tol=1e-8):
+    ''' Vectorized Levenberg-Marquardt loop over independent least squares problems
+
+        Shared by SIRFitter and CompartmentFitter, every column of params is
+        the problem of one country. All active countries take one damped step
+        per iteration, a country stops when its cost decrease or its step
+        becomes small or its damping exceeds 1e10.
+
+        Parameters:
+        ----------
+        params: np.array
+            starting point within the bounds, shape (p, n)
+        evaluate: callable
+            evaluate(params, idx) returns the residuals of the countries idx,
+            shape (m, n_residuals), and their Jacobian with the countries on
+            the first axis, for params of shape (p, m)
+        step: callable
+            step(params, residual, jac, lam) returns the trial parameters
+            within the bounds, shape (p, m), lam is the damping per country
+        max_iter: int
+            maximum number of iterations per country
+        tol: float
+            relative tolerance on cost decrease and parameter step
+
+        Returns:
+        ----------
+        params, residual, jac, cost, n_iter, converged: np.array
+            cost is the sum of squared residuals, converged is False where
+            max_iter was reached first or the cost is not finite
+    '''
+    params = np.array(params, dtype=float)
+    n = params.shape[1]
+    residual, jac = evaluate(params, np.arange(n))
+    cost = np.sum(residual*residual, axis=-1)
+
+    lam = np.full(n, 1e-3)
+    active = np.isfinite(cost)
+    converged = np.zeros(n, dtype=bool)
+    n_iter = np.zeros(n, dtype=int)
+
+    for _ in range(max_iter):
+        idx = np.flatnonzero(active)
+        if idx.size == 0:
+            break
+        n_iter[idx] += 1
+
+        trial = step(params[:, idx], residual[idx], jac[idx], lam[idx])
+        moved = np.abs(trial - params[:, idx]).max(axis=0)
+        small_step = moved <= tol*(np.abs(trial).max(axis=0) + tol)
+
+        trial_residual, trial_jac = evaluate(trial, idx)
+        trial_cost = np.sum(trial_residual*trial_residual, axis=-1)
+        improved = np.isfinite(trial_cost) & (trial_cost < cost[idx])
+
+        accepted = idx[improved]
+        params[:, accepted] = trial[:, improved]
+        residual[accepted] = trial_residual[improved]
+        jac[accepted] = trial_jac[improved]
+
+        decrease = cost[accepted] - trial_cost[improved]
+        small_decrease = decrease <= tol*cost[accepted]
+        cost[accepted] = trial_cost[improved]
+
+        lam[accepted] *= 0.3
+        lam[idx[~improved]] *= 10
+
+        done = np.zeros(idx.size, dtype=bool)
+        done[improved] = small_decrease
+        done |= small_step | (lam[idx] > 1e10)
+        converged[idx[done]] = True
+        active[idx[done]] = False
+
+    return params, residual, jac, cost, n_iter, converged
+
+
+
+class SIRFitter:
+    ''' Reentrant SIR fitting engine for a batch of countries
+
+        Population, initial conditions and time axis are held on the instance,
+        and all countries are fitted at once by levenberg_marquardt on top of
+        integrate_batch and the analytic Jacobian from SIR_sensitivity_fit. As in the original curve_fit approach the
+        simulated infected curve is fitted against the confirmed cases.
+
+        The steps are taken on beta - gamma and gamma, as the early growth of
+        the curve mostly depends on their difference. Countries reaching
+        max_iter or ending on a bound are refitted one by one with curve_fit,
+        whose result is kept where it fits better.
+
+        Parameters:
+        ----------
+        N0: array like
+            population per country
+        R0: array like
+            initial recovered population per country
+        beta_init, gamma_init: array like
+            starting point of the optimization
+        bounds: tuple
+            ((beta_min, gamma_min), (beta_max, gamma_max))
+        max_iter: int
+            maximum number of Levenberg-Marquardt iterations per country
+        tol: float
+            relative tolerance on cost decrease and parameter step
+        substeps: int
+            RK4 steps per day, by default the fewest steps that keep the
+            integration stable for all rates within the bounds
+
+        Attributes after fit:
+        ----------
+        beta_, gamma_: np.array
+            fitted parameters per country
+        pcov_: np.array
+            parameter covariance per country, shape (n, 2, 2), as in curve_fit
+        fitted_: np.array
+            fitted infected curves, shape (n_days, n)
+        residual_: np.array
+            sum of squared residuals per country
+        n_iter_: np.array
+            iterations used per country
+        converged_: np.array
+            False where max_iter was reached before convergence or the
+            residual is not finite
+        refit_: np.array
+            True where the batch fit was followed by a curve_fit refit
+        fit_time_: np.array
+            wall time of the batch fit in seconds, shared evenly by its countries
+    '''
+
+    def __init__(self, N0, R0=R0, beta_init=beta, gamma_init=gamma,
+                 bounds=SIR_FIT_BOUNDS, max_iter=100, tol=1e-8, substeps=None):
+        self.N0 = np.atleast_1d(np.asarray(N0, dtype=float))
+        self.R0 = np.broadcast_to(np.asarray(R0, dtype=float), self.N0.shape)
+        self.beta_init = np.broadcast_to(np.asarray(beta_init, dtype=float), self.N0.shape)
+        self.gamma_init = np.broadcast_to(np.asarray(gamma_init, dtype=float), self.N0.shape)
+        self.lower = np.asarray(bounds[0], dtype=float).reshape(2, 1)
+        self.upper = np.asarray(bounds[1], dtype=float).reshape(2, 1)
+        self.max_iter = max_iter
+        self.tol = tol
+        self.substeps = substeps or stable_substeps(self.upper)
+        self.t = None
+        self.I0 = None
+
+
+    def simulate(self, beta, gamma, t=None, idx=None, sensitivities=False):
+        ''' Integrate the SIR systems of the selected countries
+
+            Returns the infected curves of shape (n_days, n) and, with
+            sensitivities=True, also their Jacobian of shape (n_days, 2, n)
+        '''
+        t = self.t if t is None else t
+        idx = slice(None) if idx is None else idx
+        N0, I0, R0 = self.N0[idx], self.I0[idx], self.R0[idx]
+        S0 = N0 - I0 - R0
+
+        if sensitivities:
+            zeros = np.zeros_like(N0)
+            y0 = (S0, I0, R0, zeros, zeros, zeros, zeros)
+            result = integrate_batch(SIR_sensitivity_fit, y0, t, (beta, gamma, N0), self.substeps)
+            return result[:, 1], result[:, [4, 6]]
+
+        result = integrate_batch(SIR_model_fit, (S0, I0, R0), t, (beta, gamma, N0), self.substeps)
+        return result[:, 1]
+
+
+    def fit(self, ydata):
+        ''' Fit beta and gamma of all countries at once
+
+            Parameters:
+            ----------
+            ydata: np.array
+                confirmed cases, shape (n_days,) or (n_days, n)
+
+            Returns:
+            ----------
+            self
+        '''
+        start_time = time.perf_counter()
+        ydata = np.asarray(ydata, dtype=float)
+        if ydata.ndim == 1:
+            ydata = ydata[:, None]
+        n = ydata.shape[1]
+
+        self.t = np.arange(ydata.shape[0], dtype=float)
+        self.I0 = ydata[0].copy()
+
+        params = np.clip(np.vstack([self.beta_init, self.gamma_init]), self.lower, self.upper)
+        params, _, _, cost, n_iter, converged = levenberg_marquardt(
+            params, lambda params, idx: self._residual_jacobian(params, ydata, idx), self._growth_step,
+            self.max_iter, self.tol)
+
+        # countries stopped at the iteration limit, without infection or on an upper bound are
+        # refitted one by one, gamma = 0 is a common optimum of the growing cumulative cases
+        on_bound = (params[0] <= self.lower[0]) | (params >= self.upper).any(axis=0)
+        refit = np.flatnonzero((~converged | on_bound) & np.isfinite(cost))
+        for country in refit:
+            country_params = self._refit(country, ydata[:, country])
+            if country_params is None:
+                continue
+            country_fitted = self.simulate(*country_params[:, None], idx=[country])
+            country_cost = self._cost(country_fitted, ydata[:, [country]])[0]
+            if country_cost < cost[country]:
+                params[:, country] = country_params
+                cost[country] = country_cost
+                converged[country] = True
+
+        fitted, jac = self.simulate(params[0], params[1], sensitivities=True)
+        JTJ, _ = self._normal_equations(np.ascontiguousarray(jac.transpose(2, 1, 0)), None)
+        dof = max(ydata.shape[0] - 2, 1)
+
+        self.beta_, self.gamma_ = params
+        self.pcov_ = self._inverse(JTJ)*(cost/dof)[:, None, None]
+        self.fitted_ = fitted
+        self.residual_ = cost
+        self.n_iter_ = n_iter
+        self.converged_ = converged
+        self.refit_ = np.isin(np.arange(n), refit)
+        self.fit_time_ = np.full(n, (time.perf_counter() - start_time)/n)
+        return self
+
+
+    def _refit(self, country, ydata):
+        ''' Fit a single country with curve_fit on odeint, started like the
+            replaced implementation from beta = gamma = 1, None if it fails '''
+        N0, I0, R0 = self.N0[country], self.I0[country], self.R0[country]
+        model = lambda t, beta, gamma: integrate.odeint(SIR_model_fit, (N0 - I0 - R0, I0, R0), t,
+                                                        args=(beta, gamma, N0))[:, 1]
+        p0 = np.clip(1.0, self.lower[:, 0], self.upper[:, 0])
+        try:
+            popt, _ = optimize.curve_fit(model, self.t, ydata, p0=p0,
+                                         bounds=(self.lower[:, 0], self.upper[:, 0]), max_nfev=10000)
+        except (RuntimeError, ValueError):
+            return None
+        return popt
+
+
+    @classmethod
+    def merge(cls, fitters):
+        ''' Concatenate fitters of consecutive country chunks into one fitter '''
+        merged = cls(np.concatenate([each.N0 for each in fitters]),
+                     R0=np.concatenate([each.R0 for each in fitters]))
+        merged.t = fitters[0].t
+        merged.I0 = np.concatenate([each.I0 for each in fitters])
+        for attribute in ['beta_', 'gamma_', 'pcov_', 'residual_', 'n_iter_', 'converged_', 'refit_', 'fit_time_',
+                          'rel_error_', 'n_starts_', 'zero_start_', 'failed_']:
+            if all(hasattr(each, attribute) for each in fitters):
+                setattr(merged, attribute, np.concatenate([getattr(each, attribute) for each in fitters]))
+        merged.fitted_ = np.hstack([each.fitted_ for each in fitters])
+        return merged
+
+
+    @staticmethod
+    def _cost(fitted, ydata):
+        ''' Sum of squared residuals per country, summed in a fixed order so
+            each country's value does not depend on the rest of the batch '''
+        residual = np.ascontiguousarray((fitted - ydata).T)
+        return np.sum(residual*residual, axis=-1)
+
+
+    def _residual_jacobian(self, params, ydata, idx):
+        ''' Residuals (m, n_days) of the countries idx and their Jacobian
+            (m, 2, n_days) with respect to beta - gamma and gamma '''
+        fitted, jac = self.simulate(params[0], params[1], idx=idx, sensitivities=True)
+        jac = np.stack([jac[:, 0], jac[:, 0] + jac[:, 1]], axis=1)
+        return np.ascontiguousarray((fitted - ydata[:, idx]).T), np.ascontiguousarray(jac.transpose(2, 1, 0))
+
+
+    def _growth_step(self, params, residual, jac, lam):
+        ''' Damped step on beta - gamma and gamma within the bounds of beta and gamma
+
+            Where the step would move gamma past a bound, gamma stops on the
+            bound and the step on beta - gamma is solved again for that gamma.
+        '''
+        JTJ, JTr = self._normal_equations(jac, residual)
+        step = self._damped_step(JTJ, JTr, lam)
+        gamma = np.clip(params[1] + step[1], self.lower[1], self.upper[1])
+        pinned = gamma != params[1] + step[1]
+        if pinned.any():
+            gamma_step = gamma[pinned] - params[1, pinned]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                growth_step = -(JTr[0, pinned] + JTJ[pinned, 0, 1]*gamma_step)/(JTJ[pinned, 0, 0]*(1 + lam[pinned]) + 1e-300)
+            step[0, pinned] = np.where(np.isfinite(growth_step), growth_step, 0.0)
+        growth = np.clip(params[0] - params[1] + step[0], self.lower[0] - gamma, self.upper[0] - gamma)
+        return np.vstack([growth + gamma, gamma])
+
+
+    @staticmethod
+    def _normal_equations(jac, residual):
+        ''' Per country J^T J (n, 2, 2) and J^T r (2, n) of the Jacobian (n, 2, n_days)
+            and the residuals (n, n_days), J^T r is None without residuals '''
+        JTJ = np.empty((jac.shape[0], 2, 2))
+        JTJ[:, 0, 0] = np.sum(jac[:, 0]*jac[:, 0], axis=-1)
+        JTJ[:, 1, 1] = np.sum(jac[:, 1]*jac[:, 1], axis=-1)
+        JTJ[:, 0, 1] = JTJ[:, 1, 0] = np.sum(jac[:, 0]*jac[:, 1], axis=-1)
+        if residual is None:
+            return JTJ, None
+        return JTJ, np.vstack([np.sum(jac[:, 0]*residual, axis=-1), np.sum(jac[:, 1]*residual, axis=-1)])
+
+
+    @staticmethod
+    def _damped_step(JTJ, JTr, lam):
+        ''' Solve the 2x2 Levenberg-Marquardt systems in closed form '''
+        a = JTJ[:, 0, 0]*(1 + lam) + 1e-300
+        d = JTJ[:, 1, 1]*(1 + lam) + 1e-300
+        b = JTJ[:, 0, 1]
+        det = a*d - b*b
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step = np.vstack([-(d*JTr[0] - b*JTr[1])/det,
+                              -(a*JTr[1] - b*JTr[0])/det])
+        return np.where(np.isfinite(step), step, 0.0)
+
+
+    @staticmethod
+    def _inverse(JTJ):
+        ''' Closed form inverse of the 2x2 matrices, inf where singular '''
+        a, b, d = JTJ[:, 0, 0], JTJ[:, 0, 1], JTJ[:, 1, 1]
+        det = a*d - b*b
+        inverse = np.full(JTJ.shape, np.inf)
+        ok = det > 0
+        inverse[ok, 0, 0] = d[ok]/det[ok]
+        inverse[ok, 1, 1] = a[ok]/det[ok]
+        inverse[ok, 0, 1] = inverse[ok, 1, 0] = -b[ok]/det[ok]
+        return inverse
+
+
+
+def Handle_SIR_Modelling(ydata, N0, multistart=False):
+    ''' Fit the SIR model of a single country, kept for interactive use '''
+    fitter = fit_SIR_multistart(N0, ydata) if multistart else SIRFitter(N0).fit(ydata)
+    return fitter.t, ydata, fitter.fitted_[:, 0]
+
+
+
+@functools.lru_cache(maxsize=SIMULATION_CACHE_SIZE)
+def simulate_SIR(N0, I0, beta, gamma, horizon, R0=R0):
+    ''' Trajectory of one SIR system for what-if scenarios, memoized
+
+        Integrates SIR_model_fit with odeint, which answers a single
+        trajectory in a few milliseconds. Repeated calls with the same
+        arguments, e.g. when moving a dashboard slider back and forth, are
+        answered from a bounded LRU cache.
+
+        Parameters:
+        ----------
+        N0: float
+            total population
+        I0, R0: float
+            initial infected and recovered population
+        beta, gamma: float
+            rates of infection and recovery
+        horizon: int
+            number of simulated days after the initial day
+
+        Returns:
+        ----------
+        trajectory: np.array
+            read only, S, I and R per day, shape (horizon + 1, 3)
+    '''
+    t = np.arange(int(horizon) + 1, dtype=float)
+    trajectory = integrate.odeint(SIR_model_fit, (N0 - I0 - R0, I0, R0), t, args=(beta, gamma, N0))
+    trajectory.flags.writeable = False
+    return trajectory
+
+
+
+def simulate_SIR_batch(N0, I0, beta, gamma, horizon, R0=R0):
+    ''' Trajectories of many SIR systems at once, e.g. a grid of scenarios
+
+        All arguments but horizon can be arrays of the same shape (n,), the
+        stacked systems are integrated with integrate_batch, with as many
+        steps per day as the largest rate needs.
+
+        Returns:
+        ----------
+        trajectories: np.array
+            S, I and R per day and system, shape (horizon + 1, 3, n)
+    '''
+    N0, I0, R0, beta, gamma = np.broadcast_arrays(*[np.atleast_1d(np.asarray(each, dtype=float))
+                                                    for each in (N0, I0, R0, beta, gamma)])
+    t = np.arange(int(horizon) + 1, dtype=float)
+    return integrate_batch(SIR_model_fit, (N0 - I0 - R0, I0, R0), t, (beta, gamma, N0),
+                           stable_substeps(np.maximum(beta, gamma)))
+
+
+
+def get_start_points(n_starts=SIR_N_STARTS, bounds=SIR_START_BOUNDS, seed=0):
+    ''' Starting points of a multi-start fit, shape (n_starts, 2)
+
+        The default (beta, gamma) of the single fit comes first, the others
+        are drawn uniformly on a log scale within the bounds.
+    '''
+    rng = np.random.default_rng(seed)
+    lower, upper = np.log(bounds[0]), np.log(bounds[1])
+    points = np.exp(rng.uniform(lower, upper, (max(n_starts - 1, 0), 2)))
+    default = np.clip([beta, gamma], bounds[0], bounds[1])
+    return np.vstack([default, points])[:n_starts]
+
+
+
+def fit_SIR_multistart(N0, ydata, n_starts=SIR_N_STARTS, starts_per_round=SIR_STARTS_PER_ROUND,
+                       bounds=SIR_FIT_BOUNDS, start_bounds=SIR_START_BOUNDS, max_iter=100,
+                       same_fit=SIR_SAME_FIT, seed=0):
+    ''' Bounded SIR fit from several starting points with early stopping
+
+        The starting points are fitted in rounds, every round fits
+        starts_per_round points of all remaining countries in one batch. A
+        country stops as soon as a second starting point reproduces its best
+        fit, i.e. ends within same_fit of the smallest residual, the others
+        continue with the next round. Countries whose best fit was not
+        reproduced after n_starts points are reported as failed.
+
+        The first starting point is the one of the single fit and the best fit
+        is kept per country, so the result is never worse than SIRFitter(N0).
+        Countries without cases on the first day (I0 = 0) cannot be fitted,
+        their simulated curve stays zero. They are only fitted in the first
+        round and reported as zero_start_ instead of failed.
+
+        Parameters:
+        ----------
+        N0: np.array
+            population per country
+        ydata: np.array
+            confirmed cases, shape (n_days,) or (n_days, n)
+        n_starts: int
+            maximum number of starting points per country
+        starts_per_round: int
+            starting points fitted at once
+        bounds: tuple
+            ((beta_min, gamma_min), (beta_max, gamma_max)) of the fit
+        start_bounds: tuple
+            range of the random starting points, the lower bounds must be positive
+        max_iter: int
+            Levenberg-Marquardt iterations per starting point
+        same_fit: float
+            relative residual difference up to which two fits are the same
+        seed: int
+            random seed of the starting points
+
+        Returns:
+        ----------
+        fitter: SIRFitter
+            best fit per country, additionally with rel_error_ (RMS error
+            relative to the peak cases), n_starts_ (starting points used),
+            zero_start_ (I0 = 0) and failed_ (best fit not reproduced)
+    '''
+    N0 = np.atleast_1d(np.asarray(N0, dtype=float))
+    ydata = np.asarray(ydata, dtype=float)
+    if ydata.ndim == 1:
+        ydata = ydata[:, None]
+    n_days, n = ydata.shape
+    starts = get_start_points(n_starts, start_bounds, seed)
+    peak = np.maximum(np.abs(ydata).max(axis=0), 1.0)
+
+    result = SIRFitter(N0, bounds=bounds, max_iter=max_iter)
+    result.t = np.arange(n_days, dtype=float)
+    result.I0 = ydata[0].copy()
+    result.beta_, result.gamma_ = np.full(n, np.nan), np.full(n, np.nan)
+    result.pcov_ = np.full((n, 2, 2), np.inf)
+    result.fitted_ = np.zeros((n_days, n))
+    result.residual_ = np.full(n, np.inf)
+    result.n_iter_ = np.zeros(n, dtype=int)
+    result.converged_ = np.zeros(n, dtype=bool)
+    result.refit_ = np.zeros(n, dtype=bool)
+    result.fit_time_ = np.zeros(n)
+    result.n_starts_ = np.zeros(n, dtype=int)
+    result.zero_start_ = result.I0 == 0
+    n_same = np.zeros(n, dtype=int)
+
+    remaining = np.arange(n)
+    for first in range(0, len(starts), starts_per_round):
+        round_starts = starts[first:first + starts_per_round]
+        k, m = len(round_starts), len(remaining)
+
+        # every remaining country once per starting point, start major
+        columns = np.tile(remaining, k)
+        inits = np.repeat(round_starts, m, axis=0)
+        fitter = SIRFitter(N0[columns], beta_init=inits[:, 0], gamma_init=inits[:, 1],
+                           bounds=bounds, max_iter=max_iter).fit(ydata[:, columns])
+
+        residual = np.where(np.isfinite(fitter.residual_), fitter.residual_, np.inf).reshape(k, m)
+        best = np.argmin(residual, axis=0)
+        chosen = best*m + np.arange(m)
+        better = residual[best, np.arange(m)] < result.residual_[remaining]
+
+        # starting points counted so far are only the same fit if the new best is within same_fit of them
+        limit = np.minimum(residual[best, np.arange(m)], result.residual_[remaining])*(1 + same_fit)
+        kept = np.isfinite(limit) & (result.residual_[remaining] <= limit)
+        n_same[remaining] = np.where(kept, n_same[remaining], 0) + (np.isfinite(limit) & (residual <= limit)).sum(axis=0)
+
+        update, chosen = remaining[better], chosen[better]
+        result.beta_[update] = fitter.beta_[chosen]
+        result.gamma_[update] = fitter.gamma_[chosen]
+        result.pcov_[update] = fitter.pcov_[chosen]
+        result.fitted_[:, update] = fitter.fitted_[:, chosen]
+        result.residual_[update] = fitter.residual_[chosen]
+        result.converged_[update] = fitter.converged_[chosen]
+        result.refit_[update] = fitter.refit_[chosen]
+        result.n_iter_[remaining] += fitter.n_iter_.reshape(k, m).sum(axis=0)
+        result.fit_time_[remaining] += fitter.fit_time_.reshape(k, m).sum(axis=0)
+        result.n_starts_[remaining] += k
+
+        done = (n_same[remaining] >= 2) | result.zero_start_[remaining]
+        remaining = remaining[~done]
+        if remaining.size == 0:
+            break
+
+    result.rel_error_ = np.sqrt(result.residual_/n_days)/peak
+    result.failed_ = (n_same < 2) & ~result.zero_start_
+    return result
+
+
+
+def _fit_chunk(N0, ydata, multistart=False):
+    ''' Fit one chunk of countries, module level so it can be sent to worker processes '''
+    if multistart:
+        return fit_SIR_multistart(N0, ydata)
+    return SIRFitter(N0).fit(ydata)
+
+
+
+def get_n_workers(n, n_workers=1, min_chunk=SIR_MIN_CHUNK):
+    ''' Worker processes worth starting for a batch of n countries
+
+        The vectorized fit of a batch takes about as long for 200 as for 800
+        countries, so a split only pays when every worker gets at least
+        min_chunk countries. 1 means the batch is fitted serially.
+    '''
+    n_workers = n_workers or os.cpu_count()
+    return max(1, min(n_workers, n//max(min_chunk, 1)))
+
+
+
+@profile_stage
+def fit_SIR_parallel(N0, ydata, n_workers=1, chunk_size=None, multistart=False, min_chunk=SIR_MIN_CHUNK):
+    ''' Fit the SIR model of many countries, optionally on several processes
+
+        Every country is fitted independently inside the batch, so splitting
+        the countries into chunks gives exactly the same results as the serial
+        fit. Batches too small to give every worker min_chunk countries are
+        fitted serially, see get_n_workers.
+
+        Parameters:
+        ----------
+        N0: np.array
+            population per country
+        ydata: np.array
+            confirmed cases, shape (n_days, n)
+        n_workers: int
+            maximum number of worker processes, None uses all cores, 1 fits serially
+        chunk_size: int
+            countries per task, by default the countries are split evenly over the workers
+        multistart: bool
+            bounded fit from several starting points, see fit_SIR_multistart
+        min_chunk: int
+            fewest countries per worker
+
+        Returns:
+        ----------
+        fitter: SIRFitter
+            fitted engine holding the results of all countries in input order
+    '''
+    N0 = np.asarray(N0, dtype=float)
+    n = len(N0)
+    n_workers = get_n_workers(n, n_workers, min_chunk)
+
+    if n_workers <= 1:
+        return _fit_chunk(N0, ydata, multistart)
+
+    chunk_size = chunk_size or -(-n//n_workers)
+    bounds = range(0, n, chunk_size)
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        fitters = list(executor.map(_fit_chunk,
+                                    [N0[start:start + chunk_size] for start in bounds],
+                                    [ydata[:, start:start + chunk_size] for start in bounds],
+                                    [multistart]*len(bounds)))
+
+    return SIRFitter.merge(fitters)
+
+
+
+def get_windows(n_days, start=SIR_FIT_START, window=SIR_WINDOW, step=SIR_WINDOW_STEP, min_window=SIR_MIN_WINDOW):
+    ''' Day ranges of the rolling fit over the whole history
+
+        Returns:
+        ----------
+        bounds: list
+            (first_day, end_day) per window, end_day exclusive
+    '''
+    bounds = []
+    for first in range(start, n_days, step):
+        end = min(first + window, n_days)
+        if end - first < min_window:
+            if bounds:
+                bounds[-1] = (bounds[-1][0], n_days)
+            break
+        bounds.append((first, end))
+    return bounds
+
+
+
+def _fit_windows_chunk(N0, ydata, bounds, warm_start=True, first_window=None, beta_init=beta, gamma_init=gamma):
+    ''' Fit the windows of one chunk of countries one after the other
+
+        Every country is fitted from its first_window on, with warm_start every
+        window starts from the parameters of the previous window instead of
+        beta_init and gamma_init.
+
+        Returns:
+        ----------
+        results: list
+            (idx, fitter) per window, the fitter holding the countries idx, None if none was fitted
+    '''
+    first_window = np.zeros(len(N0), dtype=int) if first_window is None else np.asarray(first_window)
+    beta_init = np.array(np.broadcast_to(beta_init, N0.shape), dtype=float)
+    gamma_init = np.array(np.broadcast_to(gamma_init, N0.shape), dtype=float)
+
+    results = []
+    for window, (first, end) in enumerate(bounds):
+        idx = np.flatnonzero(first_window <= window)
+        if idx.size == 0:
+            results.append((idx, None))
+            continue
+        fitter = SIRFitter(N0[idx], beta_init=beta_init[idx], gamma_init=gamma_init[idx]).fit(ydata[first:end, idx])
+        results.append((idx, fitter))
+        if warm_start:
+            beta_init[idx], gamma_init[idx] = fitter.beta_, fitter.gamma_
+    return results
+
+
+
+@profile_stage
+def fit_SIR_windows(N0, ydata, bounds, warm_start=True, n_workers=1, chunk_size=None,
+                    first_window=None, beta_init=beta, gamma_init=gamma, min_chunk=SIR_MIN_CHUNK):
+    ''' Rolling SIR fit of many countries over successive windows
+
+        The windows of a country depend on each other through the warm
+        start, so the countries are split into chunks and every worker fits
+        all windows of its chunk.
+
+        Parameters:
+        ----------
+        N0: np.array
+            population per country
+        ydata: np.array
+            confirmed cases of the whole history, shape (n_days, n)
+        bounds: list
+            (first_day, end_day) per window, see get_windows
+        warm_start: bool
+            start each window from the previous window's beta and gamma
+        n_workers: int
+            maximum number of worker processes, None uses all cores, 1 fits serially
+        chunk_size: int
+            countries per task, by default the countries are split evenly over the workers
+        first_window: np.array
+            first window to fit per country, earlier windows are skipped, by default 0
+        beta_init, gamma_init: array like
+            starting point of the first fitted window per country
+        min_chunk: int
+            fewest countries per worker, smaller batches are fitted serially
+
+        Returns:
+        ----------
+        results: list
+            (idx, fitter) per window, the fitter holding the countries idx in
+            input order, None if no country was fitted in the window
+    '''
+    N0 = np.asarray(N0, dtype=float)
+    n = len(N0)
+    n_workers = get_n_workers(n, n_workers, min_chunk)
+    first_window = np.zeros(n, dtype=int) if first_window is None else np.asarray(first_window)
+    beta_init = np.broadcast_to(np.asarray(beta_init, dtype=float), N0.shape)
+    gamma_init = np.broadcast_to(np.asarray(gamma_init, dtype=float), N0.shape)
+
+    if n_workers <= 1:
+        return _fit_windows_chunk(N0, ydata, bounds, warm_start, first_window, beta_init, gamma_init)
+
+    chunk_size = chunk_size or -(-n//n_workers)
+    starts = range(0, n, chunk_size)
+    chunk = lambda values, start: values[..., start:start + chunk_size]
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        chunks = list(executor.map(_fit_windows_chunk,
+                                   [chunk(N0, start) for start in starts],
+                                   [chunk(ydata, start) for start in starts],
+                                   [bounds]*len(starts),
+                                   [warm_start]*len(starts),
+                                   [chunk(first_window, start) for start in starts],
+                                   [chunk(beta_init, start) for start in starts],
+                                   [chunk(gamma_init, start) for start in starts]))
+
+    results = []
+    for window_results in zip(*chunks):
+        fitted = [(idx + start, fitter) for start, (idx, fitter) in zip(starts, window_results) if fitter is not None]
+        if not fitted:
+            results.append((np.array([], dtype=int), None))
+            continue
+        results.append((np.concatenate([idx for idx, _ in fitted]),
+                        SIRFitter.merge([fitter for _, fitter in fitted])))
+    return results
+
+
+
+def get_window_hashes(N0, ydata, bounds, warm_start=True):
+    ''' Input hash of every window fit, shape (n_windows, n)
+
+        A window hash covers the population, the fitted cases, the window
+        bounds, the fit settings and SIR_FITTER_VERSION. With warm_start it
+        also covers the hash of the previous window, whose result is the
+        starting point.
+    '''
+    settings = json.dumps([beta, gamma, R0, warm_start, SIR_FITTER_VERSION])
+    hashes = np.empty((len(bounds), len(N0)), dtype=object)
+    for country in range(len(N0)):
+        previous = settings
+        for window, (first, end) in enumerate(bounds):
+            sha = hashlib.sha1(previous.encode('utf-8'))
+            sha.update(np.float64(N0[country]).tobytes())
+            sha.update(np.ascontiguousarray(ydata[first:end, country], dtype=np.float64).tobytes())
+            sha.update('{}:{}'.format(first, end).encode('utf-8'))
+            hashes[window, country] = sha.hexdigest()
+            if warm_start:
+                previous = hashes[window, country]
+    return hashes
+
+
+
+def get_refit_windows(df_stored, countries, hashes, warm_start=True):
+    ''' First window to refit per country, and its starting parameters
+
+        Windows whose input hash matches the stored parameters are kept, the
+        fit of a country resumes at its first changed window, warm-started
+        from the stored parameters of the window before.
+
+        Returns:
+        ----------
+        first_window, beta_init, gamma_init: np.array
+    '''
+    n_windows, n = hashes.shape
+    first_window = np.zeros(n, dtype=int)
+    beta_init = np.full(n, beta, dtype=float)
+    gamma_init = np.full(n, gamma, dtype=float)
+    if df_stored is None:
+        return first_window, beta_init, gamma_init
+
+    stored = {(str(country), window): (input_hash, each_beta, each_gamma)
+              for country, window, input_hash, each_beta, each_gamma
+              in zip(df_stored['country'], df_stored['window'], df_stored['input_hash'],
+                     df_stored['beta'], df_stored['gamma'])}
+
+    for pos, country in enumerate(countries):
+        window = 0
+        while window < n_windows and stored.get((country, window), (None,))[0] == hashes[window, pos]:
+            window += 1
+        first_window[pos] = window
+        if warm_start and 0 < window:
+            _, beta_init[pos], gamma_init[pos] = stored[(country, window - 1)]
+
+    return first_window, beta_init, gamma_init
+
+
+
+def get_window_params(results, bounds, countries, dates, N0, ydata, hashes):
+    ''' Parameters and fit diagnostics of the fitted windows, one row per country and window
+
+        Without any fitted window, e.g. for a history too short for the first
+        window, an empty frame with the same columns is returned.
+    '''
+    dates = pd.to_datetime(pd.Series(dates)).values
+    countries = np.asarray(countries, dtype=object)
+
+    params = []
+    for window, ((idx, fitter), (first, end)) in enumerate(zip(results, bounds)):
+        if fitter is None:
+            continue
+        params.append(pd.DataFrame({'country': countries[idx],
+                                    'window': window,
+                                    'start_date': dates[first],
+                                    'end_date': dates[end - 1],
+                                    'population': N0[idx],
+                                    'I0': ydata[first, idx],
+                                    'beta': fitter.beta_,
+                                    'gamma': fitter.gamma_,
+                                    'var_beta': fitter.pcov_[:, 0, 0],
+                                    'cov_beta_gamma': fitter.pcov_[:, 0, 1],
+                                    'var_gamma': fitter.pcov_[:, 1, 1],
+                                    'residual': fitter.residual_,
+                                    'n_iter': fitter.n_iter_,
+                                    'converged': fitter.converged_,
+                                    'fit_time': fitter.fit_time_,
+                                    'input_hash': hashes[window, idx]}))
+    if not params:
+        return pd.DataFrame(columns=SIR_WINDOW_PARAM_COLUMNS)
+    return pd.concat(params, ignore_index=True)
+
+
+
+def simulate_SIR_windows(df_params):
+    ''' Regenerate the fitted infected curves from stored window parameters
+
+        Parameters:
+        ----------
+        df_params: pd.DataFrame
+            rows of COVID_SIR_window_params
+
+        Returns:
+        ----------
+        df_curves: pd.DataFrame
+            fitted infected cases per date, country and window
+    '''
+    curves = []
+    for window, df_window in df_params.groupby('window', sort=True):
+        start_date = pd.to_datetime(df_window['start_date'].iloc[0])
+        n_days = (pd.to_datetime(df_window['end_date'].iloc[0]) - start_date).days + 1
+
+        fitter = SIRFitter(df_window['population'].values)
+        fitter.t = np.arange(n_days, dtype=float)
+        fitter.I0 = df_window['I0'].values.astype(float)
+        fitted = fitter.simulate(df_window['beta'].values, df_window['gamma'].values)
+
+        curves.append(pd.DataFrame({'date': np.repeat(pd.date_range(start_date, periods=n_days).values, len(df_window)),
+                                    'country': np.tile(df_window['country'].astype(str).values, n_days),
+                                    'window': window,
+                                    'fitted': fitted.reshape(-1)}))
+
+    if not curves:
+        return pd.DataFrame({'date': [], 'country': [], 'window': [], 'fitted': []})
+    return pd.concat(curves, ignore_index=True)
+
+
+
+def get_fit_report(countries, fitter, ydata):
+    ''' Fit quality per country of a single or multi-start fit of ydata
+
+        A single fit counts as one starting point and as failed where it did
+        not converge. Countries without cases on the first day (I0 = 0) are
+        flagged as zero_start and never as failed.
+    '''
+    zero_start = ydata[0] == 0
+    peak = np.maximum(np.abs(ydata).max(axis=0), 1.0)
+    return pd.DataFrame({'country': countries,
+                         'beta': fitter.beta_,
+                         'gamma': fitter.gamma_,
+                         'residual': fitter.residual_,
+                         'rel_error': np.sqrt(fitter.residual_/ydata.shape[0])/peak,
+                         'n_starts': getattr(fitter, 'n_starts_', np.ones(len(countries), dtype=int)),
+                         'n_iter': fitter.n_iter_,
+                         'converged': fitter.converged_,
+                         'refit': fitter.refit_,
+                         'zero_start': zero_start,
+                         'failed': getattr(fitter, 'failed_', ~fitter.converged_ & ~zero_start)})
+
+
+
+@profile_stage
+def exec_SIR_modelling(n_workers=1, chunk_size=None, rolling=True, warm_start=True, multistart=False):
+    ''' Fit the SIR model of every country with known population
+
+        Parameters:
+        ----------
+        n_workers: int
+            maximum number of worker processes, None uses all cores, used only for
+            batches of at least SIR_MIN_CHUNK countries per worker
+        chunk_size: int
+            countries dispatched to a worker per task
+        rolling: bool
+            also fit successive windows over the whole history, stored as
+            COVID_SIR_window_params and COVID_SIR_window_curves
+        warm_start: bool
+            start every window from the parameters of the previous one
+        multistart: bool
+            multi-start fit of the SIR slice instead of the single fit, the fit
+            quality per country is stored as COVID_SIR_fit_report either way
+    '''
     print('SIR Modelling Started.')
-    df_analyse = pd.read_csv('../data/processed/COVID_full_flat_table.csv', sep=';')
+    df_analyse = load_dataset('COVID_full_flat_table')
+    record_rows(input_rows=df_analyse.shape[0])
     df_analyse.sort_values('date', ascending=True)
     
     year = str(pd.to_datetime(df_analyse['date']).dt.year.min())
     
+    dates = df_analyse['date'].values
     df_analyse = df_analyse.drop(['date'],axis=1)
-    df_SIR_model = pd.DataFrame()
     
-    df_population_data = pd.read_csv('../data/processed/world_population_data.csv', sep=',')
-
-    for each_country in df_analyse:
-        if each_country in list(df_population_data['Country Name']):
-            global N0
-            global S0
-            global I0
-            N0 = df_population_data[df_population_data['Country Name'] == each_country][year].values[0]
-            S0 = N0 - I0
-            ydata = np.array(df_analyse[each_country][35:150])
-            t, ydata, fitted = Handle_SIR_Modelling(ydata)
-            df_SIR_model[each_country] = fitted
+    population = get_population_lookup()
+
+    countries = [each_country for each_country in df_analyse if each_country in population]
+    N0 = population.get_many(countries, year).values
+    ydata = df_analyse[countries].values[SIR_FIT_START:SIR_FIT_END]
+
+    fitter = fit_SIR_parallel(N0, ydata, n_workers=n_workers, chunk_size=chunk_size, multistart=multistart)
+
+    # curves of fits that did not converge, even after the curve_fit refit, are not stored
+    stored = [pos for pos, converged in enumerate(fitter.converged_) if converged]
+    if len(stored) < len(countries):
+        print('SIR fit did not converge for', len(countries) - len(stored), 'countries:',
+              ', '.join(country for pos, country in enumerate(countries) if pos not in set(stored)))
+    df_SIR_model = pd.DataFrame(fitter.fitted_[:, stored], columns=[countries[pos] for pos in stored])
         
-    df_SIR_model.to_csv('../data/processed/COVID_SIR_Model_Data.csv',sep=';', index = False)
+    save_dataset(df_SIR_model, 'COVID_SIR_Model_Data')
+
+    df_report = get_fit_report(countries, fitter, ydata)
+    save_dataset(df_report, 'COVID_SIR_fit_report')
+    zero_start = list(df_report.loc[df_report['zero_start'], 'country'])
+    if zero_start:
+        print('No cases on the first fitted day (I0 = 0) for', len(zero_start), 'countries:', ', '.join(zero_start))
+    failed = list(df_report.loc[df_report['failed'], 'country'])
+    if failed:
+        print('No reproducible SIR fit found for', len(failed), 'countries:', ', '.join(failed))
+    record_rows(output_rows=df_SIR_model.shape[0])
     print(df_SIR_model.shape[0],'rows generated for', df_SIR_model.shape[1], 'countries.')
-    print('SIR Modelling Completed.')
\ No newline at end of file
+
+    if rolling:
+        bounds = get_windows(len(dates))
+        ydata = df_analyse[countries].values
+        hashes = get_window_hashes(N0, ydata, bounds, warm_start)
+
+        # keep the stored windows whose inputs did not change
+        df_stored = load_dataset('COVID_SIR_window_params') if dataset_exists('COVID_SIR_window_params') else None
+        first_window, beta_init, gamma_init = get_refit_windows(df_stored, countries, hashes, warm_start)
+
+        results = fit_SIR_windows(N0, ydata, bounds, warm_start, n_workers=n_workers, chunk_size=chunk_size,
+                                  first_window=first_window, beta_init=beta_init, gamma_init=gamma_init)
+        df_params = get_window_params(results, bounds, countries, dates, N0, ydata, hashes)
+
+        if df_stored is not None:
+            first_window = dict(zip(countries, first_window))
+            keep = [first_window.get(str(country), 0) > window
+                    for country, window in zip(df_stored['country'], df_stored['window'])]
+            df_params = pd.concat([df_stored[keep], df_params], ignore_index=True)
+
+        order = {country: pos for pos, country in enumerate(countries)}
+        df_params['country'] = df_params['country'].astype(str)
+        df_params = df_params.sort_values(['window', 'country'], key=lambda column: column.map(order) if column.name == 'country' else column) \
+                             .reset_index(drop=True)
+
+        df_curves = simulate_SIR_windows(df_params)
+        save_dataset(df_params, 'COVID_SIR_window_params')
+        save_dataset(df_curves, 'COVID_SIR_window_curves')
+        record_rows(output_rows=df_curves.shape[0])
+
+        n_fitted = sum(len(idx) for idx, _ in results)
+        print(n_fitted, 'of', len(bounds)*len(countries), 'window fits updated in',
+              sum(fitter.n_iter_.sum() for _, fitter in results if fitter is not None), 'iterations.')
+
+    print('SIR Modelling Completed.')
@@ -0,0 +1,338 @@
+import time
+import pandas as pd
+import numpy as np
+
+from src.profiling import profile_stage, record_rows
+from src.data.storage import load_dataset, save_dataset
+from src.data.schema import to_float_array
+from src.data.population import get_population_lookup
+from src.models.SIR_modelling import integrate_batch, levenberg_marquardt, stable_substeps, SIR_FIT_START, SIR_FIT_END
+
+'''
+Compartment models beyond SIR, fitted against several observed series at once
+'''
+
+
+
+def SIRD_model(state, time, beta, gamma, mu, N0):
+    '''
+    SIR model with a separate compartment of the deceased.
+    S: Suspected population
+    I: Infected population
+    R: Recovered population
+    D: Deceased population
+    beta: rate of infection
+    gamma: rate of recovery
+    mu: death rate of the infected
+    N0: total population
+
+    All arguments can be numpy arrays of the same shape, one system per element.
+    '''
+    S, I, R, D = state
+    infection = beta*S*I/N0
+    return -infection, infection - (gamma + mu)*I, gamma*I, mu*I
+
+
+
+def SEIR_model(state, time, beta, sigma, gamma, N0):
+    '''
+    SIR model with an exposed (infected, not yet infectious) compartment.
+    S: Suspected population
+    E: Exposed population
+    I: Infected population
+    R: Recovered population
+    beta: rate of infection
+    sigma: rate at which the exposed become infectious, 1/incubation period
+    gamma: rate of recovery
+    N0: total population
+
+    All arguments can be numpy arrays of the same shape, one system per element.
+    '''
+    S, E, I, R = state
+    infection = beta*S*I/N0
+    return -infection, infection - sigma*E, sigma*E - gamma*I, gamma*I
+
+
+
+'''
+Per model: right hand side, parameter names, starting point and bounds, the
+initial state from the first observed values and the observed series as
+functions of the integrated states (shape (n_days, n_states, n)).
+'''
+MODELS = {
+    'SIRD': {
+        'func': SIRD_model,
+        'params': ['beta', 'gamma', 'mu'],
+        'init': [0.5, 0.1, 0.01],
+        'bounds': ((0.0, 0.0, 0.0), (10.0, 10.0, 1.0)),
+        'initial_state': lambda N0, first: (N0 - first['confirmed'], first['confirmed'] - first['deaths'],
+                                            np.zeros_like(N0), first['deaths']),
+        'observed': {'confirmed': lambda y: y[:, 1] + y[:, 2] + y[:, 3],
+                     'deaths': lambda y: y[:, 3]},
+    },
+    'SEIR': {
+        'func': SEIR_model,
+        'params': ['beta', 'sigma', 'gamma'],
+        'init': [0.5, 0.2, 0.1],
+        'bounds': ((0.0, 0.0, 0.0), (10.0, 10.0, 10.0)),
+        'initial_state': lambda N0, first: (N0 - first['confirmed'], np.zeros_like(N0),
+                                            first['confirmed'], np.zeros_like(N0)),
+        'observed': {'confirmed': lambda y: y[:, 2] + y[:, 3]},
+    },
+}
+
+
+
+class CompartmentFitter:
+    ''' Batched fit of a compartment model against several observed series
+
+        All countries are fitted at once by levenberg_marquardt, the loop
+        shared with SIRFitter. The Jacobian is taken by forward differences: the base system
+        and one system per perturbed parameter are stacked into a single
+        integrate_batch call, so n countries with p parameters integrate
+        n*(p+1) systems per iteration. The residuals of every observed series
+        are scaled by the largest observed value of the country, so deaths
+        weigh as much as confirmed cases.
+
+        Parameters:
+        ----------
+        model: str
+            key of MODELS, e.g. 'SIRD' or 'SEIR'
+        N0: array like
+            population per country
+        init: array like
+            starting point, shape (p,) or (p, n), by default the model defaults
+        bounds: tuple
+            (lower, upper) per parameter, by default the model bounds
+        max_iter: int
+            maximum number of Levenberg-Marquardt iterations per country
+        tol: float
+            relative tolerance on cost decrease and parameter step
+        substeps: int
+            RK4 steps per day, by default enough to keep the integration
+            stable for all rates within the bounds
+        eps: float
+            relative step of the finite differences
+
+        Attributes after fit:
+        ----------
+        params_: np.array
+            fitted parameters, shape (p, n)
+        pcov_: np.array
+            parameter covariance per country, shape (n, p, p)
+        fitted_: dict
+            fitted series name to array of shape (n_days, n)
+        residual_: np.array
+            sum of squared scaled residuals per country
+        n_iter_: np.array
+            iterations used per country
+        converged_: np.array
+            False where max_iter was reached before convergence or the
+            residual is not finite
+        fit_time_: np.array
+            wall time of the batch fit in seconds, shared evenly by its countries
+    '''
+
+    def __init__(self, model, N0, init=None, bounds=None, max_iter=100, tol=1e-8, substeps=None, eps=1e-6):
+        self.model = MODELS[model]
+        self.N0 = np.atleast_1d(np.asarray(N0, dtype=float))
+        n_params = len(self.model['params'])
+        init = self.model['init'] if init is None else init
+        self.init = np.broadcast_to(np.asarray(init, dtype=float).reshape(n_params, -1), (n_params, len(self.N0)))
+        bounds = self.model['bounds'] if bounds is None else bounds
+        self.lower = np.asarray(bounds[0], dtype=float).reshape(n_params, 1)
+        self.upper = np.asarray(bounds[1], dtype=float).reshape(n_params, 1)
+        self.max_iter = max_iter
+        self.tol = tol
+        # the summed upper rates bound how fast any compartment can change
+        self.substeps = substeps or stable_substeps(self.upper.sum())
+        self.eps = eps
+        self.t = None
+        self.y0 = None
+
+
+    def simulate(self, params, t=None, idx=None):
+        ''' Integrate the systems of the selected countries
+
+            Parameters:
+            ----------
+            params: np.array
+                shape (p, m), m a multiple of the selected countries, the
+                countries are repeated in blocks to fit the number of systems
+
+            Returns:
+            ----------
+            observed: dict
+                series name to array of shape (n_days, m)
+        '''
+        t = self.t if t is None else t
+        idx = slice(None) if idx is None else idx
+        N0, y0 = self.N0[idx], self.y0[:, idx]
+        repeat = params.shape[1]//len(N0)
+
+        N0 = np.tile(N0, repeat)
+        y0 = np.tile(y0, (1, repeat))
+        result = integrate_batch(self.model['func'], y0, t, tuple(params) + (N0,), self.substeps)
+        return {name: observe(result) for name, observe in self.model['observed'].items()}
+
+
+    def fit(self, observed):
+        ''' Fit the model parameters of all countries at once
+
+            Parameters:
+            ----------
+            observed: dict
+                series name to observed values of shape (n_days, n), one entry
+                per observed series of the model, e.g. confirmed and deaths
+
+            Returns:
+            ----------
+            self
+        '''
+        start_time = time.perf_counter()
+        names = list(self.model['observed'])
+        ydata = np.stack([np.asarray(observed[name], dtype=float).reshape(len(observed[name]), -1) for name in names])
+        n_params, n = self.init.shape
+
+        self.t = np.arange(ydata.shape[1], dtype=float)
+        self.y0 = np.array(self.model['initial_state'](self.N0, {name: np.asarray(values, dtype=float).reshape(len(values), -1)[0]
+                                                                  for name, values in observed.items()}), dtype=float)
+        scale = 1/np.maximum(np.abs(ydata).max(axis=1), 1.0)   # (series, n)
+
+        params = np.clip(self.init.copy(), self.lower, self.upper)
+        params, residual, jac, cost, n_iter, converged = levenberg_marquardt(
+            params, lambda params, idx: self._residual_jacobian(params, ydata[:, :, idx], scale[:, idx], idx),
+            self._clipped_step, self.max_iter, self.tol)
+
+        JTJ, _ = self._normal_equations(jac, residual)
+        dof = max(residual.shape[1] - n_params, 1)
+
+        self.params_ = params
+        self.pcov_ = self._inverse(JTJ)*(cost/dof)[:, None, None]
+        self.fitted_ = self.simulate(params)
+        self.residual_ = cost
+        self.n_iter_ = n_iter
+        self.converged_ = converged
+        self.fit_time_ = np.full(n, (time.perf_counter() - start_time)/n)
+        return self
+
+
+    def _residual_jacobian(self, params, ydata, scale, idx):
+        ''' Scaled residuals (m, n_series*n_days) and their forward difference
+            Jacobian (m, n_series*n_days, p) of the countries idx '''
+        n_params, m = params.shape
+        steps = self.eps*np.maximum(np.abs(params), 1e-3)
+
+        stacked = np.tile(params, (1, n_params + 1))
+        for pos in range(n_params):
+            stacked[pos, (pos + 1)*m:(pos + 2)*m] += steps[pos]
+
+        simulated = self.simulate(stacked, idx=idx)
+        simulated = np.stack([simulated[name] for name in self.model['observed']])   # (series, days, m*(p+1))
+        simulated = simulated.reshape(simulated.shape[0], simulated.shape[1], n_params + 1, m)
+
+        base = simulated[:, :, 0]
+        residual = (base - ydata)*scale[:, None, :]
+        jac = (simulated[:, :, 1:] - base[:, :, None])*scale[:, None, None, :]/steps[None, None]
+
+        residual = np.ascontiguousarray(residual.transpose(2, 0, 1).reshape(m, -1))
+        jac = np.ascontiguousarray(jac.transpose(3, 0, 1, 2).reshape(m, -1, n_params))
+        return residual, jac
+
+
+    def _clipped_step(self, params, residual, jac, lam):
+        ''' Damped step of the countries, clipped to the bounds '''
+        JTJ, JTr = self._normal_equations(jac, residual)
+        return np.clip(params + self._damped_step(JTJ, JTr, lam), self.lower, self.upper)
+
+
+    @staticmethod
+    def _normal_equations(jac, residual):
+        ''' Per country J^T J (n, p, p) and J^T r (p, n) '''
+        JTJ = np.einsum('nkp,nkq->npq', jac, jac)
+        JTr = np.einsum('nkp,nk->pn', jac, residual)
+        return JTJ, JTr
+
+
+    @staticmethod
+    def _damped_step(JTJ, JTr, lam):
+        ''' Solve the Levenberg-Marquardt systems of all countries '''
+        diagonal = np.einsum('npp->np', JTJ)
+        damped = JTJ.copy()
+        damped[:, np.arange(JTJ.shape[1]), np.arange(JTJ.shape[1])] = diagonal*(1 + lam[:, None]) + 1e-300
+        with np.errstate(divide='ignore', invalid='ignore'):
+            try:
+                step = -np.linalg.solve(damped, JTr.T[:, :, None])[:, :, 0].T
+            except np.linalg.LinAlgError:
+                step = -np.einsum('npq,qn->pn', np.linalg.pinv(damped), JTr)
+        return np.where(np.isfinite(step), step, 0.0)
+
+
+    @staticmethod
+    def _inverse(JTJ):
+        ''' Inverse of the normal matrices, inf where singular '''
+        inverse = np.full(JTJ.shape, np.inf)
+        ok = np.isfinite(JTJ).all(axis=(1, 2))
+        ok[ok] = np.linalg.matrix_rank(JTJ[ok]) == JTJ.shape[1]
+        if ok.any():
+            inverse[ok] = np.linalg.inv(JTJ[ok])
+        return inverse
+
+
+
+def get_country_series(df_input_large, columns=('confirmed', 'deaths')):
+    ''' Country level series of the cumulative data as (dates, countries, {column: (n_days, n)}) '''
+    df_country = df_input_large.groupby(['date', 'country'], observed=True)[list(columns)].sum()
+    series = {column: df_country[column].unstack('country').fillna(0) for column in columns}
+    first = series[columns[0]]
+    return first.index.values, [str(each) for each in first.columns], \
+           {column: to_float_array(values) for column, values in series.items()}
+
+
+
+@profile_stage
+def exec_compartment_modelling(model='SIRD', start=SIR_FIT_START, end=SIR_FIT_END):
+    ''' Fit a compartment model of every country with known population
+
+        The model is fitted against all of its observed series at once, e.g.
+        confirmed cases and deaths for SIRD, on the same slice of days as the
+        SIR model. The parameters are stored as dataset COVID_<model>_params.
+
+        Parameters:
+        ----------
+        model: str
+            key of MODELS
+        start, end: int
+            fitted slice of days of every country
+    '''
+    print(model, 'Modelling Started.')
+    df_input_large = load_dataset('COVID_final_set', columns=['date', 'country', 'confirmed', 'deaths'])
+    record_rows(input_rows=df_input_large.shape[0])
+
+    names = list(MODELS[model]['observed'])
+    dates, countries, series = get_country_series(df_input_large, names)
+    year = pd.to_datetime(dates).year.min()
+
+    population = get_population_lookup()
+    known = [pos for pos, country in enumerate(countries) if country in population]
+    countries = [countries[pos] for pos in known]
+    N0 = population.get_many(countries, year).values
+
+    fitter = CompartmentFitter(model, N0).fit({name: values[start:end, known] for name, values in series.items()})
+
+    df_params = pd.DataFrame({'country': countries,
+                              'start_date': dates[start],
+                              'end_date': dates[min(end, len(dates)) - 1],
+                              'population': N0})
+    for pos, name in enumerate(MODELS[model]['params']):
+        df_params[name] = fitter.params_[pos]
+        df_params['var_' + name] = fitter.pcov_[:, pos, pos]
+    df_params['residual'] = fitter.residual_
+    df_params['n_iter'] = fitter.n_iter_
+    df_params['converged'] = fitter.converged_
+    df_params['fit_time'] = fitter.fit_time_
+
+    save_dataset(df_params, 'COVID_{}_params'.format(model))
+    record_rows(output_rows=df_params.shape[0])
+    print(df_params.shape[0], 'countries fitted,', int((~fitter.converged_).sum()), 'not converged.')
+    print(model, 'Modelling Completed.')
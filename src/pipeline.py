@@ -0,0 +1,265 @@
+''' End-to-end data pipeline
+
+    Runs the stages of the notebook (fetch, transform, features, SIR modelling)
+    as a dependency graph. Every stage declares its input and output files, a
+    stage is skipped when the content hash of its inputs and its parameters is
+    unchanged since the last successful run and all outputs still exist.
+    Independent stages run concurrently.
+
+    Usage, from the project folder:
+
+        python -m src.pipeline [--force] [--no-fetch] [--workers 4] [--stages build_features ...]
+'''
+import os
+import sys
+import json
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from src.data.storage import dataset_path
+from src.data.process_JH_data import JH_DATA_PATH, CASE_TYPES, POPULATION_ZIP, POPULATION_CSV
+
+
+
+PIPELINE_STATE = '../data/processed/pipeline_state.json'
+
+
+
+class Stage:
+    ''' One pipeline step
+
+        Parameters:
+        ----------
+        name: str
+        func: callable
+            the stage function, called with kwargs
+        inputs: list
+            files read by the stage
+        outputs: list
+            files written by the stage
+        kwargs: dict
+            stage parameters, part of the input hash
+        fetch: bool
+            stage downloads data, it has no file inputs and always runs unless fetching is disabled
+    '''
+
+    def __init__(self, name, func, inputs=(), outputs=(), kwargs=None, fetch=False):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.kwargs = kwargs or {}
+        self.fetch = fetch
+
+
+    def run(self):
+        return self.func(**self.kwargs)
+
+
+
+def get_stages():
+    ''' The stages of the COVID-19 pipeline, in notebook order
+    '''
+    from src.data.get_data import get_johns_hopkins, get_world_population_data
+    from src.data.process_JH_data import store_confirmed_data_for_sir, process_world_population_data
+    from src.features.build_features import build_features, build_latest_global_statistics
+    from src.models.SIR_modelling import exec_SIR_modelling
+    from src.models.compartment_models import exec_compartment_modelling
+
+    jh_files = [JH_DATA_PATH.format(case_type) for case_type in CASE_TYPES]
+
+    return [
+        Stage('get_johns_hopkins', get_johns_hopkins,
+              outputs=jh_files, fetch=True),
+        Stage('get_world_population_data', get_world_population_data,
+              outputs=[POPULATION_ZIP], fetch=True),
+        Stage('build_features', build_features,
+              inputs=jh_files,
+              outputs=[dataset_path('COVID_final_set'), dataset_path('COVID_final_daily_set')],
+              kwargs={'impute_recovered': True}),
+        Stage('store_confirmed_data_for_sir', store_confirmed_data_for_sir,
+              inputs=jh_files[:1], outputs=[dataset_path('COVID_full_flat_table')]),
+        Stage('process_world_population_data', process_world_population_data,
+              inputs=[POPULATION_ZIP], outputs=[POPULATION_CSV, dataset_path('world_population')]),
+        Stage('build_latest_global_statistics', build_latest_global_statistics,
+              inputs=jh_files[:1] + [dataset_path('COVID_final_set'), dataset_path('world_population')],
+              outputs=[dataset_path('global_latest_stats')]),
+        Stage('exec_SIR_modelling', exec_SIR_modelling,
+              inputs=[dataset_path('COVID_full_flat_table'), dataset_path('world_population')],
+              outputs=[dataset_path('COVID_SIR_Model_Data'), dataset_path('COVID_SIR_window_params'),
+                       dataset_path('COVID_SIR_window_curves'), dataset_path('COVID_SIR_fit_report')]),
+        Stage('exec_compartment_modelling', exec_compartment_modelling,
+              inputs=[dataset_path('COVID_final_set'), dataset_path('world_population')],
+              outputs=[dataset_path('COVID_SIRD_params')], kwargs={'model': 'SIRD'}),
+    ]
+
+
+
+def get_dependencies(stages):
+    ''' Map every stage name to the names of the stages producing its inputs
+    '''
+    producers = {output: stage.name for stage in stages for output in stage.outputs}
+    return {stage.name: set(producers[each] for each in stage.inputs if each in producers)
+            for stage in stages}
+
+
+
+def load_state():
+    if not os.path.isfile(PIPELINE_STATE):
+        return {'stages': {}, 'files': {}}
+    with open(PIPELINE_STATE, 'r') as state_file:
+        return json.load(state_file)
+
+
+
+def save_state(state):
+    with open(PIPELINE_STATE, 'w') as state_file:
+        json.dump(state, state_file, indent=2)
+
+
+
+def hash_file(path, state):
+    ''' SHA-256 of a file, reused from the state while modification time and size are unchanged
+    '''
+    stat = os.stat(path)
+    cached = state['files'].get(path)
+    if cached is not None and cached['mtime'] == stat.st_mtime_ns and cached['size'] == stat.st_size:
+        return cached['sha256']
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as file_obj:
+        for chunk in iter(lambda: file_obj.read(1024*1024), b''):
+            sha.update(chunk)
+
+    state['files'][path] = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'sha256': sha.hexdigest()}
+    return sha.hexdigest()
+
+
+
+def hash_inputs(stage, state):
+    ''' Combined hash of the stage parameters and input files, None if an input is missing
+    '''
+    sha = hashlib.sha256(json.dumps(stage.kwargs, sort_keys=True).encode('utf-8'))
+    for path in stage.inputs:
+        if not os.path.isfile(path):
+            return None
+        sha.update(path.encode('utf-8'))
+        sha.update(hash_file(path, state).encode('utf-8'))
+    return sha.hexdigest()
+
+
+
+def is_up_to_date(stage, input_hash, state):
+    return input_hash is not None \
+        and state['stages'].get(stage.name) == input_hash \
+        and all(os.path.isfile(each) for each in stage.outputs)
+
+
+
+def run_pipeline(stages=None, selected=None, force=False, fetch=True, workers=4):
+    ''' Run the pipeline stages in dependency order
+
+        Parameters:
+        ----------
+        stages: list
+            Stage objects, by default get_stages()
+        selected: list
+            names of the stages to consider, the others are treated as done
+        force: bool
+            run every stage regardless of its input hash
+        fetch: bool
+            run the download stages
+        workers: int
+            number of stages run at the same time
+
+        Returns:
+        ----------
+        result: dict
+            stage name to 'ran', 'skipped' or 'failed'
+    '''
+    stages = stages or get_stages()
+    by_name = {stage.name: stage for stage in stages}
+    dependencies = get_dependencies(stages)
+    selected = set(selected or by_name)
+
+    state = load_state()
+    result = {name: 'skipped' for name in by_name if name not in selected}
+    pending = [name for name in by_name if name in selected]
+    running = {}
+
+    def start(name):
+        stage = by_name[name]
+        if stage.fetch and not fetch:
+            return None
+        if not force and not stage.fetch and is_up_to_date(stage, hash_inputs(stage, state), state):
+            return None
+        print('Pipeline: running', name)
+        return executor.submit(stage.run)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            for name in list(pending):
+                blocked = dependencies[name] - set(result)
+                if blocked:
+                    continue
+                pending.remove(name)
+                if any(result[each] == 'failed' for each in dependencies[name]):
+                    result[name] = 'failed'
+                    print('Pipeline: not running', name, 'after failed dependency')
+                    continue
+                future = start(name)
+                if future is None:
+                    result[name] = 'skipped'
+                    print('Pipeline: skipping', name)
+                else:
+                    running[future] = name
+
+            if not running:
+                continue
+
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    future.result()
+                except Exception as error:
+                    result[name] = 'failed'
+                    print('Pipeline: stage', name, 'failed:', repr(error))
+                    continue
+                result[name] = 'ran'
+                input_hash = hash_inputs(by_name[name], state)
+                if input_hash is not None:
+                    state['stages'][name] = input_hash
+                save_state(state)
+
+    save_state(state)
+    return result
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the COVID-19 data pipeline.')
+    parser.add_argument('--stages', nargs='+', help='only run these stages')
+    parser.add_argument('--force', action='store_true', help='run stages even if their inputs are unchanged')
+    parser.add_argument('--no-fetch', action='store_true', help='do not download new data')
+    parser.add_argument('--workers', type=int, default=4, help='number of stages run at the same time')
+    parser.add_argument('--list', action='store_true', help='list the stages and their dependencies')
+    args = parser.parse_args(argv)
+
+    # all stages use paths relative to the src folder, as the notebooks do
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    stages = get_stages()
+    if args.list:
+        for name, dependencies in get_dependencies(stages).items():
+            print(name, '<-', ', '.join(sorted(dependencies)) or '-')
+        return 0
+
+    result = run_pipeline(stages, args.stages, args.force, not args.no_fetch, args.workers)
+    return 1 if 'failed' in result.values() else 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
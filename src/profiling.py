@@ -0,0 +1,192 @@
+''' Per-stage instrumentation of the pipeline
+
+    Stage functions are wrapped with profile_stage, which records wall time,
+    CPU time, resident memory and input/output row counts and writes them as
+    one JSON line per call to PROFILE_LOG. Row counts of data frames passed
+    to or returned by a stage are taken automatically, stages reading and
+    writing files report them with record_rows.
+
+    The CPU time includes worker processes the stage started and waited for,
+    e.g. the process pool of fit_SIR_parallel. The resident memory is taken
+    at the start and end of the stage. On Linux the peak is reset at the start
+    of every stage through /proc/self/clear_refs, so peak_rss_mb is the peak
+    of the stage and its nested stages, elsewhere it is the peak of the whole
+    process so far. Memory is measured per process, so stages running
+    concurrently in the pipeline share it.
+
+    Set the environment variable COVID_PROFILE_LOG to another file, to '-'
+    for stderr or to an empty string to disable the records.
+'''
+import os
+import sys
+import json
+import time
+import functools
+import contextvars
+from datetime import datetime
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+
+PROFILE_LOG = os.environ.get('COVID_PROFILE_LOG', '../data/interim/stage_profile.jsonl')
+
+_current_record = contextvars.ContextVar('current_record', default=None)
+
+
+
+def read_proc_status(field):
+    ''' Value of a memory field of /proc/self/status in MB, None if not available '''
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])/1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+
+def get_rss_mb():
+    ''' Current resident set size of the process in MB, None if not available
+    '''
+    rss = read_proc_status('VmRSS')
+    if rss is not None:
+        return rss
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss/1024/1024
+    except ImportError:
+        return None
+
+
+
+def reset_peak_rss():
+    ''' Reset the peak resident set size of the process to the current one,
+        False where this is not supported (only Linux supports it) '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+
+def get_cpu_time():
+    ''' CPU time of the process and of its terminated child processes in seconds,
+        the children are only counted by the resource module '''
+    if resource is None:
+        return time.process_time(), 0.0
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time(), children.ru_utime + children.ru_stime
+
+
+
+def get_peak_rss_mb():
+    ''' Peak resident set size of the process in MB, None if not available
+    '''
+    peak = read_proc_status('VmHWM')
+    if peak is not None:
+        return peak
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak/1024/1024 if sys.platform == 'darwin' else peak/1024
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset/1024/1024
+    except (ImportError, AttributeError):
+        return None
+
+
+
+def count_rows(values):
+    return sum(each.shape[0] for each in values if isinstance(each, (pd.DataFrame, pd.Series)))
+
+
+
+def record_rows(input_rows=None, output_rows=None):
+    ''' Add row counts to the record of the currently running stage
+    '''
+    record = _current_record.get()
+    if record is None:
+        return
+    if input_rows is not None:
+        record['input_rows'] = (record['input_rows'] or 0) + int(input_rows)
+    if output_rows is not None:
+        record['output_rows'] = (record['output_rows'] or 0) + int(output_rows)
+
+
+
+def emit(record):
+    ''' Append a record as JSON line to PROFILE_LOG, or to stderr if PROFILE_LOG is '-'
+    '''
+    if not PROFILE_LOG:
+        return
+    line = json.dumps(record)
+    if PROFILE_LOG == '-':
+        print(line, file=sys.stderr)
+        return
+    try:
+        with open(PROFILE_LOG, 'a') as log_file:
+            log_file.write(line + '\n')
+    except OSError:
+        pass
+
+
+
+def profile_stage(func):
+    ''' Decorator recording timing, memory and row counts of a stage function
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        parent = _current_record.get()
+        input_rows = count_rows(list(args) + list(kwargs.values()))
+        record = {'stage': func.__module__.split('.')[-1] + '.' + func.__name__,
+                  'parent': parent['stage'] if parent else None,
+                  'start': datetime.now().isoformat(timespec='seconds'),
+                  'input_rows': input_rows or None,
+                  'output_rows': None}
+        token = _current_record.set(record)
+
+        rss_start = get_rss_mb()
+        if parent is not None:
+            # the peak of the parent stage so far, before it is reset for this stage
+            parent['_nested_peak_rss_mb'] = max(get_peak_rss_mb() or 0, parent.get('_nested_peak_rss_mb', 0))
+        reset_peak_rss()
+        wall_start = time.perf_counter()
+        cpu_start, child_cpu_start = get_cpu_time()
+        status = 'ok'
+        try:
+            result = func(*args, **kwargs)
+            if isinstance(result, (pd.DataFrame, pd.Series)):
+                record_rows(output_rows=result.shape[0])
+            return result
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            _current_record.reset(token)
+            cpu_end, child_cpu_end = get_cpu_time()
+            # nested stages reset the peak, they pass on the peak reached before and during them
+            peak = max(each for each in [get_peak_rss_mb(), record.pop('_nested_peak_rss_mb', None), 0]
+                       if each is not None)
+            if parent is not None:
+                parent['_nested_peak_rss_mb'] = max(peak, parent.get('_nested_peak_rss_mb', 0))
+            record.update({'status': status,
+                           'wall_time': round(time.perf_counter() - wall_start, 6),
+                           'cpu_time': round(cpu_end - cpu_start + child_cpu_end - child_cpu_start, 6),
+                           'child_cpu_time': round(child_cpu_end - child_cpu_start, 6),
+                           'rss_start_mb': rss_start,
+                           'rss_end_mb': get_rss_mb(),
+                           'peak_rss_mb': peak or None})
+            emit(record)
+
+    return wrapper
@@ -15,24 +15,36 @@ import os
 from datetime import date
 from collections import defaultdict
 
+from src.visualization.data_store import DashboardDataStore
+from src.visualization.figure_cache import FigureCache
+from src.models.SIR_modelling import simulate_SIR, SIR_FIT_BOUNDS
+
 
 
 def calc_doubling_rate(N_0, t, T_d):
     return N_0 * np.power(2, t/T_d)
 
-def run_dashboard():
+def create_app(store=None):
+    ''' Build the Dash app with all layout and callbacks
 
-    ## Fetch all data
-    df_input_large = pd.read_csv('../data/processed/COVID_final_set.csv', sep=';')
-    df_input_daily = pd.read_csv('../data/processed/COVID_final_daily_set.csv', sep=';')
-    df_SIR_data = pd.read_csv('../data/processed/COVID_SIR_Model_Data.csv', sep=';')
-    df_analyse = pd.read_csv('../data/processed/COVID_full_flat_table.csv', sep=';')
-    df_global_latest_stats = pd.read_csv('../data/processed/global_latest_stats.csv', sep=";")
-    global_stats = pd.DataFrame(df_global_latest_stats[['population', 'confirmed', 'deaths', 'recovered', 'active']].sum()).T.astype("int64")
-    global_stats.columns = ['Total population', 'Total confirmed', ' Total deaths', 'Total recovered', 'Total active']
+        The data is loaded once here, so a WSGI server started with preloading
+        (see src/visualization/wsgi.py) shares it copy-on-write between all
+        worker processes instead of loading it per worker.
+
+        Parameters:
+        ----------
+        store: DashboardDataStore
+            already loaded data, loaded from the processed datasets if None
 
-    ## Filter SIR data
-    df_SIR_data = df_SIR_data.loc[:, (df_SIR_data != 0).any(axis=0)]
+        Returns:
+        ----------
+        app: dash.Dash
+            the WSGI application is available as app.server
+    '''
+
+    ## Fetch all data
+    store = store or DashboardDataStore()
+    figure_cache = FigureCache(version=store.refresh)
 
 
     css = [
@@ -47,179 +59,189 @@ def run_dashboard():
     app = dash.Dash(external_stylesheets=[css])
 
 
-    app.layout = html.Div([
+    def serve_layout():
+        ''' Layout built on every page load, so the country lists, date ranges and
+            global statistics follow the data reloaded by the store '''
+        store.refresh()
+        data = store.data
+        global_stats = pd.DataFrame(data.df_global_latest_stats[['population', 'confirmed', 'deaths', 'recovered', 'active']].sum()).T.astype("int64")
+        global_stats.columns = ['Total population', 'Total confirmed', ' Total deaths', 'Total recovered', 'Total active']
 
-        dcc.Markdown('''
-        # COVID-19 Dashboard and SIR Modelling
-        ''',style={'text-align':'center','border-style': 'solid'}),
+        return html.Div([
 
+            dcc.Markdown('''
+            # COVID-19 Dashboard and SIR Modelling
+            ''',style={'text-align':'center','border-style': 'solid'}),
 
-        html.Br(),html.Br(),html.Br(),
 
+            html.Br(),html.Br(),html.Br(),
 
-        html.Div([
-            dcc.Markdown('''
-                ## Global Statistics
-                ''',style={'text-align':'center'}),
 
-            dash.dash_table.DataTable(
-                data = global_stats.to_dict('records'),
-                columns = [{"name": i, 
-                            "id": i, 
-                            'type': 'numeric',
-                            'format' : dash.dash_table.Format.Format().group(True)
-                           } for i in global_stats.columns],
-                style_cell={
-                    'textAlign': 'center',
-                    'fontSize':17
-                },
-                style_header={
-                    'backgroundColor': 'rgb(30, 30, 30)',
-                    'color': 'white',
-                    #'fontWeight': 'bold'
-                },
-                style_data={
-                    'backgroundColor': 'rgb(50, 50, 50)',
-                    'color': 'white',
-                    #'fontWeight': 'bold'
-                },
-            ),
+            html.Div([
+                dcc.Markdown('''
+                    ## Global Statistics
+                    ''',style={'text-align':'center'}),
+
+                dash.dash_table.DataTable(
+                    data = global_stats.to_dict('records'),
+                    columns = [{"name": i, 
+                                "id": i, 
+                                'type': 'numeric',
+                                'format' : dash.dash_table.Format.Format().group(True)
+                               } for i in global_stats.columns],
+                    style_cell={
+                        'textAlign': 'center',
+                        'fontSize':17
+                    },
+                    style_header={
+                        'backgroundColor': 'rgb(30, 30, 30)',
+                        'color': 'white',
+                        #'fontWeight': 'bold'
+                    },
+                    style_data={
+                        'backgroundColor': 'rgb(50, 50, 50)',
+                        'color': 'white',
+                        #'fontWeight': 'bold'
+                    },
+                ),
 
-            dcc.Markdown('''
-                ***Select which case values to visualize:***
-                ''',style={'text-align':'left'}),
-            dcc.RadioItems(
-                options=[
-                    {'label': 'Confirmed', 'value': 'confirmed'},
-                    {'label': 'Deaths', 'value': 'deaths'},
-                    {'label': 'Recovered', 'value': 'recovered'},
-                    {'label': 'Active', 'value': 'active'},
-                ],
-                value='confirmed',
-                id='global_variable',
-                labelStyle={'display': 'inline-block'}
-            ),
+                dcc.Markdown('''
+                    ***Select which case values to visualize:***
+                    ''',style={'text-align':'left'}),
+                dcc.RadioItems(
+                    options=[
+                        {'label': 'Confirmed', 'value': 'confirmed'},
+                        {'label': 'Deaths', 'value': 'deaths'},
+                        {'label': 'Recovered', 'value': 'recovered'},
+                        {'label': 'Active', 'value': 'active'},
+                    ],
+                    value='confirmed',
+                    id='global_variable',
+                    labelStyle={'display': 'inline-block'}
+                ),
 
-            dcc.Markdown('''
-                ***Select whether to show absolute values, or the proportion of population:***
-                ''',style={'text-align':'left'}),
-            dcc.RadioItems(
-                options=[
-                    {'label': 'Absolute values', 'value': ''},
-                    {'label': 'Proportion of Population', 'value': '_ratio'},
-                ],
-                value='',
-                id='global_type',
-                labelStyle={'display': 'inline-block'}
-            ),
+                dcc.Markdown('''
+                    ***Select whether to show absolute values, or the proportion of population:***
+                    ''',style={'text-align':'left'}),
+                dcc.RadioItems(
+                    options=[
+                        {'label': 'Absolute values', 'value': ''},
+                        {'label': 'Proportion of Population', 'value': '_ratio'},
+                    ],
+                    value='',
+                    id='global_type',
+                    labelStyle={'display': 'inline-block'}
+                ),
 
-            dcc.Graph(id='global_map'),
+                dcc.Graph(id='global_map'),
 
-        ],
-        ),
+            ],
+            ),
 
 
-        html.Br(),html.Br(),html.Br(),
+            html.Br(),html.Br(),html.Br(),
 
 
-        dbc.Row([
-            dbc.Col(md=5, children=[
+            dbc.Row([
+                dbc.Col(md=5, children=[
 
-                dcc.Markdown('''
-                ## Statistics by Country
-                ''',style={'text-align':'center'}),
-                dcc.Markdown('''
-                ***Select one country:***
-                ''',style={'text-align':'left'}),
+                    dcc.Markdown('''
+                    ## Statistics by Country
+                    ''',style={'text-align':'center'}),
+                    dcc.Markdown('''
+                    ***Select one country:***
+                    ''',style={'text-align':'left'}),
 
-                dcc.Dropdown(
-                    id='country_drop_down_stats',
-                    options=[ {'label': each,'value':each} for each in df_input_large['country'].unique()],
-                    value='Germany',
-                    multi=False,
-                    style=dict(
-                        width='50%',
-                        verticalAlign="left"
-                    )
-                ),
-                html.Br(),
-                html.Div([
-                    dcc.Tabs(id='tabs-example', value='tab-1', children=[
-                        dcc.Tab(label='Cummulative', value='tab-1', children=[
-                            html.Div([
-                                html.Br(),
-                                dbc.Row([
-                                    dbc.Col(md=3, children=[
-                                    dcc.Markdown('''
-                                    ***Scale Modes:***
-                                    ''',style={'text-align':'left'}),
-                                    ]),
-                                    dbc.Col(md=4, children=[
-                                        dcc.RadioItems(
-                                            options=[
-                                                {'label': 'Linear', 'value': 'linear'},
-                                                {'label': 'Logarithmic', 'value': 'log'},
-
-                                            ],
-                                            value='linear',
-                                            id='scale_type',
-                                            labelStyle={'display': 'inline-block'}
+                    dcc.Dropdown(
+                        id='country_drop_down_stats',
+                        options=[ {'label': each,'value':each} for each in data.countries],
+                        value='Germany',
+                        multi=False,
+                        style=dict(
+                            width='50%',
+                            verticalAlign="left"
+                        )
+                    ),
+                    html.Br(),
+                    html.Div([
+                        dcc.Tabs(id='tabs-example', value='tab-1', children=[
+                            dcc.Tab(label='Cummulative', value='tab-1', children=[
+                                html.Div([
+                                    html.Br(),
+                                    dbc.Row([
+                                        dbc.Col(md=3, children=[
+                                        dcc.Markdown('''
+                                        ***Scale Modes:***
+                                        ''',style={'text-align':'left'}),
+                                        ]),
+                                        dbc.Col(md=4, children=[
+                                            dcc.RadioItems(
+                                                options=[
+                                                    {'label': 'Linear', 'value': 'linear'},
+                                                    {'label': 'Logarithmic', 'value': 'log'},
+
+                                                ],
+                                                value='linear',
+                                                id='scale_type',
+                                                labelStyle={'display': 'inline-block'}
+                                            ),
+                                        ]),
+                                        dcc.Markdown('''
+                                        ***Select date range:***
+                                        ''',style={'text-align':'left'}),
+                                        dcc.DatePickerRange(
+                                            id='date-range-1',
+                                            start_date = data.min_date,
+                                            end_date = data.max_date,
+                                            min_date_allowed = data.min_date,
+                                            max_date_allowed = data.max_date,
+                                            display_format='DD-MMM-YYYY'
                                         ),
-                                    ]),
-                                    dcc.Markdown('''
-                                    ***Select date range:***
-                                    ''',style={'text-align':'left'}),
-                                    dcc.DatePickerRange(
-                                        id='date-range-1',
-                                        start_date = pd.to_datetime(df_input_large['date']).min().date(),
-                                        end_date = pd.to_datetime(df_input_large['date']).max().date(),
-                                        min_date_allowed = pd.to_datetime(df_input_large['date']).min().date(),
-                                        max_date_allowed = pd.to_datetime(df_input_large['date']).max().date(),
-                                        display_format='DD-MMM-YYYY'
-                                    ),
-                                ])
+                                    ])
 
-                            ]),
-                            dcc.Graph( id='multi_graph'),
+                                ]),
+                                dcc.Graph( id='multi_graph'),
 
-                        ]),
-                        dcc.Tab(label='Daily', value='tab-2', children=[
-                            html.Div([
-                                html.Br(),
-                                dbc.Row([
-                                    dbc.Col(md=3, children=[
-                                    dcc.Markdown('''
-                                    ***Scale Modes:***
-                                    ''',style={'text-align':'left'}),
-                                    ]),
-                                    dbc.Col(md=4, children=[
-                                        dcc.RadioItems(
-                                            options=[
-                                                {'label': 'Linear', 'value': 'linear'},
-                                                {'label': 'Logarithmic', 'value': 'log'},
-
-                                            ],
-                                            value='linear',
-                                            id='scale_type2',
-                                            labelStyle={'display': 'inline-block'}
+                            ]),
+                            dcc.Tab(label='Daily', value='tab-2', children=[
+                                html.Div([
+                                    html.Br(),
+                                    dbc.Row([
+                                        dbc.Col(md=3, children=[
+                                        dcc.Markdown('''
+                                        ***Scale Modes:***
+                                        ''',style={'text-align':'left'}),
+                                        ]),
+                                        dbc.Col(md=4, children=[
+                                            dcc.RadioItems(
+                                                options=[
+                                                    {'label': 'Linear', 'value': 'linear'},
+                                                    {'label': 'Logarithmic', 'value': 'log'},
+
+                                                ],
+                                                value='linear',
+                                                id='scale_type2',
+                                                labelStyle={'display': 'inline-block'}
+                                            ),
+                                        ]),
+                                        dcc.Markdown('''
+                                        ***Select date range:***
+                                        ''',style={'text-align':'left'}),
+                                        dcc.DatePickerRange(
+                                            id='date-range-2',
+                                            start_date = data.min_date,
+                                            end_date = data.max_date,
+                                            min_date_allowed = data.min_date,
+                                            max_date_allowed = data.max_date,
+                                            display_format='DD-MMM-YYYY'
                                         ),
-                                    ]),
-                                    dcc.Markdown('''
-                                    ***Select date range:***
-                                    ''',style={'text-align':'left'}),
-                                    dcc.DatePickerRange(
-                                        id='date-range-2',
-                                        start_date = pd.to_datetime(df_input_large['date']).min().date(),
-                                        end_date = pd.to_datetime(df_input_large['date']).max().date(),
-                                        min_date_allowed = pd.to_datetime(df_input_large['date']).min().date(),
-                                        max_date_allowed = pd.to_datetime(df_input_large['date']).max().date(),
-                                        display_format='DD-MMM-YYYY'
-                                    ),
-                                ])
+                                    ])
+
+                                ]),
 
+                                dcc.Graph(id = 'multi_graph_daily'),
                             ]),
 
-                            dcc.Graph(id = 'multi_graph_daily'),
                         ]),
 
                     ]),
@@ -228,133 +250,185 @@ def run_dashboard():
 
             ]),
 
-        ]),
 
+            html.Br(),html.Br(),html.Br(),
 
-        html.Br(),html.Br(),html.Br(),
 
+            html.Div([
+                dcc.Markdown('''
+                    ## Compare countries with Confirmed (smoothed) Cases and Doubling Rate
+                    ''',style={'text-align':'center'}),
 
-        html.Div([
-            dcc.Markdown('''
-                ## Compare countries with Confirmed (smoothed) Cases and Doubling Rate
-                ''',style={'text-align':'center'}),
+                dcc.Markdown('''
+                    ***Select one or more countries:***
+                    ''',style={'text-align':'left'}),
 
-            dcc.Markdown('''
-                ***Select one or more countries:***
+                dcc.Dropdown(
+                    id='country_drop_down',
+                    options=[ {'label': each,'value':each} for each in data.countries],
+                    value=['US', 'Germany', 'India'], # which are pre-selected
+                    multi=True,
+                    style=dict(
+                                width='60%',
+                                verticalAlign="left"
+                            )
+                ),
+
+                dcc.Markdown('''
+                    ***Scale Modes:***
+                    ''', style={'text-align':'left'}),
+                dcc.RadioItems(
+                    options=[
+                        {'label': 'Linear', 'value': 'linear'},
+                        {'label': 'Logarithmic', 'value': 'log'},
+                    ],
+                    value='log',
+                    id='scale_type3',
+                    labelStyle={'display': 'inline-block'}
+                ),
+
+                dcc.Markdown('''
+                ***Select number of days for doubling to plot:***
                 ''',style={'text-align':'left'}),
+                daq.NumericInput(
+                    id='doubling-days',
+                    min=0,
+                    max=1000,
+                    value = 30,
+                    size = 100
+                ),
 
-            dcc.Dropdown(
-                id='country_drop_down',
-                options=[ {'label': each,'value':each} for each in df_input_large['country'].unique()],
-                value=['US', 'Germany', 'India'], # which are pre-selected
-                multi=True,
-                style=dict(
-                            width='60%',
-                            verticalAlign="left"
-                        )
-            ),
+                dcc.Markdown('''
+                ***Initial population for doubling:***
+                ''',style={'text-align':'left'}),
+                daq.NumericInput(
+                    id='doubling-init',
+                    min=0,
+                    max=10000,
+                    value = 100,
+                    size = 100
+                ),
 
-            dcc.Markdown('''
-                ***Scale Modes:***
-                ''', style={'text-align':'left'}),
-            dcc.RadioItems(
-                options=[
-                    {'label': 'Linear', 'value': 'linear'},
-                    {'label': 'Logarithmic', 'value': 'log'},
-                ],
-                value='log',
-                id='scale_type3',
-                labelStyle={'display': 'inline-block'}
-            ),
+                dcc.Markdown('''
+                ***Select date range:***
+                ''',style={'text-align':'left'}),
+                dcc.DatePickerRange(
+                    id='date-range-3',
+                    start_date = data.min_date,
+                    end_date = data.max_date,
+                    min_date_allowed = data.min_date,
+                    max_date_allowed = data.max_date,
+                    display_format='DD-MMM-YYYY'
+                ),
 
-            dcc.Markdown('''
-            ***Select number of days for doubling to plot:***
-            ''',style={'text-align':'left'}),
-            daq.NumericInput(
-                id='doubling-days',
-                min=0,
-                max=1000,
-                value = 30,
-                size = 100
-            ),
+                dcc.Graph(id='main_window_DR'),
 
-            dcc.Markdown('''
-            ***Initial population for doubling:***
-            ''',style={'text-align':'left'}),
-            daq.NumericInput(
-                id='doubling-init',
-                min=0,
-                max=10000,
-                value = 100,
-                size = 100
+            ],
             ),
 
-            dcc.Markdown('''
-            ***Select date range:***
-            ''',style={'text-align':'left'}),
-            dcc.DatePickerRange(
-                id='date-range-3',
-                start_date = pd.to_datetime(df_input_large['date']).min().date(),
-                end_date = pd.to_datetime(df_input_large['date']).max().date(),
-                min_date_allowed = pd.to_datetime(df_input_large['date']).min().date(),
-                max_date_allowed = pd.to_datetime(df_input_large['date']).max().date(),
-                display_format='DD-MMM-YYYY'
-            ),
 
-            dcc.Graph(id='main_window_DR'),
+            html.Br(),html.Br(),html.Br(),
 
-        ],
-        ),
 
+            html.Div([
 
-        html.Br(),html.Br(),html.Br(),
+                dcc.Markdown('''
+                ## SIR Modelling
+                ''',style={'text-align':'center'}),
 
+                dcc.Markdown('''
+                    ***Select one country:***
+                    ''',style={'text-align':'left'}),
+                dcc.Dropdown(
+                    id='country_drop_down_sir',
+                    options=[ {'label': each, 'value':each} for each in data.SIR_countries ],
+                    value='Germany', # which are pre-selected
+                    multi=False,
+                    style=dict(
+                                width='60%',
+                                verticalAlign="middle"
+                            )
+                ),
 
-        html.Div([
+                dcc.Markdown('''
+                    ***Scale Modes:***
+                    ''', style={'text-align':'left'}),
+                dcc.RadioItems(
+                    options=[
+                        {'label': 'Linear', 'value': 'linear'},
+                        {'label': 'Logarithmic', 'value': 'log'},
+                    ],
+                    value='log',
+                    id='scale_type4',
+                    labelStyle={'display': 'inline-block'}
+                ),
 
-            dcc.Markdown('''
-            ## SIR Modelling
-            ''',style={'text-align':'center'}),
+                html.Br(),
+                html.Div([
+                    dcc.Graph( id='sir_chart'),
+                ], 
+                ),
 
-            dcc.Markdown('''
-                ***Select one country:***
-                ''',style={'text-align':'left'}),
-            dcc.Dropdown(
-                id='country_drop_down_sir',
-                options=[ {'label': each, 'value':each} for each in list(df_SIR_data.columns) ],
-                value='Germany', # which are pre-selected
-                multi=False,
-                style=dict(
-                            width='60%',
-                            verticalAlign="middle"
-                        )
-            ),
+                dcc.Markdown('''
+                ### SIR Scenario
+                Simulation from the start of the last fitted window, the sliders start at the fitted rates.
+                ''',style={'text-align':'center'}),
 
-            dcc.Markdown('''
-                ***Scale Modes:***
-                ''', style={'text-align':'left'}),
-            dcc.RadioItems(
-                options=[
-                    {'label': 'Linear', 'value': 'linear'},
-                    {'label': 'Logarithmic', 'value': 'log'},
-                ],
-                value='log',
-                id='scale_type4',
-                labelStyle={'display': 'inline-block'}
-            ),
+                dcc.Markdown('''
+                    ***Rate of infection (beta):***
+                    ''', style={'text-align':'left'}),
+                dcc.Slider(
+                    id='sir_beta',
+                    min=SIR_FIT_BOUNDS[0][0],
+                    max=SIR_FIT_BOUNDS[1][0],
+                    step=0.005,
+                    value=0.5,
+                    marks={each: str(each) for each in [0, 1, 2, 5, 10]},
+                    tooltip={'placement': 'bottom'},
+                    updatemode='drag'
+                ),
 
-            html.Br(),
-            html.Div([
-                dcc.Graph( id='sir_chart'),
-            ], 
-            ),
+                dcc.Markdown('''
+                    ***Rate of recovery (gamma):***
+                    ''', style={'text-align':'left'}),
+                dcc.Slider(
+                    id='sir_gamma',
+                    min=SIR_FIT_BOUNDS[0][1],
+                    max=SIR_FIT_BOUNDS[1][1],
+                    step=0.005,
+                    value=0.1,
+                    marks={each: str(each) for each in [0, 1, 2, 5, 10]},
+                    tooltip={'placement': 'bottom'},
+                    updatemode='drag'
+                ),
+
+                dcc.Markdown('''
+                    ***Forecast horizon (days):***
+                    ''', style={'text-align':'left'}),
+                dcc.Slider(
+                    id='sir_horizon',
+                    min=0,
+                    max=365,
+                    step=7,
+                    value=90,
+                    marks={0: '0', 90: '90', 180: '180', 365: '365'},
+                    tooltip={'placement': 'bottom'},
+                    updatemode='drag'
+                ),
 
-        ],),
+                html.Div([
+                    dcc.Graph( id='sir_scenario_chart'),
+                ], 
+                ),
+
+            ],),
 
-        html.Br(),html.Br(),html.Br(),
+            html.Br(),html.Br(),html.Br(),
 
 
-    ])
+        ])
+
+    app.layout = serve_layout
 
 
     #####################################
@@ -373,7 +447,11 @@ def run_dashboard():
 
         ]
     )
+    @figure_cache.cached
     def update_global_map(global_type, global_variable):
+        data = store.data
+
+        df_global_latest_stats = data.df_global_latest_stats
 
         to_show = global_variable + global_type
 
@@ -389,9 +467,9 @@ def run_dashboard():
         scale = scale_variable[global_variable]/scale_type[global_type]
 
         if "ratio" in global_type:
-            text_to_show = df_global_latest_stats['country']+": "+df_global_latest_stats[to_show].astype(str)+" -- Population: "+df_global_latest_stats['population'].astype(int).astype(str)
+            text_to_show = df_global_latest_stats['country'].astype(str)+": "+df_global_latest_stats[to_show].astype(str)+" -- Population: "+df_global_latest_stats['population'].astype(int).astype(str)
         else:    
-            text_to_show = df_global_latest_stats['country']+": "+df_global_latest_stats[to_show].astype(int).astype(str)+" -- Population: "+df_global_latest_stats['population'].astype(int).astype(str)
+            text_to_show = df_global_latest_stats['country'].astype(str)+": "+df_global_latest_stats[to_show].astype(int).astype(str)+" -- Population: "+df_global_latest_stats['population'].astype(int).astype(str)
 
         fig = go.Figure()
 
@@ -437,13 +515,11 @@ def run_dashboard():
          Input('date-range-1', 'end_date'),
         ]
     )
+    @figure_cache.cached
     def update_cummulative_stacked_plot(country, scale_type, start_date, end_date):
+        data = store.data
 
-        df_plot = df_input_large[(df_input_large['country'] == country) & 
-                                 (pd.to_datetime(df_input_large.date) >= pd.to_datetime(start_date)) &
-                                 (pd.to_datetime(df_input_large.date) <= pd.to_datetime(end_date))
-                                ]
-        df_plot = df_plot[['date','state','country','confirmed','confirmed_filtered','deaths',"recovered"]].groupby(['country','date']).agg(np.sum).reset_index()
+        df_plot = data.get_cumulative(country, start_date, end_date)
 
 
         fig=make_subplots(rows=3, cols=1,
@@ -517,16 +593,12 @@ def run_dashboard():
          Input('date-range-2', 'end_date'),
         ]
     )
+    @figure_cache.cached
     def update_daily_stacked_plot(country, scale_type, start_date, end_date):
+        data = store.data
 
-        df_plot = df_input_daily[(df_input_daily['country'] == country) & 
-                                 (pd.to_datetime(df_input_daily.date) >= pd.to_datetime(start_date)) &
-                                 (pd.to_datetime(df_input_daily.date) <= pd.to_datetime(end_date))
-                                ]
-        df_plot_active = df_input_large[(df_input_large['country'] == country) & 
-                                        (pd.to_datetime(df_input_large.date) >= pd.to_datetime(start_date)) &
-                                        (pd.to_datetime(df_input_large.date) <= pd.to_datetime(end_date))
-                                       ]
+        df_plot = data.get_daily(country, start_date, end_date)
+        df_plot_active = data.get_cumulative(country, start_date, end_date)
 
 
         fig=make_subplots(rows=4, cols=1,
@@ -551,7 +623,7 @@ def run_dashboard():
         )
         fig.add_trace(go.Bar(
                             x=df_plot.date,
-                            y=df_plot_active['confirmed'] - (df_plot_active['recovered'] + df_plot_active['deaths']),
+                            y=df_plot_active['active'],
                      ), row=4,col=1
         )
 
@@ -587,7 +659,9 @@ def run_dashboard():
             Input('date-range-3', 'end_date'),
         ]
         )
+    @figure_cache.cached
     def update_confirmed_doublingRate_plot(country_list, scale_type, doubling_days, doubling_init, start_date, end_date):
+        data = store.data
 
         traces = []
         fig = go.Figure()
@@ -597,12 +671,9 @@ def run_dashboard():
 
         for each in country_list:
 
-            df_plot = df_input_large[(df_input_large['country'] == each) & 
-                                     (df_input_large['confirmed_filtered'] >= doubling_init) & 
-                                     (pd.to_datetime(df_input_large.date) >= pd.to_datetime(start_date)) &
-                                     (pd.to_datetime(df_input_large.date) <= pd.to_datetime(end_date))
-                                    ]
-            df_plot = df_plot[['state','country','confirmed_filtered','date']].groupby(['country','date']).agg(np.mean).reset_index()
+            df_plot = data.get_regions(each, start_date, end_date)
+            df_plot = df_plot[df_plot['confirmed_filtered'] >= doubling_init]
+            df_plot = df_plot[['country','confirmed_filtered','date']].groupby(['country','date'], observed=True).agg(np.mean).reset_index()
 
             if max_days < df_plot.shape[0]:
                 max_days = df_plot.shape[0]
@@ -654,23 +725,28 @@ def run_dashboard():
          Input('scale_type4', 'value'),
         ]
     )
+    @figure_cache.cached
     def update_SIR_model(country, scale_type):
+        data = store.data
+        df_analyse = data.df_analyse
+        df_SIR_curve = data.get_SIR_curve(country)
         traces = []
         fig =go.Figure()
 
-        country_data = df_analyse[country][35:150]
-        ydata = np.array(country_data)
-        fitted = np.array(df_SIR_data[country])
+        # truth over the fitted days of the rolling windows
+        fitted_days = df_analyse['date'].isin(df_SIR_curve['date'])
+        ydata = np.array(df_analyse[country][fitted_days])
+        fitted = np.array(df_SIR_curve['fitted'])
 
         fig.add_trace(go.Scatter(
-            x = df_analyse['date'][35:150],
+            x = df_analyse['date'][fitted_days],
             y = ydata,
             mode = 'markers+lines',
             name = country+str(' - Truth'),
             opacity = 0.9
         ))
         fig.add_trace(go.Scatter(
-            x = df_analyse['date'][35:150],
+            x = df_SIR_curve['date'],
             y = fitted,
             mode = 'markers+lines',
             name = country + str(' - Simulation'),
@@ -694,4 +770,137 @@ def run_dashboard():
             ))        
         return fig
 
-    app.run_server(debug=True, use_reloader=False)
+
+
+
+    @app.callback(
+        [Output('sir_beta', 'value'),
+         Output('sir_gamma', 'value'),
+        ],
+        [Input('country_drop_down_sir', 'value')]
+    )
+    def update_SIR_sliders(country):
+        data = store.data
+        df_params = data.get_SIR_params(country)
+        if df_params.empty:
+            return 0.5, 0.1
+        # the slider ranges are the fitter bounds, parameters stored by other fits are clipped to them
+        beta, gamma = np.clip([df_params['beta'].iloc[-1], df_params['gamma'].iloc[-1]], *SIR_FIT_BOUNDS)
+        return round(float(beta), 3), round(float(gamma), 3)
+
+
+
+    @app.callback(
+        Output('sir_scenario_chart', 'figure'),
+        [Input('country_drop_down_sir', 'value'),
+         Input('sir_beta', 'value'),
+         Input('sir_gamma', 'value'),
+         Input('sir_horizon', 'value'),
+         Input('scale_type4', 'value'),
+        ]
+    )
+    @figure_cache.cached
+    def update_SIR_scenario(country, beta, gamma, horizon, scale_type):
+        data = store.data
+        df_params = data.get_SIR_params(country)
+        fig = go.Figure()
+        if df_params.empty:
+            return fig
+
+        last_window = df_params.iloc[-1]
+        start_date = pd.to_datetime(last_window['start_date'])
+        n_days = (pd.to_datetime(last_window['end_date']) - start_date).days + 1
+        N0, I0 = float(last_window['population']), float(last_window['I0'])
+
+        fitted = simulate_SIR(N0, I0, float(last_window['beta']), float(last_window['gamma']), n_days - 1)
+        scenario = simulate_SIR(N0, I0, float(beta), float(gamma), n_days - 1 + int(horizon))
+        dates = pd.date_range(start_date, periods=len(scenario))
+
+        df_analyse = data.df_analyse
+        observed = pd.to_datetime(df_analyse['date']) >= start_date
+
+        fig.add_trace(go.Scatter(
+            x = df_analyse['date'][observed],
+            y = df_analyse[country][observed],
+            mode = 'markers',
+            name = country+str(' - Truth'),
+            opacity = 0.9
+        ))
+        fig.add_trace(go.Scatter(
+            x = dates[:n_days],
+            y = fitted[:, 1],
+            mode = 'lines',
+            name = country + str(' - Fitted'),
+            opacity = 0.9
+        ))
+        fig.add_trace(go.Scatter(
+            x = dates,
+            y = scenario[:, 1],
+            mode = 'lines',
+            name = country + str(' - Scenario'),
+            line = dict(dash='dash'),
+            opacity = 0.9
+        ))
+
+        fig.update_layout(dict(
+                width = 1250,
+                height = 750,
+                xaxis = {
+                    'title': 'Date',
+                    'tickangle': -45,
+                    'nticks' : 20,
+                    'tickfont' : dict(size = 14, color = '#7F7F7A')
+                },
+                yaxis = {
+                    'title': 'Population Infected',
+                    'type': scale_type
+                },
+                margin=dict(l=50, r=50, t=50, b=50)
+            ))
+        return fig
+
+    return app
+
+
+
+def run_dashboard(debug=True):
+    ''' Run the dashboard on the single process development server
+    '''
+    app = create_app()
+    app.run_server(debug=debug, use_reloader=False)
+
+
+
+def serve_dashboard(host='0.0.0.0', port=8050, workers=4, threads=2):
+    ''' Serve the dashboard in production mode with several gunicorn worker processes
+
+        The app and its data are built once in the master process before the
+        workers are forked, debug mode is off.
+
+        Parameters:
+        ----------
+        host: str
+        port: int
+        workers: int
+            number of worker processes
+        threads: int
+            threads per worker process
+    '''
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise ImportError('gunicorn is required for serve_dashboard, install it or use run_dashboard')
+
+    class DashboardApplication(BaseApplication):
+
+        def load_config(self):
+            self.cfg.set('bind', '{}:{}'.format(host, port))
+            self.cfg.set('workers', workers)
+            self.cfg.set('threads', threads)
+            self.cfg.set('preload_app', True)
+
+        def load(self):
+            return server
+
+    server = create_app().server
+    DashboardApplication().run()
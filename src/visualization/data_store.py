@@ -0,0 +1,187 @@
+import os
+import warnings
+import threading
+import pandas as pd
+import numpy as np
+
+from src.data.storage import load_dataset, find_dataset, dataset_exists
+from src.data.schema import compact_frame
+from src.models.SIR_modelling import simulate_SIR_windows, SIR_FIT_START
+
+
+
+class DashboardDataStore:
+    ''' Processed data for the dashboard, reloaded when the datasets change
+
+        The data itself is held by an immutable DashboardData snapshot. A
+        reload builds a complete new snapshot and swaps it in with a single
+        assignment, so a callback that takes store.data once reads frames of
+        one version only, and a failed reload keeps serving the old snapshot.
+    '''
+
+    DATASETS = ['COVID_final_set', 'COVID_final_daily_set', 'COVID_SIR_Model_Data',
+                'COVID_SIR_window_params', 'COVID_full_flat_table', 'global_latest_stats']
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.data = DashboardData(self.data_version())
+
+
+    def __getattr__(self, name):
+        # attributes and accessors of the current snapshot, e.g. store.countries
+        if name == 'data':
+            raise AttributeError(name)
+        return getattr(self.data, name)
+
+
+    def data_version(self):
+        ''' Path, modification time and size of every stored dataset
+        '''
+        version = []
+        for name in self.DATASETS:
+            path, _ = find_dataset(name)
+            if path is None:
+                version.append((name, None, None))
+            else:
+                stat = os.stat(path)
+                version.append((path, stat.st_mtime_ns, stat.st_size))
+        return tuple(version)
+
+
+    def refresh(self):
+        ''' Reload the data if any dataset file changed since the last load
+
+            A reload that fails, e.g. on a file the pipeline is still writing,
+            keeps the current snapshot and is tried again on the next call.
+
+            Returns:
+            ----------
+            version: tuple
+                the data version now held in memory
+        '''
+        version = self.data_version()
+        if version != self.data.version:
+            with self._lock:
+                if version != self.data.version:
+                    try:
+                        self.data = DashboardData(version)
+                    except Exception as error:
+                        warnings.warn('Dashboard data not reloaded: {!r}'.format(error))
+        return self.data.version
+
+
+
+class DashboardData:
+    ''' One loaded version of the processed data, parsed once and not changed afterwards
+
+        The state level and daily data are sorted by (country, date) and the
+        row range of every country is kept, so a callback only touches the
+        rows of the selected country and cuts the date range by binary search.
+        Country level aggregates of the cumulative data are precomputed.
+
+        Parameters:
+        ----------
+        version: tuple
+            data version of the dataset files, taken before loading them
+    '''
+
+    def __init__(self, version):
+        df_input_large = compact_frame(load_dataset('COVID_final_set'))
+        self.countries = list(df_input_large['country'].unique())
+        self.min_date = df_input_large['date'].min().date()
+        self.max_date = df_input_large['date'].max().date()
+
+        df_input_daily = compact_frame(load_dataset('COVID_final_daily_set'))
+
+        df_country = df_input_large[['date','country','confirmed','confirmed_filtered','deaths','recovered']] \
+                        .groupby(['country','date'], observed=True).agg(np.sum).reset_index()
+        df_country['active'] = df_country['confirmed'] - (df_country['recovered'] + df_country['deaths'])
+
+        self.df_input_large, self._large_rows = self._index_by_country(df_input_large)
+        self.df_input_daily, self._daily_rows = self._index_by_country(df_input_daily)
+        self.df_country, self._country_rows = self._index_by_country(df_country)
+
+        self.df_analyse = load_dataset('COVID_full_flat_table')
+
+        # rolling fit over the whole history, curves are regenerated from the parameters on request
+        if dataset_exists('COVID_SIR_window_params'):
+            df_SIR_params = load_dataset('COVID_SIR_window_params')
+            df_SIR_params['country'] = df_SIR_params['country'].astype(str)
+            self.SIR_countries = list(df_SIR_params.loc[df_SIR_params['I0'] > 0, 'country'].unique())
+            self._SIR_curves = {}
+        else:
+            # only the single fit of COVID_SIR_Model_Data was stored (exec_SIR_modelling(rolling=False))
+            df_SIR_params = pd.DataFrame({'country': [], 'window': []})
+            self._SIR_curves = self._get_SIR_model_curves(load_dataset('COVID_SIR_Model_Data'), self.df_analyse['date'])
+            self.SIR_countries = list(self._SIR_curves)
+        self.df_SIR_params = df_SIR_params
+        self._SIR_params = {country: df for country, df in df_SIR_params.groupby('country', sort=False)}
+        self.df_global_latest_stats = compact_frame(load_dataset('global_latest_stats'))
+        self.version = version
+
+
+    @staticmethod
+    def _index_by_country(df):
+        ''' Sort by (country, date) and return the row range of every country
+        '''
+        df = df.sort_values(['country','date'], kind='stable').reset_index(drop=True)
+        codes, uniques = pd.factorize(df['country'])
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        ends = np.r_[starts[1:], len(df)]
+        rows = {uniques[code]: (start, end) for code, start, end in zip(codes[starts], starts, ends)}
+        return df, rows
+
+
+    @staticmethod
+    def _get_SIR_model_curves(df_SIR_data, dates):
+        ''' Fitted curve (date, fitted) of every country with cases in COVID_SIR_Model_Data
+        '''
+        dates = pd.to_datetime(dates).values[SIR_FIT_START:SIR_FIT_START + len(df_SIR_data)]
+        return {country: pd.DataFrame({'date': dates, 'fitted': df_SIR_data[country].values[:len(dates)]})
+                for country in df_SIR_data.columns[(df_SIR_data != 0).any(axis=0)]}
+
+
+    @staticmethod
+    def _slice(df, rows, country, start_date=None, end_date=None):
+        ''' Rows of one country within [start_date, end_date], found by binary search
+        '''
+        if country not in rows:
+            return df.iloc[0:0]
+
+        start, end = rows[country]
+        dates = df['date'].values[start:end]
+        if start_date is not None:
+            start = start + np.searchsorted(dates, np.datetime64(pd.to_datetime(start_date)), side='left')
+        if end_date is not None:
+            end = rows[country][0] + np.searchsorted(dates, np.datetime64(pd.to_datetime(end_date)), side='right')
+        return df.iloc[start:end]
+
+
+    def get_regions(self, country, start_date=None, end_date=None):
+        ''' State level cumulative data of one country '''
+        return self._slice(self.df_input_large, self._large_rows, country, start_date, end_date)
+
+
+    def get_cumulative(self, country, start_date=None, end_date=None):
+        ''' Country level cumulative data including active cases '''
+        return self._slice(self.df_country, self._country_rows, country, start_date, end_date)
+
+
+    def get_daily(self, country, start_date=None, end_date=None):
+        ''' Country level daily data '''
+        return self._slice(self.df_input_daily, self._daily_rows, country, start_date, end_date)
+
+
+    def get_SIR_curve(self, country):
+        ''' Rolling SIR fit of one country over the whole history,
+            where windows overlap the later window is shown '''
+        if country in self._SIR_curves:
+            return self._SIR_curves[country]
+        df_params = self._SIR_params.get(country, self.df_SIR_params.iloc[0:0])
+        df_curve = simulate_SIR_windows(df_params)
+        return df_curve.drop_duplicates('date', keep='last').sort_values('date').reset_index(drop=True)
+
+
+    def get_SIR_params(self, country):
+        ''' Stored parameters of the SIR windows of one country, ordered by window '''
+        return self._SIR_params.get(country, self.df_SIR_params.iloc[0:0]).sort_values('window')
@@ -0,0 +1,96 @@
+import json
+import threading
+import functools
+from collections import OrderedDict
+
+import plotly
+
+
+
+class FigureCache:
+    ''' Bounded LRU cache of serialized Plotly figures for dashboard callbacks
+
+        Figures are stored as JSON strings keyed on the data version, the
+        callback name and its input values, so a repeated view is answered
+        without touching pandas. The cache holds at most max_bytes of
+        serialized figures and is emptied whenever the version callable
+        reports a new data version.
+
+        Parameters:
+        ----------
+        max_bytes: int
+            upper bound of the summed size of all cached figures
+        version: callable
+            returns a hashable token of the underlying data, e.g. the file
+            modification times of the processed datasets
+    '''
+
+    def __init__(self, max_bytes=64*1024*1024, version=None):
+        self.max_bytes = max_bytes
+        self.version = version
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._figures = OrderedDict()
+        self._data_version = None
+        self._lock = threading.Lock()
+
+
+    def clear(self):
+        with self._lock:
+            self._figures.clear()
+            self.size = 0
+
+
+    def _check_version(self):
+        ''' Current data version, the cache is emptied when it changed '''
+        if self.version is None:
+            return None
+        data_version = self.version()
+        if data_version != self._data_version:
+            self.clear()
+            self._data_version = data_version
+        return data_version
+
+
+    def get(self, key):
+        with self._lock:
+            figure_json = self._figures.get(key)
+            if figure_json is None:
+                self.misses += 1
+                return None
+            self._figures.move_to_end(key)
+            self.hits += 1
+            return figure_json
+
+
+    def put(self, key, figure_json):
+        if len(figure_json) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._figures:
+                self.size -= len(self._figures.pop(key))
+            self._figures[key] = figure_json
+            self.size += len(figure_json)
+            while self.size > self.max_bytes:
+                _, evicted = self._figures.popitem(last=False)
+                self.size -= len(evicted)
+
+
+    def cached(self, func):
+        ''' Decorator for a callback returning a Plotly figure
+        '''
+        @functools.wraps(func)
+        def wrapper(*args):
+            # the version is part of the key, so a figure still being built from
+            # older data is never served for a newer version
+            key = (self._check_version(), func.__name__) + tuple(tuple(each) if isinstance(each, list) else each for each in args)
+
+            figure_json = self.get(key)
+            if figure_json is None:
+                figure_json = json.dumps(func(*args), cls=plotly.utils.PlotlyJSONEncoder)
+                self.put(key, figure_json)
+
+            return json.loads(figure_json)
+
+        return wrapper
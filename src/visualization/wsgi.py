@@ -0,0 +1,20 @@
+''' WSGI entry point of the dashboard
+
+    Start gunicorn from the project root and let it change into src, so the
+    package src is importable and the relative data paths resolve, e.g.
+
+        gunicorn --chdir src --preload --workers 4 --threads 2 --bind 0.0.0.0:8050 src.visualization.wsgi:server
+
+    gunicorn keeps its start directory on the import path. To start it from
+    anywhere else, install the project first (pip install -e .) and still
+    pass --chdir with the path of the src folder.
+
+    With --preload the data is loaded once in the master process and shared
+    copy-on-write by the forked workers.
+'''
+from src.visualization.dashboard import create_app
+
+
+
+app = create_app()
+server = app.server
@@ -0,0 +1,109 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import optimize, integrate
+
+from src.models.SIR_modelling import SIRFitter, SIR_model_fit, SIR_FIT_START, SIR_FIT_END, SIR_WINDOW_PARAM_COLUMNS
+from src.models.SIR_modelling import get_windows, get_window_params, simulate_SIR_windows, fit_SIR_parallel, get_n_workers
+
+
+PROCESSED_DIR = os.path.join(os.path.dirname(__file__), '..', 'data', 'processed')
+
+# countries on which the batched fit used to drift along the beta ~ gamma ridge or stop on a bound
+COUNTRIES = ['Kuwait', 'Afghanistan', 'Oman', 'Iraq', 'Chile', 'Singapore', 'Vietnam', 'Cambodia', 'India', 'Germany']
+
+
+
+@pytest.fixture(scope='module')
+def real_series():
+    df_analyse = pd.read_csv(os.path.join(PROCESSED_DIR, 'COVID_full_flat_table.csv'), sep=';')
+    df_population = pd.read_csv(os.path.join(PROCESSED_DIR, 'world_population_data.csv'))
+    year = str(pd.to_datetime(df_analyse['date']).dt.year.min())
+    population = dict(zip(df_population['Country Name'], df_population[year]))
+
+    N0 = np.array([population[country] for country in COUNTRIES], dtype=float)
+    ydata = df_analyse[COUNTRIES].values[SIR_FIT_START:SIR_FIT_END].astype(float)
+    return N0, ydata
+
+
+
+def curve_fit_residual(N0, ydata):
+    ''' Residual of the replaced per country fit, curve_fit on odeint '''
+    t = np.arange(len(ydata), dtype=float)
+    model = lambda x, beta, gamma: integrate.odeint(SIR_model_fit, (N0 - ydata[0], ydata[0], 0), x,
+                                                    args=(beta, gamma, N0))[:, 1]
+    popt, _ = optimize.curve_fit(model, t, ydata, maxfev=10000)
+    residual = model(t, *popt) - ydata
+    return residual @ residual
+
+
+
+def test_fit_matches_curve_fit(real_series):
+    N0, ydata = real_series
+    fitter = SIRFitter(N0).fit(ydata)
+
+    assert fitter.converged_.all()
+    for pos, country in enumerate(COUNTRIES):
+        reference = curve_fit_residual(N0[pos], ydata[:, pos])
+        assert fitter.residual_[pos] <= 1.1*reference + 1.0, country
+
+
+
+def test_fit_is_independent_of_batch(real_series):
+    N0, ydata = real_series
+    batch = SIRFitter(N0).fit(ydata)
+    single = SIRFitter(N0[:1]).fit(ydata[:, :1])
+
+    assert batch.beta_[0] == single.beta_[0]
+    assert batch.gamma_[0] == single.gamma_[0]
+
+
+
+def test_simulation_is_finite_within_bounds():
+    fitter = SIRFitter(np.full(4, 1e6))
+    fitter.t = np.arange(115, dtype=float)
+    fitter.I0 = np.full(4, 10.0)
+
+    # the fixed step integration with two steps per day returned NaN at these rates
+    fitted, jac = fitter.simulate(np.array([0.5, 1.0, 10.0, 10.0]), np.array([6.5, 10.0, 0.0, 10.0]), sensitivities=True)
+
+    assert np.isfinite(fitted).all() and np.isfinite(jac).all()
+
+
+
+def test_non_finite_fit_is_not_converged(real_series):
+    N0, ydata = real_series
+    fitter = SIRFitter(np.r_[np.nan, N0[1:2]]).fit(ydata[:, :2])
+
+    assert not fitter.converged_[0]
+    assert fitter.converged_[1]
+
+
+
+def test_history_too_short_for_a_window():
+    N0, ydata = np.full(2, 1e6), np.ones((SIR_FIT_START + 10, 2))
+    bounds = get_windows(len(ydata))
+    df_params = get_window_params([], bounds, ['A', 'B'], pd.date_range('2020-01-22', periods=len(ydata)),
+                                  N0, ydata, np.zeros((0, 2), dtype=object))
+
+    assert bounds == []
+    assert list(df_params.columns) == SIR_WINDOW_PARAM_COLUMNS and df_params.empty
+    assert simulate_SIR_windows(df_params).empty
+
+
+
+def test_parallel_fit_matches_serial(real_series):
+    N0, ydata = real_series
+    serial = fit_SIR_parallel(N0, ydata, n_workers=1)
+    parallel = fit_SIR_parallel(N0, ydata, n_workers=2, min_chunk=1)
+
+    for name in ['beta_', 'gamma_', 'residual_', 'n_iter_', 'converged_', 'fitted_', 'pcov_']:
+        np.testing.assert_array_equal(getattr(parallel, name), getattr(serial, name), err_msg=name)
+
+
+
+def test_small_batches_are_fitted_serially():
+    assert get_n_workers(200, n_workers=4) == 1
+    assert get_n_workers(200, n_workers=4, min_chunk=50) == 4
+    assert get_n_workers(200, n_workers=4, min_chunk=80) == 2
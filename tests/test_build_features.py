@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+import pytest
+from datetime import timedelta
+from scipy import signal
+
+from src import profiling
+from src.features.build_features import calc_daily_values_all_countries, calc_filtered_data, impute_missing_recovered_data
+
+
+REGIONS = [('no', 'Austria'), ('Hubei', 'China'), ('Beijing', 'China'), ('no', 'Chile')]
+N_DAYS = 30
+IMPUTE_START = pd.to_datetime('2020-02-10')
+
+
+
+@pytest.fixture(autouse=True)
+def no_profile_log(monkeypatch):
+    monkeypatch.setattr(profiling, 'PROFILE_LOG', '')
+
+
+
+@pytest.fixture
+def relational_data():
+    ''' Cumulative counts of REGIONS sorted by date, as melt_JH_data_all returns them,
+        with corrections (decreasing counts) in the confirmed and deaths cases '''
+    rng = np.random.default_rng(0)
+    dates = pd.date_range('2020-01-22', periods=N_DAYS)
+    df = pd.DataFrame({'date': np.repeat(dates.values, len(REGIONS)),
+                       'state': [state for state, _ in REGIONS]*N_DAYS,
+                       'country': [country for _, country in REGIONS]*N_DAYS})
+    for column, scale in [('confirmed', 50), ('deaths', 3), ('recovered', 20)]:
+        daily = rng.integers(0, scale, size=(N_DAYS, len(REGIONS)))
+        daily[N_DAYS//2, 1] = -5*scale
+        df[column] = np.cumsum(daily, axis=0).reshape(-1)
+    return df
+
+
+
+def reference_daily_list(total_list):
+    ''' get_daily_list of the replaced per country implementation '''
+    daily_list = [total_list.pop(0)]
+    for each in range(len(total_list)):
+        daily_list.append(max(0, total_list[each] - total_list[0 if each == 0 else each - 1]))
+    return daily_list
+
+
+
+def reference_daily_values(pd_daily):
+    ''' The replaced per country loop of calc_daily_values_all_countries '''
+    df_daily_all = pd.DataFrame()
+    for country in pd_daily['country'].unique():
+        pd_country = pd_daily[pd_daily['country'] == country]
+        df_daily = pd.DataFrame({'daily_{}'.format(column): reference_daily_list(list(pd_country[column]))
+                                 for column in ['confirmed', 'deaths', 'recovered']})
+        df_daily['date'] = pd_country['date'].values
+        df_daily['country'] = pd_country['country'].values
+        df_daily_all = pd.concat([df_daily_all, df_daily])
+    return df_daily_all.reset_index(drop=True)
+
+
+
+def reference_filtered(df_input, column='confirmed', window=5):
+    ''' The replaced groupby apply of the savgol filter, one series at a time '''
+    filtered = pd.Series(np.nan, index=df_input.index)
+    for _, df_group in df_input.groupby(['state', 'country']):
+        filtered[df_group.index] = signal.savgol_filter(np.array(df_group[column].fillna(0)), window, 1)
+    return filtered
+
+
+
+def reference_impute(pd_result_larg, impute_start_date, look_back=10, recovery_ratio_in_lookback=0.95):
+    ''' The replaced per (country, state) loop of impute_missing_recovered_data '''
+    for country in list(pd_result_larg.country.unique()):
+        for state in pd_result_larg[pd_result_larg['country'] == country].state.unique():
+            rows = (pd_result_larg['country'] == country) & (pd_result_larg['state'] == state)
+            pd_sub = pd_result_larg[rows]
+            d = pd_sub[pd_sub.date >= impute_start_date].deaths.reset_index(drop=True) \
+                - pd_sub[pd_sub.date >= impute_start_date - timedelta(days=1)].deaths.reset_index(drop=True)[0:-1]
+            c = pd_sub.confirmed[-d.shape[0]-look_back:-look_back].reset_index(drop=True) \
+                - pd_sub.confirmed[-d.shape[0]-look_back-1:-look_back-1].reset_index(drop=True)
+            r = pd_sub[pd_sub.date == impute_start_date - timedelta(days=1)].recovered.values[0]
+            impute = r + ((recovery_ratio_in_lookback*c) - d).cumsum()
+            pd_result_larg.loc[rows & (pd_result_larg['date'] >= impute_start_date), 'recovered'] = list(impute.fillna(0).astype(int))
+    return pd_result_larg
+
+
+
+def test_daily_values_match_per_country_loop(relational_data):
+    pd_daily = relational_data.drop('state', axis=1).groupby(['country', 'date']).sum().reset_index()
+
+    pd.testing.assert_frame_equal(calc_daily_values_all_countries(pd_daily), reference_daily_values(pd_daily),
+                                  check_dtype=False)
+
+
+
+def test_filtered_data_matches_groupby_apply(relational_data):
+    df_output = calc_filtered_data(relational_data)
+
+    np.testing.assert_allclose(df_output['confirmed_filtered'], reference_filtered(relational_data), rtol=1e-12, atol=1e-9)
+    pd.testing.assert_frame_equal(df_output.drop('confirmed_filtered', axis=1), relational_data)
+
+
+
+def test_impute_matches_per_region_loop(relational_data):
+    imputed = impute_missing_recovered_data(relational_data.copy(), impute_start_date=IMPUTE_START)
+    reference = reference_impute(relational_data.copy(), IMPUTE_START)
+
+    assert (imputed['recovered'] != relational_data['recovered']).any()
+    np.testing.assert_array_equal(imputed['recovered'].values, reference['recovered'].values)
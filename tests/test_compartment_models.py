@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+from scipy import integrate
+
+from src.models.SIR_modelling import levenberg_marquardt
+from src.models.compartment_models import CompartmentFitter, MODELS
+
+
+N_DAYS = 80
+
+# per model, ranges of the true parameters with clear growth over N_DAYS
+TRUE_PARAMS = {
+    'SIRD': [(0.3, 0.6), (0.05, 0.15), (0.002, 0.01)],
+    'SEIR': [(0.5, 0.9), (0.2, 0.5), (0.05, 0.15)],
+}
+
+
+
+def synthetic_series(model, params, N0, confirmed0=100.0):
+    ''' Observed series of known parameters, integrated by odeint independently of integrate_batch '''
+    t = np.arange(N_DAYS, dtype=float)
+    first = {'confirmed': np.full(len(N0), confirmed0), 'deaths': np.zeros(len(N0))}
+    y0 = np.array(MODELS[model]['initial_state'](N0, first))
+
+    states = np.stack([integrate.odeint(lambda y, t, *args: MODELS[model]['func'](y, t, *args), y0[:, pos], t,
+                                        args=tuple(params[:, pos]) + (N0[pos],), rtol=1e-10, atol=1e-6)
+                       for pos in range(len(N0))], axis=-1)
+    return {name: observe(states) for name, observe in MODELS[model]['observed'].items()}
+
+
+
+@pytest.mark.parametrize('model', sorted(MODELS))
+def test_fit_recovers_known_parameters(model):
+    rng = np.random.default_rng(0)
+    N0 = rng.uniform(1e6, 1e7, 12)
+    params = np.array([rng.uniform(low, high, len(N0)) for low, high in TRUE_PARAMS[model]])
+
+    fitter = CompartmentFitter(model, N0).fit(synthetic_series(model, params, N0))
+
+    assert fitter.converged_.all()
+    np.testing.assert_allclose(fitter.params_, params, rtol=0.01)
+    for name, values in fitter.fitted_.items():
+        assert np.isfinite(values).all(), name
+
+
+
+def test_levenberg_marquardt_recovers_exponential_growth():
+    rng = np.random.default_rng(0)
+    t = np.arange(30, dtype=float)
+    true = np.vstack([rng.uniform(1, 100, 5), rng.uniform(0.05, 0.3, 5)])   # (amplitude, rate) per problem
+    ydata = true[0]*np.exp(np.outer(t, true[1]))                              # (days, n)
+
+    def evaluate(params, idx):
+        curve = params[0]*np.exp(np.outer(t, params[1]))
+        residual = (curve - ydata[:, idx]).T
+        jac = np.stack([np.exp(np.outer(t, params[1])), t[:, None]*curve], axis=-1).transpose(1, 0, 2)
+        return residual, jac
+
+    def step(params, residual, jac, lam):
+        JTJ = np.einsum('nkp,nkq->npq', jac, jac)
+        JTr = np.einsum('nkp,nk->np', jac, residual)
+        diagonal = np.einsum('npp->np', JTJ)
+        JTJ[:, [0, 1], [0, 1]] = diagonal*(1 + lam[:, None])
+        return params - np.linalg.solve(JTJ, JTr[:, :, None])[:, :, 0].T
+
+    init = np.vstack([np.ones(5), np.full(5, 0.1)])
+    params, residual, jac, cost, n_iter, converged = levenberg_marquardt(init, evaluate, step)
+
+    assert converged.all() and (n_iter < 100).all()
+    np.testing.assert_allclose(params, true, rtol=1e-6)
+    assert cost.max() < 1e-6*(ydata**2).sum(axis=0).max()
+
+    # stopped by max_iter before convergence
+    assert not levenberg_marquardt(init, evaluate, step, max_iter=3)[-1].any()
@@ -0,0 +1,201 @@
+import os
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+import requests
+
+from src.data.get_data import download_file, get_feature_table
+
+
+BODY = bytes(range(256))*64
+ETAG = '"v1"'
+
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    ''' Serves BODY under /file with ETag and Range support, answers the
+        status codes in server.failures first and records all requests '''
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        if self.server.failures:
+            self.send_error(self.server.failures.pop(0))
+            return
+        if not self.path.startswith('/file'):
+            self.send_error(404)
+            return
+        if self.headers.get('If-None-Match') == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        start = 0
+        if self.headers.get('Range') and self.headers.get('If-Range') == ETAG:
+            start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+            if start >= len(BODY):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(BODY) - 1, len(BODY)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', ETAG)
+        self.send_header('Content-Length', str(len(BODY) - start))
+        self.end_headers()
+        self.wfile.write(BODY[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+
+class ArcGISHandler(BaseHTTPRequestHandler):
+    ''' Query endpoint of a feature service layer holding FEATURES, returning
+        at most MAX_RECORD_COUNT features per request '''
+
+    MAX_RECORD_COUNT = 300
+    FEATURES = [{'OBJECTID': each, 'GEN': 'Kreis {}'.format(each), 'cases': 7*each % 1000}
+                for each in reversed(range(1, 2538))]
+
+    def do_GET(self):
+        query = {name: values[0] for name, values in parse_qs(urlparse(self.path).query).items()}
+        self.server.requests.append(query)
+
+        if query.get('returnCountOnly') == 'true':
+            answer = {'count': len(self.FEATURES)}
+        else:
+            features = sorted(self.FEATURES, key=lambda each: each[query['orderByFields']])
+            offset = int(query['resultOffset'])
+            count = min(int(query['resultRecordCount']), self.MAX_RECORD_COUNT)
+            fields = list(features[0]) if query['outFields'] == '*' else query['outFields'].split(',')
+            answer = {'features': [{'attributes': {name: each[name] for name in fields}}
+                                   for each in features[offset:offset + count]],
+                      'exceededTransferLimit': offset + count < len(features)}
+
+        body = json.dumps(answer).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+
+def start_server(handler):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.requests = []
+    server.failures = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    return server
+
+
+
+@pytest.fixture
+def server():
+    server = start_server(StandInHandler)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+
+@pytest.fixture
+def arcgis_server():
+    server = start_server(ArcGISHandler)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+
+def test_unchanged_file_is_not_downloaded_again(server, tmp_path):
+    filename = str(tmp_path / 'data.bin')
+
+    assert download_file(server.url + '/file', filename, backoff=0) is True
+    assert download_file(server.url + '/file', filename, backoff=0) is False
+
+    assert open(filename, 'rb').read() == BODY
+    assert server.requests[1][1]['If-None-Match'] == ETAG
+
+
+
+def test_server_error_is_retried(server, tmp_path):
+    filename = str(tmp_path / 'data.bin')
+    server.failures = [503, 503]
+
+    assert download_file(server.url + '/file', filename, retries=2, backoff=0) is True
+    assert open(filename, 'rb').read() == BODY
+    assert len(server.requests) == 3
+
+
+
+def test_server_error_is_raised_after_last_retry(server, tmp_path):
+    server.failures = [503, 503]
+
+    with pytest.raises(requests.HTTPError):
+        download_file(server.url + '/file', str(tmp_path / 'data.bin'), retries=1, backoff=0)
+    assert len(server.requests) == 2
+
+
+
+def test_missing_file_is_not_retried(server, tmp_path):
+    with pytest.raises(requests.HTTPError):
+        download_file(server.url + '/missing', str(tmp_path / 'data.bin'), retries=3, backoff=0)
+    assert len(server.requests) == 1
+
+
+
+def test_partial_file_is_resumed(server, tmp_path):
+    filename = str(tmp_path / 'data.bin')
+    with open(filename + '.part', 'wb') as part_file:
+        part_file.write(BODY[:1000])
+    with open(filename + '.part.meta.json', 'w') as meta_file:
+        meta_file.write('{"etag": "\\"v1\\""}')
+
+    assert download_file(server.url + '/file', filename, backoff=0) is True
+    assert open(filename, 'rb').read() == BODY
+    assert server.requests[0][1]['Range'] == 'bytes=1000-'
+    assert not os.path.exists(filename + '.part')
+
+
+
+def test_stale_partial_file_is_downloaded_again(server, tmp_path):
+    filename = str(tmp_path / 'data.bin')
+    with open(filename + '.part', 'wb') as part_file:
+        part_file.write(BODY + b'stale')
+    with open(filename + '.part.meta.json', 'w') as meta_file:
+        meta_file.write('{"etag": "\\"v1\\""}')
+
+    assert download_file(server.url + '/file', filename, retries=0, backoff=0) is True
+    assert open(filename, 'rb').read() == BODY
+    assert 'Range' not in server.requests[1][1]
+
+
+
+def test_feature_table_reads_all_pages_in_order(arcgis_server):
+    df = get_feature_table(arcgis_server.url + '/query', fields=['OBJECTID', 'GEN'], page_size=1000, max_workers=4)
+
+    assert list(df.columns) == ['OBJECTID', 'GEN']
+    assert len(df) == len(ArcGISHandler.FEATURES)
+    assert list(df['OBJECTID']) == list(range(1, len(df) + 1))
+    assert df['GEN'].iloc[-1] == 'Kreis {}'.format(len(df))
+
+    pages = [query for query in arcgis_server.requests if 'resultOffset' in query]
+    assert all(query['outFields'] == 'OBJECTID,GEN' for query in pages)
+    assert max(int(query['resultRecordCount']) for query in pages) == 1000
+
+
+
+def test_feature_table_reads_all_fields(arcgis_server):
+    df = get_feature_table(arcgis_server.url + '/query', page_size=500, max_workers=2)
+
+    assert list(df.columns) == ['OBJECTID', 'GEN', 'cases']
+    assert list(df['cases']) == [7*each % 1000 for each in range(1, len(df) + 1)]
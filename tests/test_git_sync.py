@@ -0,0 +1,82 @@
+import os
+import subprocess
+
+import pytest
+
+from src.data.get_data import sync_sparse_repo
+
+
+SPARSE_PATHS = ['csse_covid_19_data/csse_covid_19_time_series']
+
+
+
+def run_git(cwd, *args):
+    return subprocess.run(['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com'] + list(args),
+                          cwd=cwd, check=True, capture_output=True, text=True).stdout.strip()
+
+
+
+def commit_file(work_dir, path, content):
+    filename = os.path.join(work_dir, path)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'w') as file_obj:
+        file_obj.write(content)
+    run_git(work_dir, 'add', path)
+    run_git(work_dir, 'commit', '-m', 'update ' + path)
+    run_git(work_dir, 'push', 'origin', 'master')
+
+
+
+@pytest.fixture
+def remote(tmp_path):
+    ''' Local bare repository shaped like the Johns Hopkins repository, and a work tree pushing to it '''
+    bare_dir, work_dir = str(tmp_path / 'remote.git'), str(tmp_path / 'work')
+    run_git(str(tmp_path), 'init', '--bare', '-b', 'master', bare_dir)
+    run_git(str(tmp_path), 'clone', bare_dir, work_dir)
+    run_git(work_dir, 'checkout', '-b', 'master')
+
+    commit_file(work_dir, 'README.md', 'readme')
+    commit_file(work_dir, 'csse_covid_19_data/csse_covid_19_daily_reports/01-22-2020.csv', 'daily')
+    commit_file(work_dir, 'csse_covid_19_data/csse_covid_19_time_series/confirmed.csv', 'a;b\n1;2\n')
+    return 'file://' + bare_dir, work_dir
+
+
+
+def test_sparse_shallow_checkout(remote, tmp_path):
+    git_url, _ = remote
+    repo_dir = str(tmp_path / 'COVID-19')
+
+    assert sync_sparse_repo(git_url, repo_dir, 'master', SPARSE_PATHS) is True
+
+    assert os.path.isfile(os.path.join(repo_dir, SPARSE_PATHS[0], 'confirmed.csv'))
+    assert not os.path.exists(os.path.join(repo_dir, 'csse_covid_19_data', 'csse_covid_19_daily_reports'))
+    assert run_git(repo_dir, 'rev-parse', '--is-shallow-repository') == 'true'
+    assert run_git(repo_dir, 'rev-list', '--count', 'HEAD') == '1'
+
+
+
+def test_changes_are_reported(remote, tmp_path):
+    git_url, work_dir = remote
+    repo_dir = str(tmp_path / 'COVID-19')
+    sync_sparse_repo(git_url, repo_dir, 'master', SPARSE_PATHS)
+
+    assert sync_sparse_repo(git_url, repo_dir, 'master', SPARSE_PATHS) is False
+
+    commit_file(work_dir, 'csse_covid_19_data/csse_covid_19_daily_reports/01-23-2020.csv', 'daily')
+    assert sync_sparse_repo(git_url, repo_dir, 'master', SPARSE_PATHS) is False
+
+    commit_file(work_dir, 'csse_covid_19_data/csse_covid_19_time_series/confirmed.csv', 'a;b\n1;3\n')
+    assert sync_sparse_repo(git_url, repo_dir, 'master', SPARSE_PATHS) is True
+    with open(os.path.join(repo_dir, SPARSE_PATHS[0], 'confirmed.csv')) as file_obj:
+        assert file_obj.read() == 'a;b\n1;3\n'
+
+
+
+def test_full_checkout_is_reduced(remote, tmp_path):
+    git_url, _ = remote
+    repo_dir = str(tmp_path / 'COVID-19')
+    run_git(str(tmp_path), 'clone', git_url, repo_dir)
+
+    assert sync_sparse_repo(git_url, repo_dir, 'master', SPARSE_PATHS) is False
+    assert os.path.isfile(os.path.join(repo_dir, SPARSE_PATHS[0], 'confirmed.csv'))
+    assert not os.path.exists(os.path.join(repo_dir, 'csse_covid_19_data', 'csse_covid_19_daily_reports'))
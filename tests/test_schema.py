@@ -0,0 +1,14 @@
+import numpy as np
+import pandas as pd
+
+from src.data.schema import compact_frame
+
+
+
+def test_compact_counts_do_not_wrap():
+    df = compact_frame(pd.DataFrame({'confirmed': [100, 100], 'deaths': [1, np.nan], 'recovered': [0, 3_000_000_000]}))
+
+    assert df['confirmed'].dtype == np.int32
+    assert df['deaths'].dtype == 'Int32'
+    assert df['recovered'].dtype == np.int64
+    assert df['confirmed'].sum() == 200 and (df['confirmed'] + df['confirmed']).tolist() == [200, 200]
@@ -0,0 +1,75 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+from src import profiling
+from src.data import storage
+from src.data.process_JH_data import store_relational_JH_data_type, JH_DATA_PATH
+from src.data.storage import load_dataset, parquet_parts
+
+
+N_DAYS = 12
+
+
+
+def write_raw_data(n_days):
+    ''' Wide JH table of three regions with the first n_days date columns '''
+    dates = pd.date_range('2020-01-22', periods=N_DAYS)[:n_days]
+    pd_raw = pd.DataFrame({'Province/State': [np.nan, 'Hubei', np.nan],
+                           'Country/Region': ['Afghanistan', 'China', 'Germany'],
+                           'Lat': [33.9, 30.9, 51.2],
+                           'Long': [67.7, 112.3, 10.5]})
+    for day, date in enumerate(dates):
+        pd_raw['{}/{}/{}'.format(date.month, date.day, date.strftime('%y'))] = [day, 10*day, day*day]
+    pd_raw.to_csv(JH_DATA_PATH.format('confirmed'), index=False)
+
+
+
+@pytest.fixture
+def processed_dir(tmp_path, monkeypatch):
+    ''' Empty data tree, the relative data paths of the pipeline point into it '''
+    os.makedirs(tmp_path / 'src')
+    os.makedirs(tmp_path / 'data' / 'processed')
+    os.makedirs(os.path.dirname(str(tmp_path / 'src' / JH_DATA_PATH)))
+    monkeypatch.chdir(tmp_path / 'src')
+    monkeypatch.setattr(profiling, 'PROFILE_LOG', '')
+    return storage.PROCESSED_DIR
+
+
+
+@pytest.mark.parametrize('fmt', ['csv', 'parquet'])
+def test_incremental_matches_full_rebuild(processed_dir, monkeypatch, fmt):
+    monkeypatch.setattr(storage, 'STORAGE_FORMAT', fmt)
+
+    write_raw_data(5)
+    store_relational_JH_data_type('confirmed', incremental=True)
+    write_raw_data(8)
+    store_relational_JH_data_type('confirmed', incremental=True)
+    write_raw_data(N_DAYS)
+    store_relational_JH_data_type('confirmed', incremental=True)
+
+    assert len(parquet_parts('COVID_relational_confirmed')) == (2 if fmt == 'parquet' else 0)
+    df_incremental = load_dataset('COVID_relational_confirmed')
+
+    store_relational_JH_data_type('confirmed', incremental=False)
+    assert parquet_parts('COVID_relational_confirmed') == []
+
+    pd.testing.assert_frame_equal(df_incremental, load_dataset('COVID_relational_confirmed'))
+    assert len(df_incremental) == 3*N_DAYS
+
+
+
+def test_other_format_only_when_configured_file_missing(tmp_path):
+    directory = str(tmp_path) + os.sep
+    df = pd.DataFrame({'country': ['Chile', 'Germany'], 'confirmed': [1, 2]})
+
+    storage.save_dataset(df, 'global_latest_stats', 'csv', directory)
+    with pytest.warns(UserWarning, match='not stored as parquet'):
+        assert storage.find_dataset('global_latest_stats', 'parquet', directory)[1] == 'csv'
+
+    storage.save_dataset(df.iloc[:1], 'global_latest_stats', 'parquet', directory)
+    modified = os.path.getmtime(os.path.join(directory, 'global_latest_stats.parquet'))
+    os.utime(os.path.join(directory, 'global_latest_stats.csv'), (modified + 60, modified + 60))
+    with pytest.warns(UserWarning, match='newer csv file'):
+        assert len(load_dataset('global_latest_stats', 'parquet', directory)) == 1